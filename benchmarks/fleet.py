@@ -0,0 +1,365 @@
+"""Fleet benchmark of the PrinterManager and the Channels stack.
+
+Connects N simulated printers (printer_manager.simulator) to the PrinterManager and K WebSocket clients
+to the ASGI application of django_project/asgi.py, in one process like daphne runs them. Measures:
+
+- idle: CPU per printer, frames/s, database queries/s, threads and memory while the printers are polled
+- latency: serial line -> browser frame, a temperature report written by a simulated printer until a
+  client receives the status with that temperature (per printer sockets and fleet sockets)
+- upload: bytes/s of uploads to all printers at once, with the queries and CPU during the upload
+
+Uses a temporary SQLite database and the in-memory channel layer, SECRET_KEY and the other settings come
+from .env as usual. The results are printed and written as JSON together with the commit, by default to
+benchmarks/results/fleet_<commit>.json, so runs on different commits can be compared. Run from the project
+root (Linux/macOS):
+
+    python -m benchmarks.fleet [--printers N] [--clients K] [--fleet-clients F] [--duration S]
+                               [--samples N] [--kbytes N] [--output FILE]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_INTERVAL = 0.2 # Seconds between two latency samples of a printer
+SAMPLE_TIMEOUT = 5 # Seconds until a sample that didn't reach a client counts as lost
+PASSWORD = "benchmark"
+RESULTS_DIR = os.path.join(PROJECT_DIR, "benchmarks", "results") # Default place of the JSON results, not committed
+
+def setup_django(directory):
+    """Configure Django with a temporary database and the in-memory channel layer."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'benchmark.sqlite3')}"
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_project.settings")
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.core.management import call_command
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    call_command("migrate", verbosity=0)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def memory_mb():
+    """Resident memory of the process, the peak if the current value is not available."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+def os_threads():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentiles(values):
+    """Latency statistics in milliseconds."""
+    if not values:
+        return {"samples": 0}
+    values = sorted(value * 1000 for value in values)
+    def at(fraction):
+        return round(values[min(int(len(values) * fraction), len(values) - 1)], 2)
+    return {"samples": len(values), "mean_ms": round(sum(values) / len(values), 2),
+            "p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": round(values[-1], 2)}
+
+def generate(path, kbytes):
+    random.seed(1)
+    with open(path, "w") as file:
+        size = 0
+        while size < kbytes * 1000:
+            line = f"G1 X{random.uniform(10, 200):.3f} Y{random.uniform(10, 200):.3f} E{random.uniform(0, 5):.5f}\n"
+            file.write(line)
+            size += len(line)
+
+
+class QueryCounter:
+    """Counts the database queries of all threads."""
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Meter:
+    """CPU, queries and frames between start() and stop()."""
+    def __init__(self, queries, clients):
+        self.queries = queries
+        self.clients = clients
+
+    def start(self):
+        self.time = time.perf_counter()
+        self.cpu = time.process_time()
+        self.query_count = self.queries.count
+        self.frames = sum(client.frames for client in self.clients)
+
+    def stop(self, printers):
+        seconds = time.perf_counter() - self.time
+        return {
+            "seconds": round(seconds, 2),
+            "cpu_percent": round((time.process_time() - self.cpu) / seconds * 100, 2),
+            "cpu_percent_per_printer": round((time.process_time() - self.cpu) / seconds * 100 / printers, 3),
+            "db_queries_per_second": round((self.queries.count - self.query_count) / seconds, 2),
+            "frames_per_second": round((sum(client.frames for client in self.clients) - self.frames) / seconds, 2),
+            "threads": threading.active_count(),
+            "os_threads": os_threads(),
+            "rss_mb": round(memory_mb(), 1),
+        }
+
+
+class Client:
+    """A browser socket, reads all frames and reports the temperatures it sees to the latency tracker."""
+    def __init__(self, application, path, cookie, tracker, kind):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b"cookie", cookie)])
+        self.tracker = tracker
+        self.kind = kind # "printer" or "fleet"
+        self.frames = 0
+        self.seen = set()
+        self.task = None
+
+    async def connect(self, printer_name=None):
+        connected, _ = await self.communicator.connect(timeout=10)
+        if not connected:
+            raise RuntimeError(f"WebSocket connection to {self.communicator.scope['path']} refused.")
+        self.printer_name = printer_name
+        self.task = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.communicator.receive_output(timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+            if message["type"] != "websocket.send":
+                return
+            now = time.perf_counter()
+            self.frames += 1
+            data = json.loads(message.get("text") or "{}")
+            if self.kind == "fleet":
+                documents = (data.get("printers") or {}).items()
+            else:
+                documents = [(self.printer_name, data)]
+            for printer_name, document in documents:
+                if document and "hotend_temp" in document:
+                    self.tracker.seen(self, printer_name, document["hotend_temp"], now)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.communicator.disconnect()
+
+
+class LatencyTracker:
+    """Temperatures written by the simulated printers and the time they were written."""
+    def __init__(self):
+        self.sent = {} # (printer name, temperature text) -> time written
+        self.latencies = {"printer": [], "fleet": []}
+        self.expected = {"printer": 0, "fleet": 0} # Arrivals expected if no sample is coalesced or lost
+
+    def seen(self, client, printer_name, temperature, now):
+        key = (printer_name, temperature)
+        sent = self.sent.get(key)
+        if sent is not None and key not in client.seen:
+            client.seen.add(key)
+            self.latencies[client.kind].append(now - sent)
+
+    def missing(self, kind):
+        return self.expected[kind] - len(self.latencies[kind])
+
+
+async def measure_latency(simulator, printers, watchers, tracker, samples):
+    """Write temperature reports on every watched printer, samples per printer.
+    watchers maps the printer names to the number of (printer, fleet) clients that see the printer."""
+    async def sample(name, printer, number):
+        temperature = 100 + number % 1000 * 0.1
+        def report():
+            # The temperature stays until the next sample, polling doesn't overwrite it
+            printer.hotend_temp = printer.hotend_target = temperature
+            printer.write(f"T:{temperature:.2f} /{temperature:.2f} B:20.00 /0.00\n")
+        tracker.sent[(name, f"{temperature:.1f}")] = time.perf_counter()
+        tracker.expected["printer"] += watchers[name][0]
+        tracker.expected["fleet"] += watchers[name][1]
+        await asyncio.to_thread(simulator.call, report)
+
+    async def sample_printer(name, printer, offset):
+        await asyncio.sleep(offset)
+        for number in range(1, samples + 1):
+            await sample(name, printer, number)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    await asyncio.gather(*(sample_printer(name, printer, index * SAMPLE_INTERVAL / len(printers))
+                           for index, (name, printer) in enumerate(printers.items()) if any(watchers[name])))
+    deadline = time.perf_counter() + SAMPLE_TIMEOUT
+    while tracker.missing("printer") and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run(args, manager, simulator, printers, cookie, queries, filename):
+    from django_project.asgi import application
+    tracker = LatencyTracker()
+    names = list(printers)
+
+    clients = []
+    for index in range(args.clients):
+        name = names[index % len(names)]
+        client = Client(application, f"/ws/printers/{index % len(names) + 1}/", cookie, tracker, "printer")
+        await client.connect(name)
+        clients.append(client)
+    for _ in range(args.fleet_clients):
+        client = Client(application, "/ws/printers/", cookie, tracker, "fleet")
+        await client.connect()
+        clients.append(client)
+    watchers = {name: (sum(client.kind == "printer" and client.printer_name == name for client in clients),
+                       sum(client.kind == "fleet" for client in clients)) for name in names}
+
+    results = {}
+    meter = Meter(queries, clients)
+    await asyncio.sleep(2) # Let the first polls settle
+
+    meter.start()
+    await asyncio.sleep(args.duration)
+    results["idle"] = meter.stop(len(names))
+
+    meter.start()
+    await measure_latency(simulator, printers, watchers, tracker, args.samples)
+    results["latency"] = dict(meter.stop(len(names)),
+                              printer=dict(percentiles(tracker.latencies["printer"]), lost=tracker.missing("printer")),
+                              # Fleet frames carry only the newest value of a frame period, older samples are coalesced
+                              fleet=dict(percentiles(tracker.latencies["fleet"]), coalesced=tracker.missing("fleet")))
+
+    if args.kbytes:
+        for name in names:
+            manager.get_state(name).update(job_status_error=False)
+        meter.start()
+        await asyncio.gather(*(asyncio.to_thread(manager.upload_file, name, filename) for name in names))
+        upload = meter.stop(len(names))
+        size = os.path.getsize(filename)
+        upload.update(bytes=size * len(names), failed=sum(manager.snapshot(name).job_status_error for name in names),
+                      bytes_per_second=round(size * len(names) / upload["seconds"]),
+                      bytes_per_second_per_printer=round(size / upload["seconds"]))
+        results["upload"] = upload
+
+    for client in clients:
+        await client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the printer manager and the Channels stack with simulated printers.")
+    parser.add_argument("--printers", type=int, default=10, help="number of simulated printers")
+    parser.add_argument("--clients", type=int, default=10, help="WebSocket clients of single printers, spread over the printers")
+    parser.add_argument("--fleet-clients", type=int, default=2, help="WebSocket clients of the whole fleet")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of the idle measurement")
+    parser.add_argument("--samples", type=int, default=20, help="latency samples per printer")
+    parser.add_argument("--kbytes", type=int, default=20, help="size of the uploaded file in kB, 0 to skip the upload")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds until a simulated printer answers a command")
+    parser.add_argument("--output", help="JSON file the results are written to, "
+                                         "benchmarks/results/fleet_<commit>.json by default")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the printer manager")
+    args = parser.parse_args()
+    if args.output:
+        output = os.path.abspath(args.output)
+    else:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"fleet_{git_commit() or 'unknown'}.json")
+
+    # printers_config.json and the database are written to a temporary directory
+    directory = tempfile.mkdtemp()
+    sys.path.insert(0, PROJECT_DIR)
+    os.chdir(directory)
+    setup_django(directory)
+
+    from django.contrib.auth import get_user_model
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    from django.test import Client as HttpClient
+    from printer_manager import printer_manager as manager_module
+    from printer_manager.instance import printer_manager as manager
+    from printer_manager.simulator import Simulator
+    from printers.models import Printer
+
+    manager_module.DEBUG = False
+    manager.start()
+    queries = QueryCounter()
+    connection_created.connect(queries.install)
+    for connection in connections.all():
+        if connection.connection:
+            queries.install(connection=connection)
+
+    user = get_user_model().objects.create_superuser("benchmark", "benchmark@example.com", PASSWORD)
+    http = HttpClient()
+    http.force_login(user)
+    cookie = f"sessionid={http.cookies['sessionid'].value}".encode()
+    filename = os.path.join(directory, "benchmark.gcode")
+    if args.kbytes:
+        generate(filename, args.kbytes)
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with Simulator() as simulator, quiet:
+        printers = {}
+        for index in range(args.printers):
+            name = f"sim{index}"
+            printers[name] = simulator.add_printer(name, latency=args.latency)
+            Printer.objects.create(name=name, port=printers[name].port)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool: # Connecting waits for the M115 report
+            list(pool.map(lambda name: manager.connect_printer(name, printers[name].port), printers))
+        connect_seconds = time.perf_counter() - start
+        connected = len(manager.printers)
+
+        results = asyncio.run(run(args, manager, simulator, printers, cookie, queries, filename))
+        for name in printers:
+            manager.remove_printer(name)
+
+    report = {
+        "benchmark": "fleet",
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "parameters": {"printers": args.printers, "clients": args.clients, "fleet_clients": args.fleet_clients,
+                       "duration": args.duration, "samples": args.samples, "kbytes": args.kbytes, "latency": args.latency},
+        "connect_seconds": round(connect_seconds, 2),
+        "connected": connected,
+    }
+    report.update(results)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
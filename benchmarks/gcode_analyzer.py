@@ -0,0 +1,79 @@
+"""Benchmark of the G-code analyzer.
+
+Analyzes a G-code file line by line in Python and with NumPy arrays and checks that both give the
+same result. Without --file a sliced-like file with random extrusion moves is generated. Run from
+the project root:
+
+    python -m benchmarks.gcode_analyzer [--file FILE] [--layers N] [--moves N]
+"""
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+
+from printer_manager import gcode_analyzer
+
+def generate(path, layers, moves):
+    """Write a file with a number of layers of random extrusion moves, retracting between layers."""
+    random.seed(1)
+    extruder = 0.0
+    with open(path, "w") as file:
+        file.write(";FLAVOR:Marlin\nM82\nG28\nM104 S200\nG92 E0\n")
+        for layer in range(layers):
+            file.write(f";LAYER:{layer}\nM204 S1500\nG0 F9000 X10 Y10 Z{0.2*(layer + 1):.2f}\n")
+            x, y = 10.0, 10.0
+            for _ in range(moves):
+                new_x, new_y = random.uniform(10, 200), random.uniform(10, 200)
+                extruder += ((new_x - x)**2 + (new_y - y)**2)**0.5 * 0.033
+                file.write(f"G1 F1800 X{new_x:.3f} Y{new_y:.3f} E{extruder:.5f} ; extrude\n")
+                x, y = new_x, new_y
+            file.write(f"G1 E{extruder - 1:.5f} F2400\nG1 E{extruder:.5f} F2400\n")
+        file.write("M104 S0\n")
+
+def timed(analyze, path):
+    start = time.perf_counter()
+    analysis = analyze(path)
+    return analysis, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the G-code analyzer.")
+    parser.add_argument("--file", help="G-code file to analyze, generated if not given")
+    parser.add_argument("--layers", type=int, default=200, help="layers of the generated file")
+    parser.add_argument("--moves", type=int, default=2000, help="moves per layer of the generated file")
+    args = parser.parse_args()
+
+    if gcode_analyzer.numpy is None:
+        print("numpy is not installed, only the line by line analysis is available.")
+        return
+
+    path = args.file
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.gcode")
+        generate(path, args.layers, args.moves)
+    size = os.path.getsize(path)
+    try:
+        lines, lines_time = timed(gcode_analyzer.analyze_lines, path)
+        arrays, arrays_time = timed(gcode_analyzer.analyze_arrays, path)
+    finally:
+        if not args.file:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+    # The sums are added in a different order, floats may differ in the last digits
+    for field in ("duration", "layer_count", "filament_length", "total_bytes", "bounds"):
+        expected, result = getattr(lines, field), getattr(arrays, field)
+        if expected != result and not (isinstance(expected, float) and math.isclose(expected, result, rel_tol=1e-9)):
+            print(f"Warning: results differ in {field}: {expected} != {result}")
+    if ([offset for offset, _ in lines.time_table] != [offset for offset, _ in arrays.time_table]
+            or not all(math.isclose(a, b, rel_tol=1e-9) for (_, a), (_, b) in zip(lines.time_table, arrays.time_table))):
+        print("Warning: results differ in time_table")
+
+    print(f"Analyzed {size / 1e6:.1f} MB, {lines.layer_count} layers, estimated {lines.duration / 3600:.1f} h")
+    print(f"  analyze_lines:  {lines_time:.3f}s")
+    print(f"  analyze_arrays: {arrays_time:.3f}s")
+    print(f"  Speedup: {lines_time / arrays_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark of parallel uploads to several printers.
+
+Uploads the same file to 1, 2, 4, ... simulated printers at once and prints the aggregate throughput.
+The printers are pseudo-terminals answered by a thread that acknowledges every line after the time the
+bytes need at the simulated baud rate. With uploads serialized the aggregate throughput stays at the rate
+of one printer, with the upload pool it grows with the number of printers up to the pool size.
+Run from the project root (Linux/macOS):
+
+    python -m benchmarks.parallel_uploads [--printers 1,2,4,8] [--pool N] [--kbytes N] [--baudrate N]
+"""
+import argparse
+import os
+import pty
+import random
+import tempfile
+import threading
+import time
+import tty
+
+from printer_manager import printer_manager as manager_module
+from printer_manager.printer_manager import PrinterManager
+
+def simulated_printer(baudrate):
+    """Start a simulated printer on a pseudo-terminal and return the name of the port."""
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    seconds_per_byte = 10 / baudrate # 8 data bits, start and stop bit
+
+    def answer(line):
+        if line.startswith("N") or line.startswith("M110") or line.startswith("M28") or line.startswith("M29"):
+            return "ok\n"
+        if line.startswith("M115"):
+            return "FIRMWARE_NAME:Marlin SIMULATED\nok\n"
+        if line.startswith("M105"):
+            return "ok T:20.0 /0.0 B:20.0 /0.0\n"
+        if line.startswith("M27"):
+            return "Not SD printing\nok\n"
+        if line.startswith("M20"):
+            return "Begin file list\nEnd file list\nok\n"
+        return "ok\n"
+
+    def run():
+        buffer = b""
+        while True:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            time.sleep(len(data) * seconds_per_byte)
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                os.write(master, answer(line.decode(errors="ignore").strip()).encode())
+
+    threading.Thread(target=run, daemon=True).start()
+    return os.ttyname(slave)
+
+def generate(path, kbytes):
+    random.seed(1)
+    with open(path, "w") as file:
+        size = 0
+        while size < kbytes * 1000:
+            line = f"G1 X{random.uniform(10, 200):.3f} Y{random.uniform(10, 200):.3f} E{random.uniform(0, 5):.5f}\n"
+            file.write(line)
+            size += len(line)
+
+def upload_all(manager, names, path):
+    """Upload the file to all printers at once, returns the elapsed seconds."""
+    threads = [threading.Thread(target=manager.upload_file, args=(name, path)) for name in names]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parallel uploads to simulated printers.")
+    parser.add_argument("--printers", default="1,2,4,8", help="comma separated printer counts")
+    parser.add_argument("--pool", type=int, default=manager_module.MAX_UPLOADS, help="size of the upload pool")
+    parser.add_argument("--kbytes", type=int, default=20, help="size of the uploaded file in kB")
+    parser.add_argument("--baudrate", type=int, default=250000, help="simulated baud rate")
+    args = parser.parse_args()
+    counts = [int(count) for count in args.printers.split(",")]
+
+    manager_module.DEBUG = False
+    os.chdir(tempfile.mkdtemp()) # printers_config.json is written to the working directory
+    path = os.path.abspath("benchmark.gcode")
+    generate(path, args.kbytes)
+
+    manager = PrinterManager(max_uploads=args.pool)
+    names = []
+    for index in range(max(counts)):
+        name = f"sim{index}"
+        manager.connect_printer(name, simulated_printer(args.baudrate))
+        names.append(name)
+
+    print(f"Upload pool of {args.pool}, {args.kbytes} kB file, {args.baudrate} baud")
+    single = None
+    for count in counts:
+        for name in names:
+            manager.get_state(name).update(job_status_error=False)
+        elapsed = upload_all(manager, names[:count], path)
+        failed = sum(manager.snapshot(name).job_status_error for name in names[:count])
+        throughput = count * os.path.getsize(path) / elapsed / 1000
+        single = single or throughput / count
+        print(f"  {count:3d} printers: {elapsed:6.2f}s, {throughput:8.1f} kB/s aggregate "
+              f"({throughput / single:.1f}x one printer), {failed} failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Micro-benchmark of the serial status line parser.
+
+Replays a captured serial log through the seven separate re.match calls read_serial() used before
+and through parse_status_line(). Run from the project root:
+
+    python -m benchmarks.status_parser [--log FILE] [--repeat N]
+"""
+import argparse
+import os
+import re
+import time
+
+from printer_manager.status_parser import parse_status_line
+
+DEFAULT_LOG = os.path.join(os.path.dirname(__file__), "data", "serial_log.txt")
+
+def legacy_parse(line):
+    """The matching done by read_serial() before the single-pass parser, kept for comparison."""
+    match_temp = re.match(r"(?:ok\s+)?T:([\d\.]+)\s*/[\d\.]+\s+B:([\d\.]+)\s*/[\d\.]+", line)
+    match_temp_2 = re.match(r"T:([\d\.]+).*?B:([\d\.]+)", line)
+    match_time = re.match(r"echo:Print time:\s*(?:(\d+)h\s*)?(?:(\d+)m\s*)?(?:(\d+)s)?", line)
+    match_time_2 = re.match(r"echo:\s*(?:(\d+)\s*hour[s]?,?\s*)?(?:(\d+)\s*min[s]?,?\s*)?(?:(\d+)\s*sec[s]?)", line)
+    match_time_remaining = re.match(r"NORMAL MODE: Percent done: (\d+); print time remaining in mins: (-?\d+)", line)
+    match_status = re.match(r"SD printing byte (\d+)/(\d+)", line)
+    match_status_2 = re.match(r"Not SD printing", line)
+    return (match_temp or match_temp_2 or match_time or match_time_2
+            or match_time_remaining or match_status or match_status_2)
+
+def replay(parse, lines, repeat):
+    """Parse every line repeat times, returns the elapsed seconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            parse(line)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the serial status line parser.")
+    parser.add_argument("--log", default=DEFAULT_LOG, help="captured serial log, one line per printer response")
+    parser.add_argument("--repeat", type=int, default=200, help="number of times the log is replayed")
+    args = parser.parse_args()
+
+    with open(args.log, "r") as file:
+        lines = [line.strip() for line in file if line.strip()]
+    count = len(lines) * args.repeat
+
+    # Both parsers have to agree on which lines carry status
+    mismatched = [line for line in lines if bool(legacy_parse(line)) != bool(parse_status_line(line))]
+    if mismatched:
+        print(f"Warning: parsers disagree on {len(mismatched)} lines, e.g. '{mismatched[0]}'")
+
+    legacy_time = replay(legacy_parse, lines, args.repeat)
+    parser_time = replay(parse_status_line, lines, args.repeat)
+
+    print(f"Lines replayed: {count}")
+    print(f"  re.match x7:       {legacy_time:.3f}s ({legacy_time / count * 1e6:.2f} us/line)")
+    print(f"  parse_status_line: {parser_time:.3f}s ({parser_time / count * 1e6:.2f} us/line)")
+    print(f"  Speedup: {legacy_time / parser_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,7 @@ from channels.auth import AuthMiddlewareStack
 django_asgi_app = get_asgi_application()
 
 from printers.routing import websocket_urlpatterns
+from printer_manager.instance import printer_manager
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
 
@@ -26,4 +27,7 @@ application = ProtocolTypeRouter({
             websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
+
+# The server owns the printers, management commands and tests don't connect them
+printer_manager.start()
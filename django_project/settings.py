@@ -70,6 +70,16 @@ else:
         },
     }
 
+# Frames per second of the fleet status stream (ws/printers/), changes in between are merged
+PRINTER_FLEET_FRAME_RATE = env.float("PRINTER_FLEET_FRAME_RATE", default=2)
+
+# Uploads to the printers' SD cards running at the same time, more uploads wait for a free slot
+PRINTER_MAX_UPLOADS = env.int("PRINTER_MAX_UPLOADS", default=4)
+
+# Unix socket of the printer daemon (manage.py printer_daemon). Empty: the ASGI server connects the printers
+# itself and must run as a single process. Set: the daemon owns the printers and the server can run many workers
+PRINTER_DAEMON_SOCKET = env.str("PRINTER_DAEMON_SOCKET", default="")
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -0,0 +1,161 @@
+import asyncio
+import struct
+
+import serial
+
+try:
+    import heatshrink2
+except ImportError: # Compression is optional, without heatshrink2 files are sent uncompressed
+    heatshrink2 = None
+
+PACKET_TOKEN = 0xB5AD
+
+PROTOCOL_CONNECTION = 0
+PACKET_SYNC = 1
+PACKET_CLOSE = 2
+
+PROTOCOL_FILE_TRANSFER = 1
+PACKET_QUERY = 0
+PACKET_OPEN = 1
+PACKET_CLOSE_FILE = 2
+PACKET_WRITE = 3
+PACKET_ABORT = 4
+
+RESPONSE_TIMEOUT = 5 # Seconds to wait for the acknowledgement of a packet
+MAX_RETRIES = 10 # Times a packet is sent before the transfer is given up
+
+def checksum(data, cs=0):
+    """Fletcher-16 checksum used by the Marlin binary protocol."""
+    for byte in data:
+        low = ((cs & 0xFF) + byte) % 255
+        cs = ((((cs >> 8) + low) % 255) << 8) | low
+    return cs
+
+def build_packet(sync, protocol, packet_type, payload=b""):
+    """Frame a packet: start token, header with its own checksum, payload and a checksum over header and payload."""
+    header = struct.pack("<BBH", sync, (protocol << 4) | packet_type, len(payload))
+    packet = header + struct.pack("<H", checksum(header))
+    if payload:
+        packet += payload
+        packet += struct.pack("<H", checksum(packet))
+    return struct.pack("<H", PACKET_TOKEN) + packet
+
+
+class BinaryTransfer:
+    """Marlin binary file transfer (M28 B1) over an engine connection.
+    Every packet is acknowledged with "ok<sync>", a "rs<sync>" or a timeout sends it again."""
+    def __init__(self, connection, print_response=False):
+        self.connection = connection
+        self.print_response = print_response
+        self.responses = asyncio.Queue()
+        self.sync = 0
+        self.max_block_size = 0
+        self.compression = None # (window, lookahead) when the firmware can decompress heatshrink
+
+    def on_line(self, line):
+        """Line hook of the connection, every line is a protocol response while the transfer runs."""
+        if self.print_response:
+            print(f"Printer response: {line}")
+        self.responses.put_nowait(line)
+        return True
+
+    async def connect(self):
+        """Switch the firmware to the binary protocol and synchronize the packet counter."""
+        self.connection.line_hook = self.on_line
+        self.connection.write(b"M28 B1\n")
+        try:
+            await self.wait_for("ok", timeout=1) # Let the firmware switch before the first packet
+        except asyncio.TimeoutError:
+            pass
+
+        for _ in range(MAX_RETRIES):
+            self.connection.write(build_packet(self.sync, PROTOCOL_CONNECTION, PACKET_SYNC))
+            try:
+                line = await self.wait_for("ss")
+                break
+            except asyncio.TimeoutError:
+                continue
+        else:
+            raise serial.SerialException("Printer did not answer the binary protocol sync.")
+
+        sync, block_size, _ = line[2:].split(",", 2)
+        self.sync = int(sync)
+        self.max_block_size = int(block_size)
+
+        line = await self.send_packet(PROTOCOL_FILE_TRANSFER, PACKET_QUERY, expect="PFT:version:")
+        compression = line.split(":", 3)[3]
+        if compression != "none":
+            _, window, lookahead = compression.split(",")
+            self.compression = (int(window), int(lookahead))
+
+    async def close(self):
+        """Return the firmware to the ASCII protocol."""
+        try:
+            self.connection.write(build_packet(self.sync, PROTOCOL_CONNECTION, PACKET_CLOSE))
+            await asyncio.sleep(0.1)
+        finally:
+            self.connection.line_hook = None
+
+    async def upload(self, sd_filename, data, compress=False, on_progress=None):
+        """Write data to sd_filename on the SD card.
+        on_progress(bytes_done, total_bytes) is called after every acknowledged block."""
+        await self.connect()
+        try:
+            compressed = bool(compress and self.compression and heatshrink2)
+            if compressed:
+                window, lookahead = self.compression
+                data = heatshrink2.compress(bytes(data), window_sz2=window, lookahead_sz2=lookahead)
+
+            payload = b"\0" + (b"\1" if compressed else b"\0") + sd_filename.encode("ascii") + b"\0"
+            line = await self.send_packet(PROTOCOL_FILE_TRANSFER, PACKET_OPEN, payload, expect="PFT:")
+            if line != "PFT:success":
+                raise serial.SerialException(f"Printer could not open '{sd_filename}': {line}")
+
+            try:
+                for offset in range(0, len(data), self.max_block_size):
+                    block = data[offset:offset + self.max_block_size]
+                    await self.send_packet(PROTOCOL_FILE_TRANSFER, PACKET_WRITE, block)
+                    if on_progress:
+                        on_progress(offset + len(block), len(data))
+            except serial.SerialException:
+                await self.send_packet(PROTOCOL_FILE_TRANSFER, PACKET_ABORT)
+                raise
+
+            line = await self.send_packet(PROTOCOL_FILE_TRANSFER, PACKET_CLOSE_FILE, expect="PFT:")
+            if line != "PFT:success":
+                raise serial.SerialException(f"Printer could not close '{sd_filename}': {line}")
+        finally:
+            await self.close()
+
+    async def send_packet(self, protocol, packet_type, payload=b"", expect=None):
+        """Send a packet until it is acknowledged. Returns the response line starting with expect."""
+        for _ in range(MAX_RETRIES):
+            self.connection.write(build_packet(self.sync, protocol, packet_type, payload))
+            try:
+                token = await self.wait_for_ack()
+            except asyncio.TimeoutError:
+                continue
+            if token == "ok":
+                self.sync = (self.sync + 1) % 256
+                break
+        else:
+            raise serial.SerialException(f"Packet {self.sync} was not acknowledged.")
+
+        if expect:
+            return await self.wait_for(expect)
+
+    async def wait_for_ack(self):
+        """Wait for the acknowledgement of the current packet, returns "ok" or "rs"."""
+        while True:
+            line = await asyncio.wait_for(self.responses.get(), RESPONSE_TIMEOUT)
+            if line.startswith("fe"):
+                raise serial.SerialException("Fatal error in binary protocol.")
+            if line[:2] in ("ok", "rs") and line[2:].strip() == str(self.sync):
+                return line[:2]
+
+    async def wait_for(self, prefix, timeout=RESPONSE_TIMEOUT):
+        """Wait for a response line starting with prefix, other lines are skipped."""
+        while True:
+            line = await asyncio.wait_for(self.responses.get(), timeout)
+            if line.startswith(prefix):
+                return line
@@ -0,0 +1,123 @@
+import os
+import copy
+import json
+import time
+import atexit
+import tempfile
+import threading
+
+SAVE_DELAY = 1 # Seconds changes are collected before the file is written, a burst of saves is written once
+BACKUP_SUFFIX = ".bak" # The previous file, loaded when the file can't be read
+
+class ConfigStore:
+    """The printers configuration file, written crash safe in the background.
+    update() only records which printers changed, a writer thread writes the file SAVE_DELAY seconds after
+    the first change. Only the entries that differ from the last update are serialized again, the file is
+    assembled from the cached text of the others and saving an unchanged configuration doesn't write at all.
+    The file is written to a temporary file that replaces it with a rename, so a crash leaves the old or the
+    new file, never a partial one."""
+    def __init__(self, path, delay=SAVE_DELAY):
+        self.path = path
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock() # One write at a time, in the order the changes were made
+        self.entries = {} # Printer name -> its entry serialized as JSON
+        self.values = {} # Printer name -> the entry that was serialized, compared with the next one
+        self.dirty = False
+        self.writes = 0
+        self.thread = None
+        atexit.register(self.flush)
+
+    def load(self):
+        """Read the configuration, a dict of printer name -> entry. Falls back to the backup
+        if the file is missing or damaged, an empty configuration if neither can be read."""
+        for path in (self.path, self.path + BACKUP_SUFFIX):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r") as file:
+                    config = json.load(file)
+                if not isinstance(config, dict):
+                    raise ValueError("Invalid configuration format.")
+            except (json.JSONDecodeError, ValueError, OSError) as e:
+                print(f"Error reading configuration file '{path}': {e}")
+                continue
+            if path != self.path:
+                print(f"Configuration restored from '{path}'.")
+            with self.condition:
+                self.values = copy.deepcopy(config)
+                self.entries = {name: self.serialize(entry) for name, entry in config.items()}
+            return config
+        return {}
+
+    def update(self, config):
+        """Replace the configuration with config, a dict of printer name -> entry. Thread safe, doesn't block on I/O."""
+        with self.condition:
+            if config == self.values:
+                return
+            self.entries = {name: self.entries[name] if name in self.values and self.values[name] == entry
+                            else self.serialize(entry) for name, entry in config.items()}
+            self.values = copy.deepcopy(config)
+            self.dirty = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="config-writer", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def serialize(self, entry):
+        """An entry as it is written into the file, indented like json.dump(config, indent=4)."""
+        return json.dumps(entry, indent=4).replace("\n", "\n    ")
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+            time.sleep(self.delay) # Collect the changes that follow
+            self.flush()
+
+    def flush(self):
+        """Write pending changes now."""
+        with self.write_lock:
+            with self.condition:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                lines = [f"    {json.dumps(name)}: {entry}" for name, entry in self.entries.items()]
+            text = "{\n" + ",\n".join(lines) + "\n}\n" if lines else "{}\n"
+            try:
+                self.write(text)
+            except OSError as e:
+                print(f"Error saving configuration: {e}")
+                with self.condition:
+                    self.dirty = True # Retried with the next change or flush
+                return
+            self.writes += 1
+            print("Configuration saved.")
+
+    def write(self, text):
+        """Replace the file with text atomically, the old file is kept as the backup."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".config-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            if os.path.exists(self.path):
+                os.chmod(temp_path, os.stat(self.path).st_mode & 0o777)
+                os.replace(self.path, self.path + BACKUP_SUFFIX)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        if hasattr(os, "O_DIRECTORY"):
+            # Make the renames durable
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
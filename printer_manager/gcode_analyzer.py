@@ -0,0 +1,529 @@
+import os
+import re
+import math
+import hashlib
+import warnings
+import threading
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError: # The vectorized analysis is optional, without numpy files are analyzed line by line
+    numpy = None
+
+DEFAULT_FEEDRATE = 1500 # mm/min until the file sets F
+DEFAULT_ACCELERATION = 1000 # mm/s^2 until the file sets M204
+JUNCTION_SPEED = 10 # mm/s, speed always allowed at a corner (like Marlin's jerk)
+TABLE_SIZE = 1000 # Approximate number of entries of the byte offset -> time table
+CACHE_SIZE = 32 # Analyses kept by analyze_cached()
+CHUNK_SIZE = 4*1024*1024 # Bytes of the memory-mapped file analyzed at once by analyze_arrays()
+HASH_BLOCK_SIZE = 1024*1024 # Bytes hashed at once by content_hash() without hashlib.file_digest()
+
+REGEX_WORD = re.compile(r"([A-Z])\s*([-+]?\d*\.?\d+)")
+
+# Command codes in analyze_arrays(): letter * 1000 + number
+CODE_G0 = ord("G")*1000
+CODE_G1 = ord("G")*1000 + 1
+CODES_M_STATE = (ord("M")*1000 + 82, ord("M")*1000 + 83, ord("M")*1000 + 204) # M commands handled by Simulation.line()
+PARAM_COLUMNS = {ord("X"): 0, ord("Y"): 1, ord("Z"): 2, ord("E"): 3, ord("F"): 4}
+
+cache = {} # SHA-256 of the content -> GcodeAnalysis, oldest first
+digests = {} # (path, size, modification time) -> SHA-256 of the content, oldest first
+cache_lock = threading.Lock()
+
+def strip_comment(gcode):
+    """Strip whitespace and comments from a G-code line. Returns "" for empty and comment lines."""
+    # Ignore empty lines and full comment lines starting with ';'
+    gcode = gcode.strip()
+    if not gcode or gcode.startswith(';'):
+        return ""
+
+    # Ignore comments after ';' in a command line
+    return gcode.split(';')[0].strip()
+
+def move_time(distance, entry, exit, speed, acceleration):
+    """Duration of a move with a trapezoidal speed profile: accelerate from entry speed to speed,
+    cruise, decelerate to exit speed. If the move is too short to reach speed, the profile is a triangle."""
+    if distance <= 0 or speed <= 0:
+        return 0.0
+    accel_distance = (speed*speed - entry*entry) / (2*acceleration)
+    decel_distance = (speed*speed - exit*exit) / (2*acceleration)
+    if accel_distance + decel_distance <= distance:
+        return (speed - entry) / acceleration + (speed - exit) / acceleration + (distance - accel_distance - decel_distance) / speed
+    peak = math.sqrt((2*acceleration*distance + entry*entry + exit*exit) / 2)
+    return max(peak - entry, 0) / acceleration + max(peak - exit, 0) / acceleration
+
+def move_times(distance, entry, exit, speed, acceleration):
+    """move_time() of arrays of moves."""
+    accel_distance = (speed*speed - entry*entry) / (2*acceleration)
+    decel_distance = (speed*speed - exit*exit) / (2*acceleration)
+    trapezoid = (speed - entry) / acceleration + (speed - exit) / acceleration + (distance - accel_distance - decel_distance) / speed
+    peak = numpy.sqrt((2*acceleration*distance + entry*entry + exit*exit) / 2)
+    triangle = numpy.maximum(peak - entry, 0) / acceleration + numpy.maximum(peak - exit, 0) / acceleration
+    times = numpy.where(accel_distance + decel_distance <= distance, trapezoid, triangle)
+    return numpy.where((distance > 0) & (speed > 0), times, 0.0)
+
+def fill_forward(values, initial):
+    """Replace every NaN with the last value before it, the NaNs at the start with initial."""
+    index = numpy.where(numpy.isnan(values), -1, numpy.arange(len(values)))
+    numpy.maximum.accumulate(index, out=index)
+    return numpy.where(index >= 0, values[index], initial)
+
+
+class GcodeAnalysis:
+    """Result of analyze(): estimated duration in seconds, layer count, filament length in mm,
+    size of the G-code sent to the printer, a table of (byte offset, elapsed seconds) and the
+    bounding box of the extruded moves as (min X, min Y, min Z, max X, max Y, max Z), None without extrusion."""
+    def __init__(self, duration=0.0, layer_count=0, filament_length=0.0, total_bytes=0, time_table=None, bounds=None):
+        self.duration = duration
+        self.layer_count = layer_count
+        self.filament_length = filament_length
+        self.total_bytes = total_bytes
+        self.time_table = time_table or []
+        self.offsets = [offset for offset, _ in self.time_table]
+        self.bounds = bounds
+
+    def elapsed_at(self, current_byte, total_byte=None):
+        """Estimated seconds of printing done when the printer reports current_byte.
+        The position is scaled by total_byte, so the file on the SD card may differ slightly in size."""
+        if not self.time_table or not self.total_bytes:
+            return 0.0
+        offset = current_byte * self.total_bytes / total_byte if total_byte else current_byte
+        index = bisect_right(self.offsets, offset)
+        if index == 0:
+            start_offset, start_time = 0, 0.0
+        else:
+            start_offset, start_time = self.time_table[index - 1]
+        if index >= len(self.time_table):
+            return self.duration
+        end_offset, end_time = self.time_table[index]
+        # Interpolate between the table entries
+        return start_time + (end_time - start_time) * (offset - start_offset) / max(end_offset - start_offset, 1)
+
+    def remaining_at(self, current_byte, total_byte=None):
+        return max(self.duration - self.elapsed_at(current_byte, total_byte), 0.0)
+
+
+class Planner:
+    """Simple motion planner. Moves are finished one behind, when the next move is known the speed
+    at their common corner is decided from the angle between them."""
+    def __init__(self):
+        self.elapsed = 0.0
+        self.acceleration = DEFAULT_ACCELERATION
+        self.pending = None # [distance, speed, direction, entry speed, start offset] of the last move
+
+    def done_offset(self, offset):
+        """Byte offset up to which elapsed is final, offset is the end of the last line read."""
+        return self.pending[4] if self.pending else offset
+
+    def move(self, distance, speed, direction, start_offset):
+        junction = 0.0
+        if self.pending:
+            _, pending_speed, pending_direction, _, _ = self.pending
+            if direction and pending_direction:
+                cos_angle = sum(a*b for a, b in zip(direction, pending_direction))
+                junction = min(speed, pending_speed, max(JUNCTION_SPEED, min(speed, pending_speed) * (1 + cos_angle) / 2))
+            self.finish(junction)
+        self.pending = [distance, speed, direction, junction, start_offset]
+
+    def finish(self, exit=0.0):
+        """Finish the pending move, it ends with the exit speed."""
+        if not self.pending:
+            return
+        distance, speed, _, entry, _ = self.pending
+        exit = min(exit, math.sqrt(entry*entry + 2*self.acceleration*distance)) # Can't accelerate faster
+        self.elapsed += move_time(distance, entry, exit, speed, self.acceleration)
+        self.pending = None
+
+    def wait(self, seconds):
+        self.finish()
+        self.elapsed += seconds
+
+
+class Simulation:
+    """Machine state while a file is analyzed. line() runs one command, moves() runs a block of
+    G0/G1 moves with array operations. Both give the same result and the same time table, the
+    values may differ in the last digits since the array sums are added in another order."""
+    def __init__(self, file_size):
+        self.planner = Planner()
+        self.time_table = []
+        self.table_step = max(file_size // TABLE_SIZE, 1)
+        self.next_entry = self.table_step
+
+        self.position = [0.0, 0.0, 0.0] # X, Y, Z
+        self.extruder = 0.0
+        self.feedrate = DEFAULT_FEEDRATE / 60 # mm/s
+        self.absolute = True
+        self.absolute_extruder = True
+        self.filament_length = 0.0
+        self.layer_count = 0
+        self.layer_z = None
+        self.bounds = None
+
+    def line(self, gcode, line_offset, offset):
+        """Run a line without comment that starts at line_offset and ends at offset in the sent G-code."""
+        words = REGEX_WORD.findall(gcode.upper())
+        if not words:
+            return
+        letter, number = words[0]
+        command = letter + number.split(".")[0].lstrip("0") if number.strip("0.") else letter + "0"
+        params = {letter: float(value) for letter, value in words[1:]}
+        planner = self.planner
+
+        if command in ("G0", "G1", "G2", "G3"):
+            if "F" in params and params["F"] > 0:
+                self.feedrate = params["F"] / 60
+            position = self.position
+            target = list(position)
+            for index, axis in enumerate("XYZ"):
+                if axis in params:
+                    target[index] = params[axis] if self.absolute else position[index] + params[axis]
+            e_delta = 0.0
+            if "E" in params:
+                e_delta = params["E"] - self.extruder if self.absolute_extruder else params["E"]
+                self.extruder += e_delta
+
+            delta = [target[i] - position[i] for i in range(3)]
+            distance = math.sqrt(sum(d*d for d in delta))
+            if command in ("G2", "G3") and ("I" in params or "J" in params):
+                distance = arc_length(position, target, params.get("I", 0.0), params.get("J", 0.0),
+                                      clockwise=command == "G2") or distance
+
+            if distance > 0:
+                direction = [d / distance for d in delta] if command in ("G0", "G1") else None
+                planner.move(distance, self.feedrate, direction, line_offset)
+            elif e_delta:
+                planner.move(abs(e_delta), self.feedrate, None, line_offset) # Retract or prime
+
+            if e_delta > 0 and distance > 0:
+                if target[2] != self.layer_z:
+                    if self.layer_z is None or target[2] > self.layer_z:
+                        self.layer_count += 1
+                    self.layer_z = target[2]
+                self.include(min(position[i], target[i]) for i in range(3))
+                self.include(max(position[i], target[i]) for i in range(3))
+            self.filament_length += e_delta
+            self.position = target
+
+        elif command == "G4":
+            planner.wait(params.get("S", 0.0) + params.get("P", 0.0) / 1000)
+        elif command == "G28":
+            planner.finish()
+            self.position = [0.0, 0.0, 0.0]
+        elif command == "G90":
+            self.absolute, self.absolute_extruder = True, True
+        elif command == "G91":
+            self.absolute, self.absolute_extruder = False, False
+        elif command == "M82":
+            self.absolute_extruder = True
+        elif command == "M83":
+            self.absolute_extruder = False
+        elif command == "G92":
+            for index, axis in enumerate("XYZ"):
+                if axis in params:
+                    self.position[index] = params[axis]
+            if "E" in params:
+                self.extruder = params["E"]
+        elif command == "M204":
+            acceleration = params.get("P", params.get("S"))
+            if acceleration:
+                planner.acceleration = acceleration
+        else:
+            return
+
+        self.record(planner.done_offset(offset), planner.elapsed)
+
+    def moves(self, values, offsets, ends):
+        """Run G0/G1 moves, values has the X, Y, Z, E and F parameter of every move in a row (NaN if
+        the move has none), offsets and ends the start and end offset of every move in the sent G-code."""
+        if not len(values):
+            return
+        planner = self.planner
+        feed = fill_forward(numpy.where(values[:, 4] > 0, values[:, 4] / 60, numpy.nan), self.feedrate)
+
+        targets = numpy.empty((len(values), 3))
+        for index in range(3):
+            if self.absolute:
+                targets[:, index] = fill_forward(values[:, index], self.position[index])
+            else:
+                targets[:, index] = self.position[index] + numpy.cumsum(numpy.nan_to_num(values[:, index]))
+        if self.absolute_extruder:
+            extruder = fill_forward(values[:, 3], self.extruder)
+            e_delta = numpy.diff(extruder, prepend=self.extruder)
+        else:
+            e_delta = numpy.nan_to_num(values[:, 3])
+            extruder = self.extruder + numpy.cumsum(e_delta)
+
+        starts = numpy.vstack(([self.position], targets[:-1]))
+        delta = targets - starts
+        distance = numpy.sqrt((delta*delta).sum(axis=1))
+        has_direction = distance > 0
+        directions = delta / numpy.where(has_direction, distance, 1.0)[:, None]
+        length = numpy.where(has_direction, distance, numpy.abs(e_delta)) # Retract or prime without XYZ
+
+        planned = length > 0
+        if planner.pending is None:
+            # Moves that don't move record their end like in line(), until a move is pending
+            for index in range(int(numpy.argmax(planned)) if planned.any() else len(planned)):
+                self.record(int(ends[index]), planner.elapsed)
+        if planned.any():
+            length, speed, offsets = length[planned], feed[planned], offsets[planned]
+            directions, has_direction = directions[planned], has_direction[planned]
+
+            # The first move joins the move pending in the planner, the last one stays pending
+            planner.move(float(length[0]), float(speed[0]),
+                         directions[0].tolist() if has_direction[0] else None, int(offsets[0]))
+            self.record(int(offsets[0]), planner.elapsed)
+            if len(length) > 1:
+                slower = numpy.minimum(speed[1:], speed[:-1])
+                cos_angle = (directions[1:] * directions[:-1]).sum(axis=1)
+                junction = numpy.minimum(slower, numpy.maximum(JUNCTION_SPEED, slower * (1 + cos_angle) / 2))
+                junction = numpy.where(has_direction[1:] & has_direction[:-1], junction, 0.0)
+                entry = numpy.concatenate(([planner.pending[3]], junction[:-1]))
+                exit = numpy.minimum(junction, numpy.sqrt(entry*entry + 2*planner.acceleration*length[:-1]))
+                elapsed = planner.elapsed + numpy.cumsum(move_times(length[:-1], entry, exit, speed[:-1], planner.acceleration))
+
+                planner.elapsed = float(elapsed[-1])
+                planner.pending = [float(length[-1]), float(speed[-1]),
+                                   directions[-1].tolist() if has_direction[-1] else None,
+                                   float(junction[-1]), int(offsets[-1])]
+                self.record_many(offsets[1:], elapsed)
+
+        extruding = (e_delta > 0) & (distance > 0)
+        if extruding.any():
+            layer_z = targets[extruding, 2]
+            previous_z = numpy.concatenate(([-math.inf if self.layer_z is None else self.layer_z], layer_z[:-1]))
+            self.layer_count += int(numpy.count_nonzero(layer_z > previous_z))
+            self.layer_z = float(layer_z[-1])
+            points = numpy.vstack((starts[extruding], targets[extruding]))
+            self.include(points.min(axis=0).tolist())
+            self.include(points.max(axis=0).tolist())
+
+        self.filament_length += float(e_delta.sum())
+        self.position = targets[-1].tolist()
+        self.extruder = float(extruder[-1])
+        self.feedrate = float(feed[-1])
+
+    def include(self, point):
+        """Grow the bounding box to include an (X, Y, Z) point."""
+        point = list(point)
+        if self.bounds is None:
+            self.bounds = point + point
+        else:
+            self.bounds = [min(self.bounds[i], point[i]) for i in range(3)] + [max(self.bounds[i + 3], point[i]) for i in range(3)]
+
+    def record(self, done_offset, elapsed):
+        """Add a time table entry if done_offset is a table step after the last entry."""
+        if done_offset >= self.next_entry:
+            self.time_table.append((done_offset, elapsed))
+            self.next_entry = done_offset + self.table_step
+
+    def record_many(self, done_offsets, elapsed):
+        """record() for sorted arrays of offsets and elapsed times."""
+        while True:
+            index = numpy.searchsorted(done_offsets, self.next_entry)
+            if index >= len(done_offsets):
+                return
+            self.record(int(done_offsets[index]), float(elapsed[index]))
+
+    def result(self, offset):
+        """Finish the last move and return the GcodeAnalysis, offset is the size of the sent G-code."""
+        self.planner.finish()
+        if not self.time_table or self.time_table[-1][0] != offset:
+            self.time_table.append((offset, self.planner.elapsed))
+        return GcodeAnalysis(self.planner.elapsed, self.layer_count, max(self.filament_length, 0.0),
+                             offset, self.time_table, self.bounds)
+
+
+def analyze(filename):
+    """Simulate the G-code file and return a GcodeAnalysis.
+    Byte offsets count the lines as they are sent to the SD card: without comments, one newline each.
+    Uses analyze_arrays() when numpy is installed, analyze_lines() otherwise."""
+    if numpy is not None:
+        try:
+            return analyze_arrays(filename)
+        except ValueError as e:
+            print(f"Vectorized analysis of '{filename}' failed ({e}), analyzing line by line.")
+    return analyze_lines(filename)
+
+def analyze_lines(filename):
+    """analyze() in plain Python, one line at a time."""
+    simulation = Simulation(os.path.getsize(filename))
+    offset = 0
+    with open(filename, "r", errors="ignore") as file:
+        for line in file:
+            gcode = strip_comment(line)
+            if not gcode:
+                continue
+            line_offset = offset
+            offset += len(gcode) + 1
+            simulation.line(gcode, line_offset, offset)
+    return simulation.result(offset)
+
+def analyze_arrays(filename):
+    """analyze() with NumPy. The file is memory-mapped and analyzed in chunks of CHUNK_SIZE bytes:
+    the X/Y/Z/E/F parameters of the G0/G1 lines are parsed into arrays and every block of moves
+    between two lines that change the machine state (G92, M83, ...) is run with array operations.
+    Raises ValueError for a file it can't parse, analyze_lines() reads any file."""
+    file_size = os.path.getsize(filename)
+    simulation = Simulation(file_size)
+    if not file_size:
+        return simulation.result(0)
+
+    data = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+    start, offset, chunk_size = 0, 0, CHUNK_SIZE
+    while start < file_size:
+        end = min(start + chunk_size, file_size)
+        consumed, offset = analyze_chunk(simulation, data[start:end], offset, final=end == file_size)
+        if not consumed:
+            chunk_size *= 2 # A line longer than the chunk
+            continue
+        start += consumed
+        chunk_size = CHUNK_SIZE
+    return simulation.result(offset)
+
+def analyze_chunk(simulation, chunk, offset, final):
+    """Run the complete lines of a chunk, offset is the sent G-code before the chunk.
+    Returns the number of bytes run and the offset after them."""
+    newlines = numpy.flatnonzero(chunk == ord("\n"))
+    if final:
+        consumed = len(chunk)
+        if not len(newlines) or newlines[-1] != consumed - 1:
+            newlines = numpy.append(newlines, consumed) # Last line without newline
+    elif len(newlines):
+        consumed = int(newlines[-1]) + 1
+    else:
+        return 0, offset
+
+    text = chunk[:consumed].copy()
+    text[(text >= ord("a")) & (text <= ord("z"))] -= 32 # Upper case
+    size = len(text)
+    line_starts = numpy.concatenate(([0], newlines[:-1] + 1))
+    line_ends = newlines
+
+    # Lines without comments and surrounding whitespace, like strip_comment()
+    semicolons = numpy.append(numpy.flatnonzero(text == ord(";")), size)
+    code_ends = numpy.minimum(semicolons[numpy.searchsorted(semicolons, line_starts)], line_ends)
+    blank = (text == ord(" ")) | (text == ord("\t")) | (text == ord("\r")) | (text == ord("\n"))
+    filled = numpy.flatnonzero(~blank)
+    code_starts = numpy.append(filled, size)[numpy.searchsorted(filled, line_starts)]
+    has_code = code_starts < code_ends
+    last_index = numpy.searchsorted(filled, code_ends) - 1
+    code_lasts = numpy.where(last_index >= 0, filled[numpy.maximum(last_index, 0)], -1)
+    sent = numpy.where(has_code, code_lasts - code_starts + 2, 0) # With the newline
+    sent_ends = offset + numpy.cumsum(sent)
+    sent_starts = sent_ends - sent
+
+    # Command code letter * 1000 + number, from at most three digits without decimal point
+    def char(position):
+        return numpy.where(position < code_ends, text[numpy.minimum(position, size - 1)], ord(" "))
+    letter = char(code_starts)
+    number = numpy.zeros(len(line_starts), dtype=numpy.int64)
+    digits = numpy.zeros(len(line_starts), dtype=numpy.int64)
+    reading = numpy.ones(len(line_starts), dtype=bool)
+    for index in range(1, 5):
+        c = char(code_starts + index)
+        digit = reading & (c >= ord("0")) & (c <= ord("9"))
+        number = numpy.where(digit, number*10 + c - ord("0"), number)
+        digits += digit
+        reading &= digit
+    plain = (digits >= 1) & (digits <= 3) & (char(code_starts + digits + 1) != ord("."))
+    code = letter.astype(numpy.int64)*1000 + number
+    is_move = has_code & plain & ((code == CODE_G0) | (code == CODE_G1))
+    # Every other G command and the M commands that change the state run through Simulation.line()
+    is_special = has_code & ~is_move & ((letter == ord("G")) | numpy.isin(code, CODES_M_STATE) | ((letter == ord("M")) & ~plain))
+
+    # Parameter letters of the moves and the numbers after them
+    params = numpy.flatnonzero(numpy.isin(text, list(PARAM_COLUMNS)))
+    param_lines = numpy.searchsorted(line_starts, params, side="right") - 1
+    keep = is_move[param_lines] & (params > code_starts[param_lines]) & (params < code_ends[param_lines])
+    params, param_lines = params[keep], param_lines[keep]
+    numeric = ((text >= ord("0")) & (text <= ord("9"))) | (text == ord(".")) | (text == ord("-")) | (text == ord("+"))
+    breaks = numpy.append(numpy.flatnonzero(~numeric), size)
+    value_starts = params + 1
+    value_ends = breaks[numpy.searchsorted(breaks, value_starts)]
+    # A letter without a number right after it ("X 10") is left to Simulation.line()
+    unusual = param_lines[value_ends == value_starts]
+    is_move[unusual], is_special[unusual] = False, True
+    keep = is_move[param_lines]
+    params, param_lines = params[keep], param_lines[keep]
+    value_starts, value_ends = value_starts[keep], value_ends[keep]
+
+    marks = numpy.zeros(size + 1, dtype=numpy.int8)
+    marks[value_starts] = 1
+    marks[value_ends] = -1
+    numbers = numpy.where(numpy.cumsum(marks[:-1]) > 0, text, ord(" ")).astype(numpy.uint8).tobytes()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        try:
+            parsed = numpy.fromstring(numbers, sep=" ")
+        except (ValueError, DeprecationWarning):
+            raise ValueError("unparsable number in a move")
+    if len(parsed) != len(params):
+        raise ValueError("unparsable number in a move")
+
+    move_lines = numpy.flatnonzero(is_move)
+    values = numpy.full((len(move_lines), 5), numpy.nan)
+    columns = numpy.zeros(256, dtype=numpy.int64)
+    for byte, column in PARAM_COLUMNS.items():
+        columns[byte] = column
+    values[numpy.searchsorted(move_lines, param_lines), columns[text[params]]] = parsed
+
+    # Blocks of moves between the special lines
+    first = 0
+    for line in numpy.flatnonzero(is_special):
+        last = numpy.searchsorted(move_lines, line)
+        simulation.moves(values[first:last], sent_starts[move_lines[first:last]], sent_ends[move_lines[first:last]])
+        gcode = text[code_starts[line]:code_lasts[line] + 1].tobytes().decode("ascii", errors="ignore")
+        simulation.line(gcode, int(sent_starts[line]), int(sent_ends[line]))
+        first = last
+    simulation.moves(values[first:], sent_starts[move_lines[first:]], sent_ends[move_lines[first:]])
+
+    return consumed, int(sent_ends[-1]) if len(sent_ends) else offset
+
+def arc_length(start, end, i, j, clockwise):
+    """Length of a G2/G3 arc in the XY plane, center at start + (I, J)."""
+    center_x, center_y = start[0] + i, start[1] + j
+    radius = math.hypot(i, j)
+    start_angle = math.atan2(start[1] - center_y, start[0] - center_x)
+    end_angle = math.atan2(end[1] - center_y, end[0] - center_x)
+    sweep = start_angle - end_angle if clockwise else end_angle - start_angle
+    if sweep <= 0:
+        sweep += 2*math.pi
+    return math.hypot(radius * sweep, end[2] - start[2])
+
+def content_hash(filename):
+    """SHA-256 of the file content, remembered while the file is unchanged."""
+    key = (os.path.abspath(filename), os.path.getsize(filename), os.path.getmtime(filename))
+    with cache_lock:
+        digest = digests.pop(key, None)
+    if digest is None:
+        with open(filename, "rb") as file:
+            if hasattr(hashlib, "file_digest"):
+                digest = hashlib.file_digest(file, "sha256").hexdigest()
+            else: # Python < 3.11
+                sha256 = hashlib.sha256()
+                for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+                    sha256.update(block)
+                digest = sha256.hexdigest()
+    with cache_lock:
+        remember(digests, key, digest)
+    return digest
+
+def analyze_cached(filename):
+    """analyze() with a cache of the last CACHE_SIZE files by content, so uploading the same file
+    again doesn't analyze it again."""
+    digest = content_hash(filename)
+    with cache_lock:
+        analysis = cache.pop(digest, None)
+    if analysis is None:
+        analysis = analyze(filename)
+    with cache_lock:
+        remember(cache, digest, analysis)
+    return analysis
+
+def remember(entries, key, value):
+    """Add an entry to a cache dict as newest and drop the oldest ones over CACHE_SIZE, hold cache_lock."""
+    entries[key] = value
+    while len(entries) > CACHE_SIZE:
+        del entries[next(iter(entries))]
@@ -0,0 +1,134 @@
+import os
+import json
+import mmap
+import tempfile
+from array import array
+
+from .gcode_analyzer import content_hash, strip_comment
+from .gcode_minifier import Minifier
+
+COMPILED_DIR = ".compiled" # Directory next to the uploaded files that keeps the compiled files
+COMPILED_KEEP = 64 # Compiled files kept per directory, the least recently used are deleted
+
+# Kinds of compiled files
+NUMBERED = "numbered" # "N<line> <command>*<checksum>" lines for the ASCII upload
+PLAIN = "plain" # Commands without comments for the binary upload
+
+def checksum(line):
+    """XOR checksum of the bytes of a line up to '*', as expected by Marlin after '*'."""
+    result = 0
+    for byte in line:
+        if byte == 42: # '*'
+            break
+        result ^= byte
+    return result & 0xff
+
+def add_checksum(gcode, line_number):
+    """Strip the comment of a G-code line and add the line number and checksum. Returns "" for empty lines."""
+    gcode = strip_comment(gcode)
+    if not gcode:
+        return ""
+    line_str = f"N{line_number} {gcode}"
+    return f"{line_str}*{checksum(line_str.encode())}"
+
+def compiled_path(filename, kind, minify=False):
+    """Path of the compiled file of a G-code file, named by the SHA-256 of its content."""
+    name = f"{content_hash(filename)}.{kind}{'.min' if minify else ''}"
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), COMPILED_DIR, name)
+
+def compile_gcode(filename, kind=NUMBERED, minify=False):
+    """Compile a G-code file once into the lines sent to the printer and return the path of the compiled file.
+    The compiled file is stored next to the G-code file with an index of the line ends (.idx) and
+    the number of bytes saved by the minifier (.json), a file with the same content is compiled only once."""
+    path = compiled_path(filename, kind, minify)
+    if all(os.path.exists(path + extension) for extension in ("", ".idx", ".json")):
+        os.utime(path) # Recently used
+        return path
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    minifier = Minifier() if minify else None
+    data = bytearray()
+    ends = array("Q")
+    with open(filename, "r", errors="ignore") as file:
+        for line in file:
+            command = strip_comment(line)
+            if command and minifier:
+                command = minifier.line(command)
+            if command and kind == NUMBERED:
+                command = add_checksum(command, len(ends) + 1)
+            if command:
+                data += command.encode() + b"\n"
+                ends.append(len(data))
+
+    # Write to temporary files first, a concurrent upload never sees a half written file
+    write_file(path + ".json", json.dumps({"saved_bytes": minifier.saved_bytes if minifier else 0}).encode())
+    write_file(path + ".idx", ends.tobytes())
+    write_file(path, data)
+    prune(directory)
+    return path
+
+def write_file(path, data):
+    """Write a file atomically."""
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def prune(directory):
+    """Delete the least recently used compiled files over COMPILED_KEEP."""
+    try:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if not name.endswith((".idx", ".json")) and not name.startswith(".tmp")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[COMPILED_KEEP:]:
+            for old in (path, path + ".idx", path + ".json"):
+                if os.path.exists(old):
+                    os.remove(old)
+    except OSError as e:
+        print(f"Error pruning compiled G-code in '{directory}': {e}")
+
+
+class CompiledGcode:
+    """A compiled file, memory-mapped. Works as a sequence of lines without newline (bytes),
+    so it can be streamed by SerialConnection.stream() without reading the lines into memory.
+    saved_bytes is the number of bytes the minifier removed."""
+    def __init__(self, path):
+        self.ends = array("Q")
+        with open(path + ".idx", "rb") as file:
+            self.ends.frombytes(file.read())
+        with open(path + ".json", "r") as file:
+            self.saved_bytes = json.load(file).get("saved_bytes", 0)
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+
+    @classmethod
+    def open(cls, filename, kind=NUMBERED, minify=False):
+        """Compile a G-code file if needed and open the compiled file."""
+        return cls(compile_gcode(filename, kind, minify))
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.ends)
+        start = self.ends[index - 1] if index > 0 else 0
+        return self.data[start:self.ends[index] - 1]
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
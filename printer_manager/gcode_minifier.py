@@ -0,0 +1,116 @@
+import re
+
+PRECISION = {"X": 3, "Y": 3, "Z": 3, "E": 5, "F": 1} # Decimals kept per parameter of G0/G1, finer than the printer's steps
+AXES = "XYZE"
+
+# Commands that don't move the axes or change the feedrate, the position stays known after them
+SAFE_COMMANDS = {"G4", "M73", "M104", "M105", "M106", "M107", "M109", "M117", "M140", "M141", "M190", "M191",
+                 "M201", "M203", "M204", "M205", "M220", "M221", "M400", "M486", "M572", "M900"}
+# Commands with a text parameter, their whitespace is kept
+TEXT_COMMANDS = {"M23", "M28", "M30", "M32", "M117", "M118", "M928"}
+
+REGEX_COMMAND = re.compile(r"([GMT])0*(\d+)(?=\s|$|[A-Z])")
+REGEX_PARAM = re.compile(r"\s*([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+
+def format_number(value, decimals):
+    """Format a number with at most decimals digits after the point, without trailing zeros."""
+    text = f"{value:.{decimals}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+class Minifier:
+    """Lossless for motion minifier of G-code lines without comments.
+    Drops the parameters of G0/G1 that repeat the known position or feedrate, rounds them to PRECISION
+    and merges whitespace. The position is known after moves and G92 and unknown after any command
+    that may move the axes. Counts the bytes it saves (newlines included)."""
+    def __init__(self):
+        self.absolute = True
+        self.absolute_extruder = True
+        self.position = dict.fromkeys(AXES) # Known position of X, Y, Z and E, None if unknown
+        self.feedrate = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def saved_bytes(self):
+        return self.bytes_in - self.bytes_out
+
+    def line(self, gcode):
+        """Minify a stripped G-code line. Returns "" if the line does nothing and can be dropped."""
+        self.bytes_in += len(gcode) + 1
+        result = self.minify(gcode)
+        if result:
+            self.bytes_out += len(result) + 1
+        return result
+
+    def minify(self, gcode):
+        match = REGEX_COMMAND.match(gcode)
+        if not match:
+            self.forget()
+            return gcode
+        command = match.group(1) + match.group(2)
+        if command in TEXT_COMMANDS:
+            return gcode
+
+        rest = gcode[match.end():]
+        params = REGEX_PARAM.findall(rest)
+        if "".join(letter + number for letter, number in params) != "".join(rest.split()):
+            self.forget() # Parameters that can't be parsed are sent unchanged
+            return gcode
+
+        if command in ("G0", "G1"):
+            return self.move(command, params)
+        if command == "G90":
+            self.absolute, self.absolute_extruder = True, True
+        elif command == "G91":
+            self.absolute, self.absolute_extruder = False, False
+        elif command == "M82":
+            self.absolute_extruder = True
+        elif command == "M83":
+            self.absolute_extruder = False
+        elif command == "G92":
+            values = {letter: float(number) for letter, number in params if letter in AXES}
+            for axis in AXES:
+                if not params or axis in values:
+                    self.position[axis] = values.get(axis, 0.0)
+        elif command in ("G2", "G3"):
+            self.position = dict.fromkeys(AXES)
+            self.update_feedrate(params)
+        elif command not in SAFE_COMMANDS:
+            self.forget()
+        return " ".join([command] + [letter + number for letter, number in params])
+
+    def move(self, command, params):
+        words = []
+        for letter, number in params:
+            if letter in PRECISION:
+                text = format_number(float(number), PRECISION[letter])
+                value = float(text)
+                if letter == "F":
+                    if value == self.feedrate:
+                        continue
+                    self.feedrate = value
+                elif (self.absolute_extruder if letter == "E" else self.absolute):
+                    if value == self.position[letter]:
+                        continue
+                    self.position[letter] = value
+                elif value == 0:
+                    continue
+                elif self.position[letter] is not None:
+                    self.position[letter] += value
+                words.append(letter + text)
+            else:
+                words.append(letter + number)
+        return " ".join([command] + words) if words else ""
+
+    def update_feedrate(self, params):
+        for letter, number in params:
+            if letter == "F":
+                self.feedrate = float(number)
+
+    def forget(self):
+        """The position and feedrate are unknown after a command that may move the axes."""
+        self.position = dict.fromkeys(AXES)
+        self.feedrate = None
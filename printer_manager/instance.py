@@ -1,5 +1,76 @@
+import os
+import threading
+from django.conf import settings
+from django.db import DatabaseError
+from . import printer_manager as manager_module
 from .printer_manager import PrinterManager
+from .rpc import ManagerClient
+from printers.scheduler import DatabaseJobQueue
 
-printer_manager = PrinterManager()
+try:
+    import fcntl
+except ImportError: # Windows, no check for a second server
+    fcntl = None
 
-#added because of desync issue due to separate printer_manager instances across different modules.
\ No newline at end of file
+LOCK_SUFFIX = ".lock" # Next to the configuration file, held by the process that owns the printers
+
+class ManagerProxy:
+    """The PrinterManager of the server process, created by start().
+    The manager opens every serial port, so it is started by the ASGI application (django_project/asgi.py)
+    and never by management commands or tests, which would take the ports of the running server.
+    A lock file makes sure only one process on the machine owns the printers. With PRINTER_DAEMON_SOCKET set
+    they belong to the printer daemon and the server talks to it through a ManagerClient instead.
+    Everything else is passed to the manager, using it before start() raises RuntimeError."""
+    def __init__(self):
+        self._manager = None
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    @property
+    def started(self):
+        return self._manager is not None
+
+    def start(self, local=False):
+        """Create the manager if it isn't running yet and return it.
+        local=True connects the printers in this process even with PRINTER_DAEMON_SOCKET set, for the daemon."""
+        with self._lock:
+            if self._manager is None:
+                if settings.PRINTER_DAEMON_SOCKET and not local:
+                    self._manager = ManagerClient(settings.PRINTER_DAEMON_SOCKET, job_queue=DatabaseJobQueue())
+                else:
+                    self._lock_file = self.claim_printers(manager_module.CONFIG_FILE + LOCK_SUFFIX)
+                    job_queue = DatabaseJobQueue() # The print queues are kept in the database
+                    try:
+                        job_queue.recount()
+                    except DatabaseError as e:
+                        print(f"Error counting the queued jobs: {e}")
+                    self._manager = PrinterManager(job_queue=job_queue,
+                                                   max_uploads=settings.PRINTER_MAX_UPLOADS)
+            return self._manager
+
+    def claim_printers(self, path):
+        """Lock path for this process, the lock is released when the process ends."""
+        lock_file = open(path, "a+")
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.seek(0)
+                owner = lock_file.read().strip() or "another process"
+                lock_file.close()
+                raise RuntimeError(f"The printers are used by process {owner}, stop it first.")
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        return lock_file
+
+    def __getattr__(self, name):
+        manager = self.__dict__.get("_manager")
+        if manager is None:
+            raise RuntimeError(f"printer_manager.{name}: the printer manager is not started, "
+                               "it runs in the ASGI server (printer_manager.start()).")
+        return getattr(manager, name)
+
+#added because of desync issue due to separate printer_manager instances across different modules.
+printer_manager = ManagerProxy()
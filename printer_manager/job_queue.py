@@ -0,0 +1,37 @@
+from collections import deque
+
+class MemoryJobQueue:
+    """Print queue kept in memory, one deque of file names per printer.
+    Used when the PrinterManager runs without the website (printer_shell.py). The website passes a
+    queue with the same methods that keeps the jobs in the database (printers.scheduler.DatabaseJobQueue)."""
+    def __init__(self):
+        self.queues = {}
+
+    def enqueue(self, printer_name, filename, owner=None):
+        """Append a file to the queue of a printer. owner is only stored by the database queue."""
+        self.queues.setdefault(printer_name, deque()).append(filename)
+
+    def dequeue(self, printer_name):
+        """Remove and return the oldest file in the queue, None when the queue is empty."""
+        queue = self.queues.get(printer_name)
+        return queue.popleft() if queue else None
+
+    def remove(self, printer_name, filename):
+        """Remove the newest occurrence of a file from the queue. Returns False if it is not queued."""
+        queue = self.queues.get(printer_name)
+        if not queue or filename not in queue:
+            return False
+        queue.reverse()
+        queue.remove(filename)
+        queue.reverse()
+        return True
+
+    def length(self, printer_name):
+        return len(self.queues.get(printer_name, ()))
+
+    def items(self, printer_name):
+        """Queued file names, oldest first."""
+        return list(self.queues.get(printer_name, ()))
+
+    def remove_printer(self, printer_name):
+        self.queues.pop(printer_name, None)
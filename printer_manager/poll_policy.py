@@ -0,0 +1,75 @@
+import time
+
+# What a printer is doing, selects the poll intervals
+IDLE = "idle"
+HEATING = "heating"
+PRINTING = "printing"
+UPLOADING = "uploading"
+
+# Seconds between two polls of a status command per activity, commands not listed are not polled.
+# M27 is the SD status, M105 the temperatures, M31 the print time.
+POLL_POLICY = {
+    IDLE: {"M105": 10, "M27": 10},
+    HEATING: {"M105": 1, "M27": 5},
+    PRINTING: {"M105": 5, "M27": 2, "M31": 2},
+    UPLOADING: {}, # The upload owns the serial line
+}
+# Auto report command and M115 capability of the status commands the firmware can send on its own
+AUTOREPORTS = {"M105": ("M155 S{}", "AUTOREPORT_TEMP"), "M27": ("M27 S{}", "AUTOREPORT_SD_STATUS")}
+# Commands that change the temperature targets, the temperatures are polled right after them
+TEMPERATURE_COMMANDS = ("M104", "M109", "M140", "M190")
+HEATING_TOLERANCE = 3 # °C below the target that count as heating
+MAX_WAIT = 1 # Seconds, the activity is checked at least this often
+
+def poll_activity(state, uploading=False):
+    """Activity of a printer from its state. Called with or without state.lock held."""
+    if uploading:
+        return UPLOADING
+    if state.status == "SD printing":
+        return PRINTING
+    for temp, target in ((state.hotend_temp, state.hotend_target), (state.bed_temp, state.bed_target)):
+        if target and temp is not None and temp < target - HEATING_TOLERANCE:
+            return HEATING
+    return IDLE
+
+
+class PollScheduler:
+    """Decides which status commands a printer is asked for, by what it is doing.
+    Commands the firmware can auto report (see AUTOREPORTS) are not polled, the report interval is set
+    whenever the activity changes it, and the command is sent once so the state is current right away."""
+    def __init__(self, capabilities=None):
+        capabilities = capabilities or {}
+        self.autoreports = {command: autoreport for command, (autoreport, capability) in AUTOREPORTS.items()
+                            if capabilities.get(capability)}
+        self.reporting = {} # Command -> auto report interval set in the firmware, 0 for off
+        self.sent = {} # Command -> time.monotonic() it was polled last
+
+    def due(self, activity, now=None):
+        """The commands to send now."""
+        now = time.monotonic() if now is None else now
+        policy = POLL_POLICY[activity]
+        commands = []
+        for command, autoreport in self.autoreports.items():
+            interval = policy.get(command, 0)
+            if self.reporting.get(command) != interval:
+                self.reporting[command] = interval
+                commands.append(autoreport.format(interval))
+                if interval:
+                    commands.append(command)
+        for command, interval in policy.items():
+            if command not in self.autoreports and now - self.sent.get(command, float("-inf")) >= interval:
+                self.sent[command] = now
+                commands.append(command)
+        return commands
+
+    def refresh(self, command):
+        """Poll a command with the next due(), e.g. after a G-code changed what it reports."""
+        self.sent.pop(command, None)
+        self.reporting.pop(command, None)
+
+    def wait(self, activity, now=None):
+        """Seconds until the next poll is due, at most MAX_WAIT."""
+        now = time.monotonic() if now is None else now
+        waits = [self.sent.get(command, float("-inf")) + interval - now
+                 for command, interval in POLL_POLICY[activity].items() if command not in self.autoreports]
+        return max(min(waits + [MAX_WAIT]), 0)
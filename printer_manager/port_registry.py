@@ -0,0 +1,116 @@
+import os
+import threading
+from serial.tools import list_ports
+
+try:
+    import pyudev # Optional, hotplug events from udev instead of waiting for the next scan
+except ImportError:
+    pyudev = None
+
+BY_ID_DIRECTORY = "/dev/serial/by-id" # Links named after the USB device, they don't change with the plug order
+DEVICE_PREFIXES = ("ttyACM", "ttyUSB") # Device nodes of USB serial adapters in /dev
+SCAN_INTERVAL = 2 # Seconds between checks for plugged and unplugged devices
+
+class PortRegistry:
+    """The serial ports of the machine, kept up to date by a watcher thread.
+    Every check only lists /dev and the by-id links, the ports are enumerated again only when they changed,
+    right away when pyudev reports a tty event. A port is keyed by its by-id link if it has one, so a printer
+    keeps its port when the devices are plugged in another order. on_change(added, removed) gets the keys
+    and device paths of the ports that appeared and disappeared."""
+    def __init__(self, on_change=None, interval=SCAN_INTERVAL, by_id_directory=None):
+        self.on_change = on_change
+        self.interval = interval
+        self.by_id_directory = by_id_directory or BY_ID_DIRECTORY
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock() # One scan at a time, so on_change sees the changes in order
+        self.ports = [] # (key, device, description) of every port
+        self.signature = None # Listing of the device nodes and links the ports were read from
+        self.scanned = False # The first scan doesn't call on_change
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Read the ports and watch them in the background."""
+        self.scan()
+        self.thread = threading.Thread(target=self.watch, name="port-registry", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+
+    def list(self):
+        """(key, device, description) of every port, from the last scan."""
+        with self.lock:
+            return list(self.ports)
+
+    def watch(self):
+        monitor = None
+        if pyudev:
+            try:
+                monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                monitor.filter_by("tty")
+                monitor.start()
+            except (OSError, ValueError) as e:
+                print(f"No udev events, scanning every {self.interval}s: {e}")
+                monitor = None
+        while not self.stopped.is_set():
+            if monitor:
+                monitor.poll(timeout=self.interval)
+            else:
+                self.stopped.wait(self.interval)
+            if not self.stopped.is_set():
+                try:
+                    self.scan()
+                except Exception as e:
+                    print(f"Error scanning serial ports: {e}")
+
+    def current_signature(self):
+        """What the ports are read from, cheap enough to check every few seconds."""
+        try:
+            devices = sorted(name for name in os.listdir("/dev") if name.startswith(DEVICE_PREFIXES))
+        except OSError:
+            return None # Not Linux, the ports are enumerated every time
+        links = self.by_id_links()
+        return tuple(devices), tuple(sorted(links.items()))
+
+    def by_id_links(self):
+        """Device path -> by-id link."""
+        try:
+            names = os.listdir(self.by_id_directory)
+        except OSError:
+            return {}
+        links = {}
+        for name in names:
+            path = os.path.join(self.by_id_directory, name)
+            links[os.path.realpath(path)] = path
+        return links
+
+    def scan(self):
+        """Read the ports again if the devices changed, calls on_change for the differences."""
+        with self.scan_lock:
+            self._scan()
+
+    def _scan(self):
+        signature = self.current_signature()
+        if signature is not None and signature == self.signature:
+            return
+        links = self.by_id_links()
+        ports = []
+        for port in list_ports.comports():
+            if port.description != "n/a":
+                ports.append((links.pop(os.path.realpath(port.device), port.device), port.device, port.description))
+        for device, link in links.items(): # Linked devices the enumeration doesn't know
+            ports.append((link, device, os.path.basename(link)))
+
+        with self.lock:
+            old = {key: device for key, device, _ in self.ports}
+            self.ports = ports
+            self.signature = signature
+            first, self.scanned = not self.scanned, True
+        if first:
+            return
+        new = {key: device for key, device, _ in ports}
+        added = [(key, device) for key, device in new.items() if key not in old]
+        removed = [(key, device) for key, device in old.items() if key not in new]
+        if (added or removed) and self.on_change:
+            self.on_change(added, removed)
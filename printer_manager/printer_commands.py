@@ -1,71 +1,119 @@
-import serial
+import re
 import time
+import asyncio
+import serial
+
+from .serial_engine import SerialEngine
+
+RX_BUFFER_SIZE = 127 # Bytes of G-code kept in flight during uploads, Marlin's default RX buffer is 128 bytes
+TRANSFER_MODES = ("ascii", "binary")
+REPORT_TIMEOUT = 2 # Seconds to wait for the M115 report, a printer that resets on connect misses the first M115
+REPORT_ATTEMPTS = 3
+CONNECT_DEADLINE = 8 # Seconds a connection attempt may take in total, a bit more than all M115 attempts
+COMMAND_TIMEOUT = 120 # Seconds to wait for the "ok" of a command sent with send_gcode_command()
+
+REGEX_CAPABILITY = re.compile(r"Cap:([A-Z0-9_]+):(\d+)")
 
 class PrinterCommands:
-    def __init__(self, port, baudrate=115200):
+    """Connection of one printer. Owns the only handle of the port, a SerialConnection on the serial engine.
+    The engine reads the port and hands every "ok" to the command waiting for it, the other lines
+    go to on_line(line). Without an engine a private one is started.
+    With auto_connect=False the port is opened later by connect() or probe()."""
+    def __init__(self, port, baudrate=115200, rx_buffer_size=RX_BUFFER_SIZE, transfer_mode="ascii", compression=False, minify=False,
+                 engine=None, on_line=None, auto_connect=True):
         self.port = port
         self.baudrate = baudrate
-        self.serial = None
-        self.connected = False
-        self.connect()
+        self.rx_buffer_size = rx_buffer_size
+        self.transfer_mode = transfer_mode if transfer_mode in TRANSFER_MODES else "ascii"
+        self.compression = compression
+        self.minify = minify # Minify the G-code before it is uploaded
+        self.engine = engine or SerialEngine()
+        self.on_line = on_line
+        self.connection = None
+        self.firmware = None
+        self.capabilities = {}
+        self.connect_time = None # Seconds the last successful connection took
+        self.connect_error = None # Why the last connection attempt failed
+        if auto_connect:
+            self.connect()
+
+    @property
+    def connected(self):
+        return self.connection is not None and not self.connection.closed
 
     def connect(self, raise_on_error=False):
+        error = self.engine.call(self.probe())
+        if error and raise_on_error:
+            raise ConnectionError(f"Failed to connect to port '{self.port}': {error}")
+
+    async def probe(self, deadline=None):
+        """Connect on the engine loop, gives up after deadline seconds (CONNECT_DEADLINE by default).
+        Returns None once connected, the error otherwise. Many printers are probed at once with asyncio.gather()."""
+        deadline = deadline or CONNECT_DEADLINE
+        self.disconnect()
+        start = time.monotonic()
         try:
-            self.serial = serial.Serial(self.port, self.baudrate, timeout=5)
-            print(f"Connected to {self.port} at {self.baudrate} baud.")
-            self.serial.write(b'M115\n') # Send a command to check the printer's firmware version
-            time.sleep(1) # allow time for the printer to respond
-            response = self.serial.readline().decode(errors="ignore").strip()
-            if response:
-                self.connected = True
-            else:
-                raise serial.SerialException("No response from printer.")
-        except serial.SerialException as e:
-            print(f"Error connecting to printer: {e}")
-            self.connected = False
-            if raise_on_error:
-                raise ConnectionError(f"Failed to connect to port '{self.port}': {e}")
+            self.connection = await asyncio.wait_for(self.open(), deadline)
+        except asyncio.TimeoutError:
+            error = serial.SerialException(f"No response within {deadline} seconds.")
+        except (serial.SerialException, OSError) as e:
+            error = e
+        else:
+            self.connect_time = time.monotonic() - start
+            self.connect_error = None
+            print(f"Connected to {self.port} at {self.baudrate} baud in {self.connect_time * 1000:.0f} ms.")
+            return None
+        self.connect_error = error
+        print(f"Error connecting to printer: {error}")
+        return error
 
-    def disconnect(self):
-        if self.serial and self.serial.is_open:
-            self.serial.close()
-            print(f"Disconnected from {self.port}.")
-        self.connected = False
+    async def open(self):
+        """Open the port on the engine loop and read the firmware report (M115)."""
+        connection = self.engine.open_connection(self.port, self.baudrate, self.handle_line)
+        try:
+            for _ in range(REPORT_ATTEMPTS):
+                try:
+                    response = await connection.send("M115", timeout=REPORT_TIMEOUT)
+                except serial.SerialException:
+                    break
+                if response is not None:
+                    self.parse_capabilities(response)
+                    return connection
+        except asyncio.CancelledError:
+            connection.close() # Deadline passed
+            raise
+        connection.close()
+        raise serial.SerialException("No response from printer.")
 
-    def send_gcode_command(self, gcode, print_response = False):
-        if self.serial and self.serial.is_open:
-            try:
-                self.serial.write((gcode + '\n').encode())
-                if print_response:
-                    print(f"Sent: {gcode}")
-                
-                response_lines = []
-                for _ in range(100_000_000):
-                    response = self.serial.readline().decode(errors="ignore").strip()
-                    if response == "ok":
-                        break
-                    if response:
-                        if print_response:
-                            print(f"Printer response: {response}")
-                        response_lines.append(response)
-                    else:
-                        break
+    def handle_line(self, line):
+        if self.on_line:
+            self.on_line(line)
 
-                return response_lines
-            
-            except serial.SerialException as e:
-                print(f"Serial communication error: {e}")
-                self.connected = False
+    def parse_capabilities(self, response):
+        """Read the firmware name and the "Cap:NAME:0/1" lines of a M115 report."""
+        for line in response:
+            if "FIRMWARE_NAME:" in line:
+                self.firmware = line
+            match = REGEX_CAPABILITY.match(line)
+            if match:
+                self.capabilities[match.group(1)] = match.group(2) == "1"
 
-            except Exception as e:
-                print(f"Error sending G-code: {e}")
-                
-            except OSError as e:
-                print(f"OS error: {e}")
-                self.connected = False
+    def disconnect(self):
+        if self.connected:
+            self.engine.invoke(self.connection.close)
+            print(f"Disconnected from {self.port}.")
 
-        else:
+    def send_gcode_command(self, gcode, print_response = False):
+        """Send a command and wait for its "ok", returns the response lines or None.
+        The PrinterManager sends through its command channel instead, not both at once."""
+        if not self.connected:
             print("Printer not connected or serial port not open.")
+            return None
+        try:
+            response_lines = self.engine.call(self.connection.send(gcode, timeout=COMMAND_TIMEOUT, print_response=print_response))
+            if response_lines is None:
+                print(f"No response to '{gcode}' from {self.port}.")
+            return response_lines
+        except serial.SerialException as e:
+            print(f"Serial communication error: {e}")
         return None
-    
-
@@ -1,139 +1,202 @@
 import os
-import json
-from collections import deque
+import asyncio
 import threading
 import time
-from serial.tools import list_ports
-import re
 
 import serial
 
-from .printer_commands import PrinterCommands
+from .printer_commands import PrinterCommands, RX_BUFFER_SIZE
+from .serial_engine import SerialEngine, CommandChannel, RequestInterrupted, PRIORITY_CONTROL, PRIORITY_JOB, PRIORITY_POLL
+from .binary_transfer import BinaryTransfer
+from .job_queue import MemoryJobQueue
+from .upload_pool import UploadPool, MAX_UPLOADS
+from .gcode_analyzer import analyze_cached, strip_comment
+from .gcode_compiler import CompiledGcode, add_checksum, NUMBERED, PLAIN
+from .printer_state import PrinterState
+from .config_store import ConfigStore
+from .port_registry import PortRegistry
+from .poll_policy import PollScheduler, poll_activity, UPLOADING, TEMPERATURE_COMMANDS
+from .status_parser import parse_status_line, TEMPERATURE, PRINT_TIME, TIME_REMAINING, SD_PROGRESS, NOT_SD_PRINTING
 
 CONFIG_FILE = "printers_config.json"
 DEBUG = True # Set to True for debugging, False for production
 
+POLL_TIMEOUT = 1 # Seconds to wait for the answer to a polling command
+NOT_RESPONDING_TIMEOUT = 30 # Seconds without a status line until a printer counts as disconnected, a few idle poll intervals
+UPLOAD_TIMEOUT = 30 # Seconds to wait for the "ok" of an uploaded line
+COMMAND_TIMEOUT = 120 # Seconds to wait for the "ok" of a command, homing and heating take a while
+UPLOAD_STATUSES = ("Waiting for upload slot", "Uploading to SD card")
+
 class PrinterManager:
     """Class to manage multiple 3D printers.
     This class handles printer connections, file uploads, and monitoring of printer status.
     It provides methods to connect, disconnect, and manage print jobs for multiple printers.
     It also includes methods to save and load printer configurations from a JSON file.
     """
-    def __init__(self):
-        self.lock = threading.Lock()
+    def __init__(self, job_queue=None, max_uploads=MAX_UPLOADS):
         self.printers = {}
-        self.queues = {}
-        self.printing_file = {}
-        self.printing_sd_filename = {}
+        self.job_queue = job_queue or MemoryJobQueue() # Print queues of all printers
+        self.uploads = UploadPool(max_uploads) # Uploads to different printers run in parallel up to max_uploads
+        self.states = {}
         self.line_number = 0
 
-        #sdupload time
-        self.sd_upload_time = {}
-        self.sd_upload_time_remaining = {}
-        self.monitorprinter_time_remaining_prusa = {}
-
-        #monitoring
-        self.monitorprinter_status = {}
-        self.monitorprinter_hotend_temp = {}
-        self.monitorprinter_bed_temp = {}
-        
-        #progress
-        self.monitorprinter_current_byte = {}
-        self.monitorprinter_total_byte = {}
-        self.monitorprinter_procent = {}
-        self.monitorprinter_procent_prusa = {}
-
-        #time
-        self.monitorprinter_time = {}        
-        self.monitorprinter_time_remaining = {}
-        self.monitorprinter_time_seconds = {}
-
-        
-        #bool
-        self.model_removed = {}
-        self.job_status_error = {}
+        #serial engine
+        self.engine = SerialEngine()
+        self.channels = {} # Command channel of every monitored printer, all commands go through it
+        self.monitor_tasks = {}
+        self.poll_schedulers = {} # What to poll and what the firmware auto reports, per monitored printer
 
         #threads
-        self.monitor_threads = {}
         self.print_threads = {}
-        self.monitor_events = {}
 
-        #monitor printer 
-        self.last_time_remaining_update = {}
-        self.last_time_connected_update = {}
-        
+        #state change listeners
+        self.listeners = []
 
+        self.config = ConfigStore(CONFIG_FILE) # Written in the background, see save_printer_config()
         self.load_printer_config()
+        self.connect_printers(list(self.printers))
         self.start_monitoring()
-        self.reconnect_printers()
 
-    def load_printer_config(self):
-        """Load printer configuration from a JSON file."""
-        if os.path.exists(CONFIG_FILE):
+        self.ports = PortRegistry(on_change=self.ports_changed) # Reconnects printers when their device is plugged in
+        self.ports.start()
+
+    def get_state(self, printer_name):
+        """Return the PrinterState of a printer, None for unknown printers."""
+        return self.states.get(printer_name)
+
+    def snapshot(self, printer_name):
+        """Return an immutable snapshot of the state of a printer, None for unknown printers."""
+        state = self.states.get(printer_name)
+        return state.snapshot() if state else None
+
+    def create_state(self, printer_name, **values):
+        """Create the PrinterState of a printer, its changes are announced to the listeners."""
+        def on_change(version, changes, snapshot):
+            self.notify(printer_name, version, changes, snapshot)
+        self.states[printer_name] = PrinterState(on_change=on_change, **values)
+        return self.states[printer_name]
+
+    def add_listener(self, callback):
+        """Call callback(printer_name, version, changes, snapshot) whenever the state of a printer changes.
+        changes holds only the changed fields, snapshot is None when the printer was removed.
+        The callback runs in the thread that changed the state (usually the serial engine) and must not block."""
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, printer_name, version, changes, snapshot):
+        for listener in list(self.listeners):
             try:
-                with open(CONFIG_FILE, "r") as file:
-                    config = json.load(file)
-                    if not isinstance(config, dict):
-                        raise ValueError("Invalid configuration format.")
-                    
-                    for printer_name, data in config.items():
-                        if isinstance(data, dict):
-                            self.printers[printer_name] = PrinterCommands(data.get("port", ""), data.get("baudrate", 115200))
-                            self.queues[printer_name] = deque(data.get("queue", []))
-                            self.monitorprinter_status[printer_name] = data.get("monitorprinter_status", "Unknown")
-                            self.monitorprinter_current_byte[printer_name] = data.get("current_byte", 0)
-                            self.monitorprinter_total_byte[printer_name] = data.get("total_byte", 0)
-                            self.sd_upload_time[printer_name] = data.get("sd_upload_time")
-                            self.sd_upload_time_remaining[printer_name] = data.get("sd_upload_time_remaining")
-                            self.monitorprinter_time_seconds[printer_name] = data.get("time_seconds", 0)
-                            self.model_removed[printer_name] = data.get("model_removed", False)
-                            self.printing_file[printer_name] = data.get("current_file")
-                            self.printing_sd_filename[printer_name] = data.get("current_sd_file")
-                            self.job_status_error[printer_name] = data.get("job_status_error")
-                        else:
-                            print(f"Warning: Invalid data format for {printer_name}, skipping.")
-                            
-            except (json.JSONDecodeError, FileNotFoundError) as e:
-                print(f"Error reading configuration file: {e}")
-            except ValueError as e:
-                print(f"Error loading configuration: {e}")
-
-    def save_printer_config(self):
-        """Save printer configuration to a JSON file."""
+                listener(printer_name, version, changes, snapshot)
+            except Exception as e:
+                print(f"Error in state listener for '{printer_name}': {e}")
+
+    def load_printer_config(self):
+        """Load printer configuration from a JSON file, from its backup if the file is damaged."""
+        config = self.config.load()
+        for printer_name, data in config.items():
+            if isinstance(data, dict):
+                self.printers[printer_name] = PrinterCommands(data.get("port", ""), data.get("baudrate", 115200),
+                                                              data.get("rx_buffer_size", RX_BUFFER_SIZE),
+                                                              data.get("transfer_mode", "ascii"),
+                                                              data.get("compression", False),
+                                                              data.get("minify", False),
+                                                              engine=self.engine, on_line=self.line_handler(printer_name),
+                                                              auto_connect=False) # All printers are connected at once
+                self.create_state(printer_name,
+                    status=data.get("monitorprinter_status", "Unknown"),
+                    current_byte=data.get("current_byte", 0),
+                    total_byte=data.get("total_byte", 0),
+                    sd_upload_time=self.config_number(data.get("sd_upload_time")),
+                    sd_upload_time_remaining=self.config_number(data.get("sd_upload_time_remaining")),
+                    print_time=data.get("time_seconds", 0),
+                    model_removed=data.get("model_removed", False),
+                    printing_file=data.get("current_file"),
+                    printing_sd_filename=data.get("current_sd_file"),
+                    job_status_error=bool(data.get("job_status_error")),
+                )
+                if data.get("current_file") and not data.get("model_removed", False):
+                    # Analyze the file of the unfinished job in the background
+                    threading.Thread(target=self.load_analysis, args=(printer_name, data["current_file"]),
+                                     daemon=True).start()
+            else:
+                print(f"Warning: Invalid data format for {printer_name}, skipping.")
+
+    def config_number(self, value):
+        """Numbers are stored as they are, older configurations stored formatted strings which are dropped."""
+        return value if isinstance(value, (int, float)) else None
+
+    def save_printer_config(self, flush=False):
+        """Save printer configuration to a JSON file.
+        The file is written in the background shortly after, with flush=True before returning."""
+        snapshots = {printer_name: state.snapshot() for printer_name, state in list(self.states.items())}
         config = {
             printer_name: {
                 "port": printer.port,
                 "baudrate": printer.baudrate,
-                "queue": list(self.queues.get(printer_name, [])),
-                "monitorprinter_status": self.monitorprinter_status.get(printer_name, "Unknown"),
-                "current_byte": self.monitorprinter_current_byte.get(printer_name, 0),
-                "total_byte": self.monitorprinter_total_byte.get(printer_name, 0),
-                "sd_upload_time": self.sd_upload_time.get(printer_name),
-                "sd_upload_time_remaining": self.sd_upload_time_remaining.get(printer_name),
-                "time_seconds": self.monitorprinter_time_seconds.get(printer_name, 0),
-                "model_removed": self.model_removed.get(printer_name, False),
-                "current_file": self.printing_file.get(printer_name),
-                "current_sd_file": self.printing_sd_filename.get(printer_name),
-                "job_status_error": self.job_status_error.get(printer_name),
+                "rx_buffer_size": printer.rx_buffer_size,
+                "transfer_mode": printer.transfer_mode,
+                "compression": printer.compression,
+                "minify": printer.minify,
+                "monitorprinter_status": snapshots[printer_name].status,
+                "current_byte": snapshots[printer_name].current_byte or 0,
+                "total_byte": snapshots[printer_name].total_byte or 0,
+                "sd_upload_time": snapshots[printer_name].sd_upload_time,
+                "sd_upload_time_remaining": snapshots[printer_name].sd_upload_time_remaining,
+                "time_seconds": snapshots[printer_name].print_time or 0,
+                "model_removed": snapshots[printer_name].model_removed,
+                "current_file": snapshots[printer_name].printing_file,
+                "current_sd_file": snapshots[printer_name].printing_sd_filename,
+                "job_status_error": snapshots[printer_name].job_status_error,
             }
-            for printer_name, printer in self.printers.items()
+            for printer_name, printer in list(self.printers.items())
+            if printer_name in snapshots
         }
-        with open(CONFIG_FILE, "w") as file:
-            json.dump(config, file, indent=4)
-        print("Configuration saved.")
+        self.config.update(config)
+        if flush:
+            self.config.flush()
  
-    def reconnect_printers(self):
-        """Reconnect to all printers that are marked as disconnected."""
-        for printer_name, printer in self.printers.items():
-            if self.monitorprinter_status.get(printer_name) == "Disconnected":
-                print(f"Reconnecting to printer {printer_name}...")
-                printer.connect()
-                if printer.connected:
-                    print(f"Successfully reconnected to {printer_name}.")
-                    self.last_time_connected_update[printer_name] = time.time()
-                    self.start_monitor_threads(printer_name)
-                else:
-                    print(f"Failed to reconnect to {printer_name}.")
+    def connect_printers(self, printer_names, deadline=None):
+        """Connect several printers at the same time, each one gets deadline seconds (CONNECT_DEADLINE by default).
+        Returns the seconds each printer took to connect, None for the ones that failed."""
+        async def probe_all():
+            printers = [self.printers[printer_name] for printer_name in printer_names]
+            await asyncio.gather(*(printer.probe(deadline) for printer in printers))
+            return {printer_name: printer.connect_time if printer.connected else None
+                    for printer_name, printer in zip(printer_names, printers)}
+
+        if not printer_names:
+            return {}
+        start = time.monotonic()
+        latencies = self.engine.call(probe_all())
+        for printer_name, latency in latencies.items():
+            if latency is None and printer_name in self.states:
+                self.states[printer_name].update(status="Disconnected") # Reconnected when its device is plugged in
+            print(f"  {printer_name}: " + (f"connected in {latency * 1000:.0f} ms" if latency is not None
+                                          else f"not connected, {self.printers[printer_name].connect_error}"))
+        connected = sum(latency is not None for latency in latencies.values())
+        print(f"Connected {connected} of {len(latencies)} printers in {time.monotonic() - start:.2f} s.")
+        return latencies
+
+    def reconnect_printers(self, printer_names=None):
+        """Reconnect to all printers that are marked as disconnected, or the disconnected ones of printer_names."""
+        printer_names = [printer_name for printer_name in (self.printers if printer_names is None else printer_names)
+                         if printer_name in self.states and self.states[printer_name].status == "Disconnected"]
+        for printer_name, latency in self.connect_printers(printer_names).items():
+            if latency is not None:
+                self.start_monitor_threads(printer_name)
+
+    def ports_changed(self, added, removed):
+        """Called by the port registry, reconnects the disconnected printers whose device was plugged in."""
+        plugged = {path for key, device in added for path in (key, device)}
+        printer_names = [printer_name for printer_name, printer in list(self.printers.items())
+                         if printer.port in plugged or os.path.realpath(printer.port) in plugged]
+        if printer_names:
+            print(f"Devices of {', '.join(printer_names)} plugged in.")
+            self.reconnect_printers(printer_names)
 
     def reconnect_printer(self, printer_name, raise_on_error=False):
         """Reconnect to a specific printer."""
@@ -141,14 +204,13 @@ class PrinterManager:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
             
-            if self.monitorprinter_status.get(printer_name) != "Disconnected":
+            if self.states[printer_name].status != "Disconnected":
                 raise ValueError(f"Printer '{printer_name}' is already connected.")
             
-            if self.monitorprinter_status.get(printer_name) == "Disconnected":
+            if self.states[printer_name].status == "Disconnected":
                 self.printers[printer_name].connect(raise_on_error=raise_on_error)
                 if self.printers[printer_name].connected:
                     print(f"Successfully reconnected to {printer_name}.")
-                    self.last_time_connected_update[printer_name] = time.time()
                     self.start_monitor_threads(printer_name)
                 else:    
                     print(f"Failed to reconnect to {printer_name}.")
@@ -161,69 +223,88 @@ class PrinterManager:
     def start_monitoring(self):
         """Start monitoring for all connected printers on program start."""
         for printer_name in self.printers:
-            self.last_time_connected_update[printer_name] = time.time()
             self.start_monitor_threads(printer_name)
             
 
     def start_monitor_threads(self, printer_name, polling=True):
-        """Start the monitoring threads for a printer."""
+        """Open the command channel of a printer and start monitoring it. The monitor runs as a coroutine
+        on the serial engine, the name is kept so callers don't need to change."""
         try:
-            # Check if a monitor thread is already running for this printer
-            thread = self.monitor_threads.get(printer_name)
-            if thread and thread.is_alive():
-                if DEBUG: print(f"Monitor thread for {printer_name} is already running.")
+            # Check if a monitor is already running for this printer
+            task = self.monitor_tasks.get(printer_name)
+            if task and not task.done():
+                if DEBUG: print(f"Monitor for {printer_name} is already running.")
                 return
             
-            if DEBUG: print(f"Starting monitoring threads for {printer_name}...")
-            self.monitor_events[printer_name] = threading.Event()
+            if DEBUG: print(f"Starting monitor for {printer_name}...")
 
             # Reset connection timer to prevent instant disconnect
-            self.last_time_connected_update[printer_name] = time.time()
+            self.states[printer_name].last_connected = time.time()
 
-            thread_monitoring = threading.Thread(target=self.monitor_printer, args=(printer_name, polling), daemon=True)
-            self.monitor_threads[printer_name] = thread_monitoring
-            thread_monitoring.start()
+            channel = self.engine.call(self.open_channel(printer_name))
+            self.monitor_tasks[printer_name] = self.engine.spawn(self.monitor_printer(printer_name, channel, polling))
             
-        except (threading.ThreadError, serial.SerialException, ValueError) as e:
-            print(f"Error starting monitoring threads for {printer_name}: {e}")
+        except (RuntimeError, ValueError, OSError, serial.SerialException) as e:
+            print(f"Error starting monitor for {printer_name}: {e}")
 
     def stop_monitor_threads(self, printer_name):
-        """Function to stop the monitoring thread for a printer."""
-        if printer_name in self.monitor_events:
-            self.monitor_events[printer_name].set()  # Signal threads to stop
-
-        thread = self.monitor_threads.get(printer_name)
-        if thread and thread.is_alive():
-            thread.join(timeout=5)  # Wait up to 5 seconds 
-            if DEBUG: print(f"[STOPPED] Monitor thread for {printer_name} stopped.")
-
-            # Ensure that no remaining commands are being sent
-            printer = self.printers.get(printer_name)
-            if printer and printer.serial and printer.serial.is_open:
-                try:
-                    printer.serial.reset_output_buffer()  # Clear pending writes
-                    printer.serial.reset_input_buffer()   # Clear pending reads
-                except serial.SerialException as e:
-                    print(f"Error flushing buffers: {e}")
+        """Stop the monitor of a printer and close its command channel."""
+        task = self.monitor_tasks.get(printer_name)
+        if task and not task.done():
+            self.engine.call(self.cancel_monitor(printer_name), timeout=5)  # Wait up to 5 seconds 
+            if DEBUG: print(f"[STOPPED] Monitor for {printer_name} stopped.")
+
+    async def cancel_monitor(self, printer_name):
+        """Cancel the monitor coroutine of a printer and wait until its port is closed."""
+        task = self.monitor_tasks.get(printer_name)
+        if task and not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+    async def open_channel(self, printer_name):
+        """Create the command channel of a printer on the engine loop. The connection is opened by
+        PrinterCommands, the channel is its only user until the monitor stops and closes it."""
+        printer = self.printers[printer_name]
+        if not printer.connected:
+            self.states[printer_name].update(status="Disconnected")
+            raise serial.SerialException(f"Printer '{printer_name}' is not connected.")
+        channel = CommandChannel(printer.connection)
+        self.channels[printer_name] = channel
+        return channel
+
+    def command(self, printer_name, *gcodes, priority=PRIORITY_JOB, preempt=False, print_response=False):
+        """Send G-code commands to a printer through its command channel, no other command runs in between.
+        Blocks until the last "ok" and returns the response lines of the last command,
+        None if the printer is not connected or doesn't answer."""
+        channel = self.channels.get(printer_name)
+        if not channel or channel.closed:
+            print(f"Printer '{printer_name}' is not connected.")
+            return None
+
+        async def send_all(connection):
+            response = None
+            for gcode in gcodes:
+                response = await connection.send(gcode, timeout=COMMAND_TIMEOUT, print_response=print_response)
+            return response
 
-            # Wait for printer to finish processing
-            time.sleep(10)  # Wait for 10 seconds
-        else:
-            print(f"No active monitor thread found for '{printer_name}'.")
+        try:
+            response = self.engine.call(channel.run(send_all, priority, preempt))
+            scheduler = self.poll_schedulers.get(printer_name)
+            if scheduler and any(gcode.split(" ", 1)[0].upper() in TEMPERATURE_COMMANDS for gcode in gcodes):
+                scheduler.refresh("M105") # Pick up the new targets, the poll rate depends on them
+            return response
+        except RequestInterrupted:
+            print(f"Commands {gcodes} to '{printer_name}' were interrupted.")
+            return None
+        except serial.SerialException as e:
+            print(f"Error sending {gcodes} to '{printer_name}': {e}")
+            return None
 
     def list_serial_ports(self):
-        """List all available serial ports."""
-        ports = list_ports.comports()
-        available_ports = []
-        for port in ports:
-            if port.description != "n/a":
-                available_ports.append((port.device, f"{port.device} - {port.description}"))
-                print(f"Device: {port.device}, Description: {port.description}, Hardware ID: {port.hwid}")
-        if not available_ports:
-            print("No serial devices found.")
-
+        """List all available serial ports as (port, label) for the form field, from the port registry."""
+        available_ports = [(key, f"{device} - {description}") for key, device, description in self.ports.list()]
         return available_ports if available_ports else [("", "No serial devices found")] # list of tuples for form field
-        
+
     def list_printer(self, printer_name):
         """List all connected printers and put their data in a dictionary. For website."""
         printer_data = {}
@@ -236,20 +317,7 @@ class PrinterManager:
             print(f"No printer connected with name '{printer_name}'.")
             return {}
 
-        printer_data = {
-        "status": self.monitorprinter_status.get(printer_name, "Unknown"),
-        "sd_upload_time": self.sd_upload_time.get(printer_name, "N/A"),
-        "sd_upload_time_remaining": self.sd_upload_time_remaining.get(printer_name, "N/A"),
-        "print_time": self.monitorprinter_time.get(printer_name, "N/A"),
-        "estimated_time_remaining": self.monitorprinter_time_remaining.get(printer_name, "N/A"),
-        "current_byte": self.monitorprinter_current_byte.get(printer_name, "N/A"),
-        "total_byte": self.monitorprinter_total_byte.get(printer_name, "N/A"),
-        "print_progress": self.monitorprinter_procent.get(printer_name, "N/A"),
-        "hotend_temp": self.monitorprinter_hotend_temp.get(printer_name, "N/A"),
-        "bed_temp": self.monitorprinter_bed_temp.get(printer_name, "N/A"),
-        }
-
-        return printer_data
+        return self.states[printer_name].snapshot().to_dict()
     
     def list_all_printers(self):
         """List all connected printers and their data. Print to console."""
@@ -258,48 +326,51 @@ class PrinterManager:
             return
 
         for printer_name, printer in self.printers.items():
+            state = self.states[printer_name].snapshot()
+            printer_data = state.to_dict()
             print(
             f"Printer: {printer_name}\n"
             f"  Port: {printer.port}\n"
             f"  Baudrate: {printer.baudrate}\n"
-            f"  Queue: {self.queues.get(printer_name, [])}\n"
-            f"  Status: {self.monitorprinter_status.get(printer_name, 'Unknown')}\n"
+            f"  Queue: {self.job_queue.items(printer_name)}\n"
+            f"  Status: {state.status}\n"
             "\n"
-            f"  SD upload time: {self.sd_upload_time.get(printer_name, 'N/A')}\n"
-            f"  SD upload time remaining: {self.sd_upload_time_remaining.get(printer_name, 'N/A')}\n"
+            f"  SD upload time: {printer_data['sd_upload_time']}\n"
+            f"  SD upload time remaining: {printer_data['sd_upload_time_remaining']}\n"
+            f"  SD upload speed: {printer_data['sd_upload_speed']}\n"
             "\n"
-            f"  Print time: {self.monitorprinter_time.get(printer_name, 'N/A')}\n"
-            f"  Time in seconds: {self.monitorprinter_time_seconds.get(printer_name, 'N/A')}\n"
-            f"  Estimated time remaining: {self.monitorprinter_time_remaining.get(printer_name, 'N/A')}\n"
+            f"  Print time: {printer_data['print_time']}\n"
+            f"  Time in seconds: {state.print_time}\n"
+            f"  Estimated time remaining: {printer_data['estimated_time_remaining']}\n"
             "\n"
-            f"  Current byte: {self.monitorprinter_current_byte.get(printer_name, 'N/A')}\n"
-            f"  Total byte: {self.monitorprinter_total_byte.get(printer_name, 'N/A')}\n"
-            f"  Print progress: {self.monitorprinter_procent.get(printer_name, 'N/A')}\n"
+            f"  Current byte: {printer_data['current_byte']}\n"
+            f"  Total byte: {printer_data['total_byte']}\n"
+            f"  Print progress: {printer_data['print_progress']}\n"
             "\n"
-            f"  Hotend temp: {self.monitorprinter_hotend_temp.get(printer_name, 0)}\n"
-            f"  Bed temp: {self.monitorprinter_bed_temp.get(printer_name, 0)}\n"
-            f"  Model removed: {self.model_removed.get(printer_name, False)}\n"
+            f"  Hotend temp: {state.hotend_temp or 0}\n"
+            f"  Bed temp: {state.bed_temp or 0}\n"
+            f"  Model removed: {state.model_removed}\n"
             "\n"
-            f"  Monitor threads: {self.monitor_threads.get(printer_name)}\n"
+            f"  Monitor: {self.monitor_tasks.get(printer_name)}\n"
             f"  Print threads: {self.print_threads.get(printer_name)}\n"
-            f"  Current file: {self.printing_file.get(printer_name)}\n"
-            f"  Current SD file: {self.printing_sd_filename.get(printer_name)}"
+            f"  Current file: {state.printing_file}\n"
+            f"  Current SD file: {state.printing_sd_filename}"
             "\n"
             )
  
     def list_sd_files(self, printer_name):
-        """List all files on the SD card of a printer. Used in upload_file()."""
-        sd_files = []
+        """List all files on the SD card of a printer."""
+        return self.parse_sd_files(self.command(printer_name, "M20", print_response=DEBUG))
 
-        printer = self.printers[printer_name]
-           
-        response = printer.send_gcode_command("M20")
-        if response:
-            sd_files = response[1:-1]
-        else:
-            sd_files = []
+    async def read_sd_files(self, connection):
+        """List all files on the SD card through the engine connection. Used in upload_file()."""
+        return self.parse_sd_files(await connection.send("M20", print_response=DEBUG))
 
-        return sd_files
+    def parse_sd_files(self, response):
+        """Strip the "Begin file list" and "End file list" lines from a M20 response."""
+        if response:
+            return response[1:-1]
+        return []
 
     def connect_printer(self, printer_name, port, baudrate=115200, raise_on_error=False):
         """Connect to a printer and add it to the list of connected printers."""
@@ -312,15 +383,11 @@ class PrinterManager:
                 if existing_printer.port == port:
                     raise ValueError(f"Port '{port}' is already connected to another printer.")
 
-            printer = PrinterCommands(port, baudrate)
+            printer = PrinterCommands(port, baudrate, engine=self.engine, on_line=self.line_handler(printer_name))
             if printer.connected:
                 self.printers[printer_name] = printer
+                self.create_state(printer_name, model_removed=True, job_status_error=False)
 
-                #set dictionary values
-                self.model_removed[printer_name] = True
-                self.job_status_error[printer_name] = False
-
-                self.queues[printer_name] = deque()
                 self.save_printer_config()
                 if DEBUG: print(f"Printer '{printer_name}' connected and configuration saved.")
                 self.start_monitor_threads(printer_name)
@@ -340,10 +407,13 @@ class PrinterManager:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
             
+            self.stop_monitor_threads(printer_name)
             self.printers[printer_name].disconnect()
             del self.printers[printer_name]
-            del self.queues[printer_name]
+            self.job_queue.remove_printer(printer_name)
+            del self.states[printer_name]
             self.save_printer_config()
+            self.notify(printer_name, None, None, None)
             print(f"Printer '{printer_name}' disconnected and removed from configuration.")
 
         except ValueError as e:
@@ -356,17 +426,14 @@ class PrinterManager:
         try:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
-            
-            self.stop_monitor_threads(printer_name)
-            printer = self.printers[printer_name]
-            printer.send_gcode_command(gcode, print_response=True)
-            self.start_monitor_threads(printer_name)
+
+            self.command(printer_name, gcode, print_response=True)
 
         except ValueError as e:
             print(f"Error sending G-code command: {e}")
     
-    def add_to_queue(self, printer_name, filename, raise_on_error=False):
-        """Add a file to the print queue for a printer."""
+    def add_to_queue(self, printer_name, filename, raise_on_error=False, owner=None):
+        """Add a file to the print queue for a printer. owner is the user the job belongs to."""
         try:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
@@ -374,9 +441,8 @@ class PrinterManager:
             if not os.path.exists(filename):
                 raise ValueError(f"File '{filename}' not found.")
             
-            self.queues[printer_name].append(filename)
+            self.job_queue.enqueue(printer_name, filename, owner)
             if DEBUG: print(f"Added '{filename}' to the queue for printer '{printer_name}'.")
-            self.save_printer_config()
             
         except ValueError as e:
             print(f"Error adding file to queue: {e}")
@@ -387,267 +453,251 @@ class PrinterManager:
         """Remove a file from the print queue for a printer.
         If the file is currently being printed, it cannot be removed."""
         try:
-            if printer_name not in self.queues:
+            if printer_name not in self.printers:
                 raise ValueError(f"No queue found for printer '{printer_name}'.")
 
-            if filename not in self.queues[printer_name]:
-                raise ValueError(f"File '{filename}' not found in queue for printer '{printer_name}'.")
-            
-            if self.printing_file.get(printer_name) == filename:
+            if self.states[printer_name].printing_file == filename:
                 raise ValueError(f"Cannot remove file '{filename}' while it is being printed.")
              
             # Remove last occurrence from the right
-            self.queues[printer_name].reverse()
-            self.queues[printer_name].remove(filename)
-            self.queues[printer_name].reverse()
+            if not self.job_queue.remove(printer_name, filename):
+                raise ValueError(f"File '{filename}' not found in queue for printer '{printer_name}'.")
             if DEBUG: print(f"Removed '{filename}' from the queue for printer '{printer_name}'.")
-            self.save_printer_config()
 
         except (KeyError, ValueError, IndexError) as e:
             print(f"Error removing file from queue: {e}")
             if raise_on_error:
                 raise
         finally:
-            self.start_monitor_threads(printer_name)
+            if printer_name in self.printers:
+                self.start_monitor_threads(printer_name)
+
+    def strip_comment(self, gcode):
+        """Strip whitespace and comments from a G-code line. Returns "" for empty and comment lines."""
+        return strip_comment(gcode)
 
     def add_checksum(self, gcode, line_number):
-        """Add checksum to G-code command. Used in upload_file()."""
-        # Ignore empty lines and full comment lines starting with ';'
-        gcode = gcode.strip()
-        if not gcode or gcode.startswith(';'):
-            return ""
-        
-        # Ignore comments after ';' in a command line
-        gcode = gcode.split(';')[0].strip()
-        if not gcode:
-            return ""
-        
-        line_str = f"N{line_number} {gcode}"
-        
-        # Calculate checksum 
-        checksum = 0
-        for char in line_str:
-            if char == '*':
-                break
-            checksum ^= ord(char)  
-        checksum &= 0xff  # Keep it within an 8-bit range
-        
-        return f"{line_str}*{checksum}"
+        """Add checksum to G-code command."""
+        return add_checksum(gcode, line_number)
 
     def upload_file(self, printer_name, filename):
         """Upload a file to the printer's SD card.
-        This function handles the file upload process, including checksum calculation and progress monitoring."""
-        self.stop_monitor_threads(printer_name)
-
+        The upload waits for a slot of the upload pool, then the lines are streamed through the command
+        channel of the printer, polling waits meanwhile. Uploads to other printers run at the same time."""
+        state = self.states[printer_name]
         try:
             if not os.path.exists(filename):
                 print(f"File '{filename}' not found.")
                 raise ValueError(f"File '{filename}' not found.")
-            
-            with self.lock:
-                printer = self.printers[printer_name]
-
-                number = 0
-                base_name = os.path.splitext(os.path.basename(filename))[0].replace(" ", "_")[:6]
-                base_name = base_name.ljust(6, '0')
-                sd_filename = f"{base_name.upper()}_{number}.GCO"
 
-                sd_files = self.list_sd_files(printer_name)
-                existing_numbers = set()
+            def waiting():
+                if DEBUG: print(f"Upload pool is full, '{printer_name}' waits for a slot.")
+                state.update(status="Waiting for upload slot")
 
+            with self.uploads.slot(printer_name, on_wait=waiting):
+                channel = self.channels.get(printer_name)
+                if not channel or channel.closed:
+                    raise ValueError(f"Printer '{printer_name}' is not connected.")
 
-                if sd_files:
-                    for name in sd_files:
-                        split_name = name.split(' ')[0]
-                        if split_name.startswith(base_name.upper()):
-                            try:
-                                existing_number = int(split_name[len(base_name) + 1:-4])
-                                existing_numbers.add(existing_number)
-                            except ValueError:
-                                pass
-                
-                    for number in range(10):
-                        if number not in existing_numbers:
-                            sd_filename = f"{base_name.upper()}_{number}.GCO"
-                            break
-                    
-                    for name in sd_files:
-                        if name.split(' ')[0] == sd_filename:
-                            raise ValueError(f"Too many files with the same base name '{base_name}'.")
-
-                #measuring estimated sd trasfer time
-                file_size_bytes = os.path.getsize(filename)
-                baud_rate = printer.baudrate
-                efficiency_factor = 0.35  # Adjust based on testing
-                estimated_time = round((file_size_bytes * 8) / baud_rate) / efficiency_factor # in seconds
-
-                line_number = 1
-                self.monitorprinter_status[printer_name] = "Uploading to SD card"
-                printer.send_gcode_command(f"M110 N0 {sd_filename}", print_response = DEBUG) # Set line number
-                time.sleep(2) # Wait for printer to process the command - not waiting will sometimes break uploading. Potentially not needed.
-                response = printer.send_gcode_command(f"M28 {sd_filename}", print_response = DEBUG) # Start writing to SD card
-                if response and any("open failed" in line for line in response): # Check for file name error
-                    self.start_monitor_threads(printer_name)
-                    raise ValueError(f"Error during file upload.")
-                
-                time.sleep(2) # Wait for printer to process the command - just to be sure.
-                
-                start_time = time.time()
-
-                with open(filename, "r") as file:
-                    for line in file:
-                        command = self.add_checksum(line.strip(), line_number)
-                        if command:
-                            response = printer.send_gcode_command(command, print_response=DEBUG)
-                            line_number += 1
-                            
-                            elapsed_time = time.time() - start_time # Calculate elapsed time in seconds
-                            if elapsed_time > 60:
-                                self.sd_upload_time[printer_name] = f"{int(elapsed_time // 60)}m {int(elapsed_time % 60)}s"
-                            else:
-                                self.sd_upload_time[printer_name] = f"{int(elapsed_time)}s"
-
-                            remaining_time = estimated_time - elapsed_time # Calculate remaining time in seconds
-                            if remaining_time > 60:
-                                self.sd_upload_time_remaining[printer_name] = f"{int(remaining_time // 60)}m {int(remaining_time % 60)}s"
-                            elif remaining_time > 0:
-                                self.sd_upload_time_remaining[printer_name] = f"{int(remaining_time)}s"
-                            else:
-                                self.sd_upload_time_remaining[printer_name] = "0s"
-
-                            self.monitorprinter_status[printer_name] = f"Uploading to SD card"
-                            if response and any("Error" in line for line in response):
-                                self.start_monitor_threads(printer_name)
-                                raise ValueError(f"Error during file upload.")
-                        
-                
-                printer.send_gcode_command(f"M29 {sd_filename}", print_response=True) # Finish writing to SD card
-                self.sd_upload_time_remaining[printer_name] = "0s"
-
+                # Compiled once per file content outside the serial engine, retries and reprints reuse it
+                printer = self.printers[printer_name]
+                binary = printer.transfer_mode == "binary" and printer.capabilities.get("BINARY_FILE_TRANSFER")
+                if printer.transfer_mode == "binary" and not binary:
+                    print(f"Printer '{printer_name}' does not support binary file transfer, using ASCII upload.")
+                compiled = CompiledGcode.open(filename, PLAIN if binary else NUMBERED, printer.minify)
+                if printer.minify:
+                    print(f"Minified '{filename}' for '{printer_name}': {compiled.saved_bytes} bytes saved.")
 
-                # Stop timing once SD upload is completed
-                end_time = time.time()
-                actual_time = end_time - start_time
-                self.sd_upload_time[printer_name] = f"{round(actual_time // 60)}m {round(actual_time % 60)}s"
-                self.sd_upload_time_remaining[printer_name] = "0s"
-                
-                self.printing_sd_filename[printer_name] = sd_filename
-                self.printing_file[printer_name] = filename
-                self.save_printer_config()
+                try:
+                    self.engine.call(channel.run(
+                        lambda connection: self.stream_file(printer_name, connection, filename, compiled, binary)))
+                finally:
+                    compiled.close()
 
-        except ValueError as e:
+        except (ValueError, OSError, serial.SerialException) as e:
             print(f"Error uploading file to printer '{printer_name}': {e}")
-            self.job_status_error[printer_name] = True
+            state.update(job_status_error=True)
+        except RequestInterrupted:
+            print(f"Upload to printer '{printer_name}' was cancelled.")
+            state.update(job_status_error=True)
         finally: 
-            self.start_monitor_threads(printer_name)
+            if state.status == "Waiting for upload slot":
+                state.update(status="Unknown") # Set by the next poll
 
-    def cancel_print(self, printer_name):
-        """Cancel the current print job and return the printer to a safe state.
-        This function stops the print job, turns off the hotend and bed, and moves the print head to a safe position.
-        Used when printing is cancelled or interrupted."""
+    async def stream_file(self, printer_name, connection, filename, compiled, binary=False):
+        """Stream a compiled file to the SD card. Runs as a coroutine on the serial engine.
+        This function handles the file upload process, including the SD file name and progress monitoring."""
+        printer = self.printers[printer_name]
 
-        self.stop_monitor_threads(printer_name)
+        # Let polling commands which timed out but are still on the way finish first
+        await connection.wait_idle()
 
-        printer = self.printers[printer_name]
+        # Stop the auto reports, they would compete with the upload for the serial line
+        scheduler = self.poll_schedulers.get(printer_name)
+        if scheduler:
+            await self.poll(connection, scheduler.due(UPLOADING))
 
-        self.job_status_error[printer_name] = True
-        self.save_printer_config()
+        number = 0
+        base_name = os.path.splitext(os.path.basename(filename))[0].replace(" ", "_")[:6]
+        base_name = base_name.ljust(6, '0')
+        sd_filename = f"{base_name.upper()}_{number}.GCO"
+
+        sd_files = await self.read_sd_files(connection)
+        existing_numbers = set()
 
-        if self.monitorprinter_status.get(printer_name) == "SD printing":
+
+        if sd_files:
+            for name in sd_files:
+                split_name = name.split(' ')[0]
+                if split_name.startswith(base_name.upper()):
+                    try:
+                        existing_number = int(split_name[len(base_name) + 1:-4])
+                        existing_numbers.add(existing_number)
+                    except ValueError:
+                        pass
+        
+            for number in range(10):
+                if number not in existing_numbers:
+                    sd_filename = f"{base_name.upper()}_{number}.GCO"
+                    break
             
-            printer.send_gcode_command("M108", print_response=True)  # Break out of wait-for-user during heating
+            for name in sd_files:
+                if name.split(' ')[0] == sd_filename:
+                    raise ValueError(f"Too many files with the same base name '{base_name}'.")
 
-            printer.send_gcode_command("M524", print_response=True)  # Abort SD print (if supported)
+        state = self.states[printer_name]
+        state.update(status="Uploading to SD card", sd_upload_time=0, sd_upload_time_remaining=None, sd_upload_speed=None)
+        start_time = time.time()
 
-            # Attempt Prusa-style cancel for serial prints
-            printer.send_gcode_command("M603", print_response=True)
+        def update_progress(bytes_done, total_bytes):
+            self.update_upload_progress(printer_name, start_time, bytes_done, total_bytes)
 
-            
+        if binary:
+            total_bytes = await self.upload_binary(printer, connection, compiled, sd_filename, update_progress)
+        else:
+            total_bytes = await self.upload_ascii(printer, connection, compiled, sd_filename, update_progress)
 
-        # If printing from SD, stop writing to SD
-        printer.send_gcode_command(f"M29", print_response=True) # Stop writing to SD
-
-        # Stop the print job
-        printer.send_gcode_command(f"M104 S0", print_response=True) # Turn off hotend
-        printer.send_gcode_command(f"M140 S0", print_response=True) # Turn off bed
-        printer.send_gcode_command(f"M107", print_response=True) # Turn off fan
-        printer.send_gcode_command(f"G91", print_response=True) # Set relative positioning
-        printer.send_gcode_command(f"G1 Z10 F300", print_response=True) # Move Z up 10mm
-        printer.send_gcode_command(f"G90", print_response=True) # Set absolute positioning
-        printer.send_gcode_command(f"G28 X Y", print_response=True) # Home X and Y
-        printer.send_gcode_command(f"M84", print_response=True) # Disable motors
+        # Stop timing once SD upload is completed
+        end_time = time.time()
+        actual_time = end_time - start_time
+        if DEBUG: print(f"Uploaded {total_bytes} bytes to '{printer_name}' at {total_bytes / max(actual_time, 0.001) / 1000:.1f} kB/s.")
         
+        state.update(sd_upload_time=actual_time, sd_upload_time_remaining=0,
+                     printing_sd_filename=sd_filename, printing_file=filename)
+        self.save_printer_config()
+
+    async def upload_ascii(self, printer, connection, commands, sd_filename, on_progress):
+        """Write the file to the SD card with M28/M29, commands is the CompiledGcode with every line
+        numbered and checksummed. Returns the number of bytes sent."""
+        total_bytes = commands.size
 
-        self.start_monitor_threads(printer_name)
+        # Every command waits for its "ok", the printer is ready for the next one when it arrives
+        await connection.send(f"M110 N0 {sd_filename}", timeout=UPLOAD_TIMEOUT, print_response = DEBUG) # Set line number
+        response = await connection.send(f"M28 {sd_filename}", timeout=UPLOAD_TIMEOUT, print_response = DEBUG) # Start writing to SD card
+        if response is None or any("open failed" in line for line in response): # Check for file name error
+            raise ValueError(f"Error during file upload.")
+
+        await connection.stream(commands, printer.rx_buffer_size, timeout=UPLOAD_TIMEOUT, print_response=DEBUG,
+                                on_progress=lambda lines_done, bytes_done: on_progress(bytes_done, total_bytes))
+        
+        await connection.send(f"M29 {sd_filename}", print_response=True) # Finish writing to SD card
+        return total_bytes
+
+    async def upload_binary(self, printer, connection, compiled, sd_filename, on_progress):
+        """Write the file to the SD card with the Marlin binary file transfer protocol.
+        compiled is the CompiledGcode without comments, optionally the data is heatshrink compressed.
+        Returns the number of bytes sent."""
+        transfer = BinaryTransfer(connection, print_response=DEBUG)
+        sent = 0
+
+        def update_progress(bytes_done, total_bytes):
+            nonlocal sent
+            sent = bytes_done
+            on_progress(bytes_done, total_bytes)
+
+        await transfer.upload(sd_filename, compiled.data, compress=printer.compression, on_progress=update_progress)
+        return sent
+
+    def update_upload_progress(self, printer_name, start_time, bytes_done, total_bytes):
+        """Update the SD upload time, speed and remaining time from the measured transfer rate."""
+        elapsed_time = time.time() - start_time # Calculate elapsed time in seconds
+        speed = bytes_done / elapsed_time if elapsed_time > 0 else 0
+        remaining_time = (total_bytes - bytes_done) / speed if speed > 0 else None
+        self.states[printer_name].update(sd_upload_time=elapsed_time, sd_upload_speed=speed,
+                                         sd_upload_time_remaining=max(remaining_time, 0) if remaining_time is not None else None)
+
+    def cancel_print(self, printer_name):
+        """Cancel the current print job and return the printer to a safe state.
+        This function stops the print job, turns off the hotend and bed, and moves the print head to a safe position.
+        Used when printing is cancelled or interrupted. A running upload is aborted, the commands
+        run before anything else waiting for the printer."""
+        state = self.states[printer_name]
+
+        state.update(job_status_error=True)
+        self.save_printer_config()
+
+        commands = []
+        if state.status == "SD printing":
+            commands += ["M108", # Break out of wait-for-user during heating
+                         "M524", # Abort SD print (if supported)
+                         "M603"] # Attempt Prusa-style cancel for serial prints
+
+        commands += ["M29", # If writing to SD, stop writing to SD
+                     "M104 S0", # Turn off hotend
+                     "M140 S0", # Turn off bed
+                     "M107", # Turn off fan
+                     "G91", # Set relative positioning
+                     "G1 Z10 F300", # Move Z up 10mm
+                     "G90", # Set absolute positioning
+                     "G28 X Y", # Home X and Y
+                     "M84"] # Disable motors
+        self.command(printer_name, *commands, priority=PRIORITY_CONTROL, preempt=True, print_response=True)
 
     def remove_model(self, printer_name, raise_on_error=False):
         """Remove the current model from the printer's SD card and start the next print job in the queue."""
-        self.stop_monitor_threads(printer_name)
         try:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
             
+            state = self.states[printer_name]
             if ((printer_name in self.print_threads and self.print_threads[printer_name].is_alive()) 
-                or (self.monitorprinter_status.get(printer_name) == "SD printing")):
+                or (state.status == "SD printing")):
                 raise ValueError(f"Cannot remove model during printing.")
             
-            if self.model_removed.get(printer_name) and not self.job_status_error.get(printer_name):
+            if state.model_removed and not state.job_status_error:
                 raise ValueError(f"No model to remove from printer '{printer_name}'.")
             
-            if not self.job_status_error.get(printer_name):
-                sd_filename = self.printing_sd_filename.get(printer_name)
+            if not state.job_status_error:
+                sd_filename = state.printing_sd_filename
 
                 if not sd_filename:
                     raise ValueError(f"No SD file found for printer '{printer_name}'.")
 
                 self.delete_file_from_sd(printer_name, sd_filename)
 
-            self.job_status_error[printer_name] = False
-            self.monitorprinter_current_byte[printer_name] = 0
-            self.monitorprinter_total_byte[printer_name] = 0
-            self.monitorprinter_time[printer_name] = 0
-            self.monitorprinter_time_remaining[printer_name] = 0
-            self.monitorprinter_procent[printer_name] = 0
-            self.sd_upload_time[printer_name] = 0
-            self.printing_file[printer_name] = None
-            self.printing_sd_filename[printer_name] = None
-            self.model_removed[printer_name] = True
+            state.update(job_status_error=False, current_byte=0, total_byte=0,
+                         print_time=None, time_remaining=None, progress=None, completed=False,
+                         progress_prusa=None, time_remaining_prusa=None, sd_upload_time=None,
+                         printing_file=None, printing_sd_filename=None, model_removed=True, analysis=None)
             self.save_printer_config()
 
-            if self.queues[printer_name]:
+            if self.job_queue.length(printer_name):
                 self.print_next_in_queue(printer_name, raise_on_error)
-                return # Prevent from starting monitoring threads again.
 
         except (ValueError, IndexError) as e:
             print(f"Error removing model from printer '{printer_name}': {e}")
             if raise_on_error:
                 raise
-        
-        self.start_monitor_threads(printer_name)
 
     def delete_file_from_sd(self, printer_name, sd_filename):
         """Delete a file from the printer's SD card. Used in remove_model()."""
-        self.stop_monitor_threads(printer_name)
-        
-        printer = self.printers[printer_name]
-        
-        printer.send_gcode_command(f"M30 {sd_filename}", print_response=True)        
-
-        self.start_monitor_threads(printer_name)
+        self.command(printer_name, f"M30 {sd_filename}", print_response=True)
 
     def print_file_from_sd(self, printer_name, sd_filename):
         """Start printing a file from the printer's SD card."""
-        self.stop_monitor_threads(printer_name)
-
-        self.model_removed[printer_name] = False
+        self.states[printer_name].update(model_removed=False, status="SD printing")
 
-        self.monitorprinter_status[printer_name] = "SD printing"
-
-        printer = self.printers[printer_name]
-        
-        printer.send_gcode_command(f"M32 {sd_filename}")
-
-        self.start_monitor_threads(printer_name)
+        self.command(printer_name, f"M32 {sd_filename}", print_response=DEBUG)
 
     def print_next_in_queue(self, printer_name, raise_on_error=False):
         """Start the next print job in the queue for a printer.
@@ -656,18 +706,19 @@ class PrinterManager:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
             
-            if not self.model_removed.get(printer_name, False):
+            state = self.states[printer_name]
+            if not state.model_removed:
                 raise ValueError(f"Please remove model from printer '{printer_name}' before printing.")
             
-            self.model_removed[printer_name] = False
+            state.update(model_removed=False)
             
             if ((printer_name in self.print_threads and self.print_threads[printer_name].is_alive()) 
-                or (self.monitorprinter_status.get(printer_name) == "SD printing")):
+                or (state.status == "SD printing")):
                 raise ValueError(f"Printer '{printer_name}' is already printing.")
         
-            self.model_removed[printer_name] = False
-            filename = self.queues[printer_name].popleft()
-            self.save_printer_config()
+            filename = self.job_queue.dequeue(printer_name)
+            if filename is None:
+                raise IndexError(f"Queue for printer '{printer_name}' is empty.")
 
             thread = threading.Thread(target=self.print_job, args=(printer_name, filename), daemon=True)
             self.print_threads[printer_name] = thread
@@ -683,10 +734,12 @@ class PrinterManager:
         """Handle a print job by uploading to SD, printing from SD"""
         try:
             if DEBUG: print(f"Starting print job for '{printer_name}' with file '{filename}'")
-            self.model_removed[printer_name] = False
+            state = self.states[printer_name]
+            state.update(model_removed=False)
+            self.load_analysis(printer_name, filename)
             self.upload_file(printer_name, filename)
 
-            sd_filename = self.printing_sd_filename.get(printer_name)
+            sd_filename = state.printing_sd_filename
 
             if not sd_filename:
                 raise ValueError(f"Failed to upload '{filename}' to printer '{printer_name}'.")
@@ -695,217 +748,217 @@ class PrinterManager:
 
         except Exception as e:
             print(f"Error during print job on '{printer_name}': {e}")
-            self.job_status_error[printer_name] = True
+            self.states[printer_name].update(job_status_error=True)
             self.cancel_print(printer_name)
 
-    def print_gcode(self, printer_name, filename, raise_on_error=False):
+    def load_analysis(self, printer_name, filename):
+        """Analyze the G-code file for the progress and remaining time. The result is cached,
+        files analyzed when the job was queued are not simulated again."""
+        try:
+            analysis = analyze_cached(filename)
+        except (OSError, ValueError) as e:
+            print(f"Error analyzing '{filename}': {e}")
+            analysis = None
+        state = self.states.get(printer_name)
+        if state:
+            state.update(analysis=analysis)
+
+    def print_gcode(self, printer_name, filename, raise_on_error=False, owner=None):
         """Add a file to the print queue and start printing."""
         try:
             if printer_name not in self.printers:
                 raise ValueError(f"No printer connected with name '{printer_name}'.")
             
-            self.add_to_queue(printer_name, filename)
+            self.add_to_queue(printer_name, filename, owner=owner)
             
             self.print_next_in_queue(printer_name, raise_on_error)
 
         except (ValueError, IndexError) as e:
             print(f"Error adding file to queue and starting print job: {e}")
-            self.job_status_error[printer_name] = True
+            if printer_name in self.states:
+                self.states[printer_name].update(job_status_error=True)
             if raise_on_error:
                 raise
 
+    def line_handler(self, printer_name):
+        """The callback of a printer's connection for the lines that aren't a command's response."""
+        return lambda line: self.read_serial(printer_name, line)
+
     def read_serial(self, printer_name, line):
         """Process incoming data from the printer and update its status.
-        This method is invoked by monitor_printer() to handle serial input."""
-        regex_temp = r"(?:ok\s+)?T:([\d\.]+)\s*/[\d\.]+\s+B:([\d\.]+)\s*/[\d\.]+" # Hotend and bed temp
-        match_temp = re.match(regex_temp, line)
-        
-        regex_temp_2 = r"T:([\d\.]+).*?B:([\d\.]+)" #prusa temp
-        match_temp_2 = re.match(regex_temp_2, line)
-
-        regex_time = r"echo:Print time:\s*(?:(\d+)h\s*)?(?:(\d+)m\s*)?(?:(\d+)s)?" # Print time
-        match_time = re.match(regex_time, line)
-
-        regex_time_2 = r"echo:\s*(?:(\d+)\s*hour[s]?,?\s*)?(?:(\d+)\s*min[s]?,?\s*)?(?:(\d+)\s*sec[s]?)" # Print time second option
-        match_time_2 = re.match(regex_time_2, line)
-
-        regex_time_remaining = r"NORMAL MODE: Percent done: (\d+); print time remaining in mins: (-?\d+)"
-        match_time_remaining = re.match(regex_time_remaining, line)
-
-        regex_status = r"SD printing byte (\d+)/(\d+)" # Print status
-        match_status = re.match(regex_status, line)
-
-        regex_status_2 = r"Not SD printing" # Print status
-        match_status_2 = re.match(regex_status_2, line)
-
-        with self.lock:
-            if match_time or match_time_2:
-                # Default values
-                hours = 0
-                minutes = 0
-                seconds = 0
-
-                if match_time:
-                    if match_time.group(1):
-                        hours = int(match_time.group(1))
-                    if match_time.group(2):
-                        minutes = int(match_time.group(2))
-                    if match_time.group(3):
-                        seconds = int(match_time.group(3))
-
-                if match_time_2:
-                    if match_time_2.group(1):
-                        hours = int(match_time_2.group(1))
-                    if match_time_2.group(2):
-                        minutes = int(match_time_2.group(2))
-                    if match_time_2.group(3):
-                        seconds = int(match_time_2.group(3))
-
-                if self.monitorprinter_status.get(printer_name) == "SD printing":
-                    if hours > 0:
-                        self.monitorprinter_time[printer_name] = f"{hours}h {minutes}m {seconds}s"
-                    elif minutes > 0:
-                        self.monitorprinter_time[printer_name] = f"{minutes}m {seconds}s"
-                    elif seconds >= 0:
-                        self.monitorprinter_time[printer_name] = f"{seconds}s"
-
-                    self.monitorprinter_time_seconds[printer_name] = hours*60*60 + minutes*60 + seconds
-
-            if match_time_remaining:
-                if match_time_remaining.group(1):
-                    self.monitorprinter_procent_prusa[printer_name] = int(match_time_remaining.group(1).strip())
-                if match_time_remaining.group(2):
-                    self.monitorprinter_time_remaining_prusa[printer_name] = int(match_time_remaining.group(2))
-
-            if match_temp:
-                self.monitorprinter_hotend_temp[printer_name] = match_temp.group(1).strip()
-                self.monitorprinter_bed_temp[printer_name] = match_temp.group(2).strip()
-            
-            if match_temp_2:
-                self.monitorprinter_hotend_temp[printer_name] = match_temp_2.group(1).strip()
-                self.monitorprinter_bed_temp[printer_name] = match_temp_2.group(2).strip()
-            
-            if match_status:
-                self.monitorprinter_current_byte[printer_name] = int(match_status.group(1))
-                self.monitorprinter_total_byte[printer_name] = int(match_status.group(2))
-                self.monitorprinter_status[printer_name] = "SD printing"
+        This method is invoked by the serial engine for every received line. Only the fields
+        that changed are written, the progress is recomputed only when a line can affect it."""
+        parsed = parse_status_line(line)
+        if parsed is None:
+            return
+        kind, values = parsed
+
+        state = self.states.get(printer_name)
+        if not state:
+            return
 
-            if match_status_2:
-                self.monitorprinter_status[printer_name] = "Not SD printing"
-                self.last_time_connected_update[printer_name] = time.time()
+        with state.lock:
+            self.apply_status(state, kind, values)
+        state.publish()
+
+    def apply_status(self, state, kind, values):
+        """Write a parsed status line into the state. Called with state.lock held."""
+        state.last_connected = time.time()
+        if kind == TEMPERATURE:
+            hotend_temp, bed_temp = float(values[0]), float(values[1])
+            if state.hotend_temp != hotend_temp:
+                state.hotend_temp = hotend_temp
+            if state.bed_temp != bed_temp:
+                state.bed_temp = bed_temp
+            if values[2] is not None:
+                state.hotend_target = float(values[2])
+            if values[3] is not None:
+                state.bed_target = float(values[3])
+            return # Temperatures don't affect the progress
+
+        if kind == PRINT_TIME:
+            if state.status != "SD printing":
+                return
+            hours, minutes, seconds = values
+            time_seconds = hours*60*60 + minutes*60 + seconds
+            if state.print_time == time_seconds:
+                return
+            state.print_time = time_seconds
 
-            self.get_print_progress(printer_name)
+        elif kind == TIME_REMAINING:
+            percent, minutes_remaining = values
+            if state.progress_prusa == percent and state.time_remaining_prusa == minutes_remaining:
+                return
+            state.progress_prusa = percent
+            state.time_remaining_prusa = minutes_remaining
 
-    def monitor_printer(self, printer_name, polling):
-        """Periodically check the printer status and read incoming data.
-        This function runs in a separate thread for each printer."""
+        elif kind == SD_PROGRESS:
+            current_byte, total_byte = values
+            if (state.current_byte == current_byte and state.total_byte == total_byte
+                    and state.status == "SD printing"):
+                return
+            state.current_byte = current_byte
+            state.total_byte = total_byte
+            state.status = "SD printing"
+
+        elif kind == NOT_SD_PRINTING:
+            if state.status in ("Not SD printing", "Waiting for upload slot"):
+                return
+            state.status = "Not SD printing"
+
+        self.get_print_progress(state)
+
+    async def monitor_printer(self, printer_name, channel, polling):
+        """Periodically poll the printer status. Runs as a coroutine on the serial engine,
+        incoming lines are passed to read_serial() by the engine as soon as they arrive.
+        The polls go through the command channel with the lowest priority, they wait while
+        other commands or an upload use the printer. The channel is closed when the monitor stops."""
+        state = self.states.get(printer_name)
         try:
             printer = self.printers.get(printer_name)
-            if not printer:
-                raise ValueError(f"Printer '{printer_name}' not found.")
-            
-            if printer_name not in self.printers:
+            if not printer or not state:
                 raise ValueError(f"Printer '{printer_name}' not found.")
 
-            with serial.Serial(printer.port, printer.baudrate, timeout=5) as ser:
-                while printer_name in self.printers and not self.monitor_events[printer_name].is_set():
-                    
-                    if not printer.connected:
-                        self.monitorprinter_status[printer_name] = "Disconnected"
-                        self.monitorprinter_bed_temp[printer_name] = 0
-                        self.monitorprinter_hotend_temp[printer_name] = 0
-                        raise ValueError(f"Printer '{printer_name}' is disconnected.")
-                    
-                    # Process all incoming data before attempting to send anything
-                    while ser.in_waiting:
-                        line = ser.readline().decode("ascii", errors="ignore").strip()
-                        self.read_serial(printer_name, line)
-                        time.sleep(0.5)
-
-
-                    if ser.in_waiting == 0 and polling:
-                        try:
-                            ser.write(b"M27\n")  # Request print status
-                            time.sleep(1)
-
-                            ser.write(b"M105\n")  # Request temperatures
-                            time.sleep(1)
-
-                            ser.write(b"M31\n")  # Request print time
-                            time.sleep(1)
-
-                        except serial.SerialException as e:
-                            self.monitorprinter_status[printer_name] = "Disconnected"
-                    
-                    # Check if the printer is still connected
-                    if polling:
-                        last_connected = self.last_time_connected_update.get(printer_name, 0)
-                        status = self.monitorprinter_status.get(printer_name, "")
-                        if time.time() - last_connected > 10 and status not in ["SD printing", "Uploading to SD card", "Disconnected"]:
-                            print(f"[TIMEOUT] Printer '{printer_name}' not responding for 10s — disconnecting.")
-                            self.monitorprinter_status[printer_name] = "Disconnected"
-                            printer = self.printers.get(printer_name)
-                            if printer:
-                                printer.connected = False
-                                printer.disconnect()
-                            return  # Exit monitor thread
-                    time.sleep(1)
+            scheduler = PollScheduler(printer.capabilities)
+            self.poll_schedulers[printer_name] = scheduler
+
+            while printer_name in self.printers:
+                
+                if not printer.connected:
+                    state.update(status="Disconnected", bed_temp=0.0, hotend_temp=0.0)
+                    raise ValueError(f"Printer '{printer_name}' is disconnected.")
+
+                activity = poll_activity(state, printer_name in self.uploads.active)
+                commands = scheduler.due(activity) if polling else None
+                if commands:
+                    try:
+                        await channel.run(lambda connection: self.poll(connection, commands), PRIORITY_POLL)
+                    except RequestInterrupted:
+                        pass # More urgent commands went first
+                
+                # Check if the printer is still connected
+                if polling:
+                    if (time.time() - state.last_connected > NOT_RESPONDING_TIMEOUT
+                            and state.status not in ("SD printing", "Disconnected") + UPLOAD_STATUSES):
+                        print(f"[TIMEOUT] Printer '{printer_name}' not responding for {NOT_RESPONDING_TIMEOUT}s — disconnecting.")
+                        state.update(status="Disconnected")
+                        printer = self.printers.get(printer_name)
+                        if printer:
+                            printer.disconnect()
+                        return  # Exit monitor
+                await asyncio.sleep(scheduler.wait(activity))
 
         except serial.SerialException as e:
             print(f"Serial connection error: {e}")
-            self.monitorprinter_status[printer_name] = "Disconnected"
+            state.update(status="Disconnected")
         
         except OSError as e:
             print(f"OS error for '{printer_name}': {e}")
-            self.monitorprinter_status[printer_name] = "Disconnected"
+            state.update(status="Disconnected")
 
         except ValueError as e:
             print(f"Error monitoring printer '{printer_name}': {e}")
 
-    def get_print_progress(self, printer_name):
+        finally:
+            channel.close()
+            if self.channels.get(printer_name) is channel:
+                del self.channels[printer_name]
+                self.poll_schedulers.pop(printer_name, None)
+
+    async def poll(self, connection, commands):
+        """Ask for the status, the answers are handled by read_serial()."""
+        for command in commands:
+            await connection.send(command, timeout=POLL_TIMEOUT)
+
+    def get_print_progress(self, state):
         """Calculate the print progress and estimated time remaining.
-        Its not very accurate, but it gives a rough estimate."""
-        current_byte = self.monitorprinter_current_byte.get(printer_name)
-        total_byte = self.monitorprinter_total_byte.get(printer_name)
-        elapsed_time = self.monitorprinter_time_seconds.get(printer_name)
+        With an analysis of the file the position on the SD card is mapped to the simulated print time,
+        otherwise its not very accurate, but it gives a rough estimate. Called with state.lock held."""
+        current_byte = state.current_byte
+        total_byte = state.total_byte
+        elapsed_time = state.print_time
         
-        if total_byte is None or total_byte is None or total_byte == 0 or elapsed_time == 0:
-            self.monitorprinter_time_remaining[printer_name] = "0s"
-            self.monitorprinter_procent[printer_name] = "0%"
+        if not total_byte or not elapsed_time:
+            state.time_remaining = 0
+            state.progress = 0
+            state.completed = False
             return
 
-        if current_byte >= total_byte or self.monitorprinter_status[printer_name] == "Not SD printing":
+        if current_byte >= total_byte or state.status == "Not SD printing":
             # after print is done, sometimes the current_byte is lower than total_byte - dont know why
-            self.monitorprinter_current_byte[printer_name] = total_byte
-            self.monitorprinter_procent[printer_name] = "100%"
-            self.monitorprinter_time_remaining[printer_name] = "Printing Completed"
+            state.current_byte = total_byte
+            state.progress = 100
+            state.completed = True
+            return
+
+        if state.analysis and state.analysis.duration:
+            elapsed_estimate = state.analysis.elapsed_at(current_byte, total_byte)
+            state.progress = elapsed_estimate / state.analysis.duration * 100
+            state.time_remaining = state.analysis.remaining_at(current_byte, total_byte)
+            state.completed = False
             return
         
         #procent calculation
-        if self.monitorprinter_procent_prusa.get(printer_name):
-            percent_completed  = self.monitorprinter_procent_prusa.get(printer_name)
+        if state.progress_prusa:
+            percent_completed = state.progress_prusa
         else:
             percent_completed = (current_byte / total_byte) * 100 
-        self.monitorprinter_procent[printer_name] = f"{int(percent_completed)}%"
+        state.progress = percent_completed
+        state.completed = False
 
         #remaining time calculation
         if percent_completed > 5: # Calculate estimated time remaining after 5% completion to avoid misleading results
-            if self.monitorprinter_time_remaining_prusa.get(printer_name):
-                time_remaining = self.monitorprinter_time_remaining_prusa.get(printer_name) * 60 # Convert to seconds
+            if state.time_remaining_prusa:
+                time_remaining = state.time_remaining_prusa * 60 # Convert to seconds
                 if time_remaining > 2:
                     estimated_time_remaining = time_remaining
                 else:
                     estimated_total_time = (elapsed_time / percent_completed) * 100
                     estimated_time_remaining = estimated_total_time - elapsed_time # Remaining time in seconds - not very accurate
-                        
-                if estimated_time_remaining > 3600:
-                    self.monitorprinter_time_remaining[printer_name] = (f"{int(estimated_time_remaining) // 3600}h "
-                                                                        f"{int(estimated_time_remaining % 3600 // 60)}m ")
-                elif estimated_time_remaining > 60:
-                    self.monitorprinter_time_remaining[printer_name] = f"{int(estimated_time_remaining) // 60}m"
-                elif estimated_time_remaining > 0 and self.monitorprinter_status[printer_name] == "SD printing":
-                    self.monitorprinter_time_remaining[printer_name] = f"{int(estimated_time_remaining)}s"
+
+                if estimated_time_remaining > 0 and (estimated_time_remaining > 60 or state.status == "SD printing"):
+                    state.time_remaining = estimated_time_remaining
                 else:
-                    self.monitorprinter_time_remaining[printer_name] = "Printing Completed"
+                    state.completed = True
         else:
-            self.monitorprinter_time_remaining[printer_name] = "Calculating..."
\ No newline at end of file
+            state.time_remaining = None # Calculating
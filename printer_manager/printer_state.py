@@ -0,0 +1,129 @@
+import threading
+from collections import namedtuple
+
+# Field name and default value of the runtime state of a printer.
+# Numbers are kept in native types (seconds, bytes, percent), they are formatted only for display.
+STATE_FIELDS = (
+    ("status", "Unknown"),
+    ("hotend_temp", None),            # °C
+    ("bed_temp", None),               # °C
+    ("hotend_target", None),          # °C, 0 when heating is off
+    ("bed_target", None),             # °C
+
+    ("current_byte", None),
+    ("total_byte", None),
+    ("progress", None),               # percent, None until the first calculation
+    ("progress_prusa", None),         # percent reported by Prusa firmware
+
+    ("print_time", None),             # seconds
+    ("time_remaining", None),         # seconds, None while the estimate is being calculated
+    ("time_remaining_prusa", None),   # minutes reported by Prusa firmware
+    ("completed", False),             # print finished, the job can be marked as completed
+
+    ("sd_upload_time", None),         # seconds
+    ("sd_upload_time_remaining", None), # seconds
+    ("sd_upload_speed", None),        # bytes per second
+
+    ("model_removed", False),
+    ("job_status_error", False),
+    ("printing_file", None),
+    ("printing_sd_filename", None),
+
+    ("last_connected", 0.0),          # time.time() of the last sign of life
+)
+FIELD_NAMES = tuple(name for name, _ in STATE_FIELDS)
+PUBLISHED_FIELDS = frozenset(FIELD_NAMES) - {"last_connected", "hotend_target", "bed_target"} # Changes of these fields are announced
+
+def format_duration(seconds, with_seconds=True):
+    """Format seconds as "1h 2m 3s", "2m 3s" or "3s"."""
+    seconds = int(seconds)
+    hours, minutes = seconds // 3600, seconds % 3600 // 60
+    if not with_seconds:
+        return f"{hours}h {minutes}m" if hours else f"{minutes}m"
+    if hours:
+        return f"{hours}h {minutes}m {seconds % 60}s"
+    if minutes:
+        return f"{minutes}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+class PrinterSnapshot(namedtuple("PrinterSnapshot", FIELD_NAMES)):
+    """Immutable view of the state of a printer, taken atomically by PrinterState.snapshot()."""
+    __slots__ = ()
+
+    def to_dict(self):
+        """Format the state for the website."""
+        return {
+            "status": self.status,
+            "sd_upload_time": format_duration(self.sd_upload_time) if self.sd_upload_time is not None else "N/A",
+            "sd_upload_time_remaining": (format_duration(self.sd_upload_time_remaining)
+                                         if self.sd_upload_time_remaining is not None else "N/A"),
+            "sd_upload_speed": f"{self.sd_upload_speed / 1000:.1f} kB/s" if self.sd_upload_speed is not None else "N/A",
+            "print_time": format_duration(self.print_time) if self.print_time is not None else "N/A",
+            "estimated_time_remaining": self.format_time_remaining(),
+            "current_byte": self.current_byte if self.current_byte is not None else "N/A",
+            "total_byte": self.total_byte if self.total_byte is not None else "N/A",
+            "print_progress": f"{int(self.progress)}%" if self.progress is not None else "N/A",
+            "hotend_temp": f"{self.hotend_temp:.1f}" if self.hotend_temp is not None else "N/A",
+            "bed_temp": f"{self.bed_temp:.1f}" if self.bed_temp is not None else "N/A",
+        }
+
+    def format_time_remaining(self):
+        if self.progress is None:
+            return "N/A"
+        if self.completed:
+            return "Printing Completed"
+        if self.time_remaining is None:
+            return "Calculating..."
+        if self.time_remaining > 60:
+            return format_duration(self.time_remaining, with_seconds=False)
+        return f"{int(self.time_remaining)}s"
+
+
+class PrinterState:
+    """Runtime state of a single printer.
+    Writers change the fields while holding lock and call publish() afterwards, readers use snapshot()
+    to get a consistent view. Every publish() with changed fields increments version and passes the
+    changed fields to on_change(version, changes, snapshot)."""
+    __slots__ = FIELD_NAMES + ("lock", "version", "changed", "on_change", "analysis")
+
+    def __init__(self, on_change=None, **values):
+        object.__setattr__(self, "changed", set())
+        self.lock = threading.Lock()
+        self.version = 0
+        self.on_change = on_change
+        self.analysis = None # GcodeAnalysis of the printed file, not published
+        for name, default in STATE_FIELDS:
+            setattr(self, name, values.get(name, default))
+        self.changed.clear()
+
+    def __setattr__(self, name, value):
+        # Remember which fields really changed since the last publish()
+        if name in PUBLISHED_FIELDS and getattr(self, name, None) != value:
+            self.changed.add(name)
+        object.__setattr__(self, name, value)
+
+    def snapshot(self):
+        """Return all fields at once as an immutable PrinterSnapshot."""
+        with self.lock:
+            return PrinterSnapshot(*[getattr(self, name) for name in FIELD_NAMES])
+
+    def update(self, **values):
+        """Set several fields atomically and publish the changes."""
+        with self.lock:
+            for name, value in values.items():
+                setattr(self, name, value)
+        self.publish()
+
+    def publish(self):
+        """Announce the fields changed since the last call. Must be called without holding lock."""
+        with self.lock:
+            if not self.changed:
+                return
+            self.version += 1
+            version = self.version
+            changes = {name: getattr(self, name) for name in self.changed}
+            self.changed.clear()
+            snapshot = PrinterSnapshot(*[getattr(self, name) for name in FIELD_NAMES])
+        if self.on_change:
+            self.on_change(version, changes, snapshot)
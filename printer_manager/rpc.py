@@ -0,0 +1,344 @@
+import os
+import stat
+import time
+import socket
+import struct
+import asyncio
+import itertools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
+
+from .gcode_analyzer import GcodeAnalysis
+from .printer_state import PrinterSnapshot
+
+HEADER = struct.Struct(">I") # Length of the msgpack message that follows
+MAX_MESSAGE = 16 * 1024 * 1024 # Bytes, a longer message is a protocol error
+MAX_SUBSCRIBER_BUFFER = 1024 * 1024 # Bytes of events a subscriber may fall behind before it is dropped
+RPC_WORKERS = 64 # Requests handled at the same time, an upload keeps a worker busy until it is done
+SUBSCRIBE_TIMEOUT = 5 # Seconds a client waits for the states of the printers
+RECONNECT_DELAY = 1 # Seconds between the attempts of a client to subscribe again
+SOCKET_UMASK = 0o117 # The socket is created with mode 0o660
+
+# Methods of the PrinterManager clients may call
+RPC_METHODS = ("connect_printer", "remove_printer", "reconnect_printer", "list_serial_ports",
+               "add_to_queue", "remove_from_queue", "print_gcode", "upload_file", "print_file_from_sd",
+               "remove_model", "cancel_print", "send_gcode")
+# Exceptions raised again by the client, others become RuntimeError
+ERRORS = {error.__name__: error for error in (ValueError, ConnectionError, RuntimeError, KeyError)}
+
+RemotePrinter = namedtuple("RemotePrinter", ("port", "baudrate", "connected"))
+
+def pack(message):
+    """A message with its length header."""
+    data = msgpack.packb(message, default=str)
+    return HEADER.pack(len(data)) + data
+
+def unpack_length(header):
+    (length,) = HEADER.unpack(header)
+    if length > MAX_MESSAGE:
+        raise ValueError(f"Message of {length} bytes is too long.")
+    return length
+
+async def read_message(reader):
+    length = unpack_length(await reader.readexactly(HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(length))
+
+def receive(sock):
+    """Read one message from a blocking socket, None when the connection is closed."""
+    header = receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = receive_exactly(sock, unpack_length(header))
+    return msgpack.unpackb(data) if data is not None else None
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class RpcServer:
+    """Serves a PrinterManager on a Unix socket, the daemon side of ManagerClient.
+    Messages are msgpack maps after a 4 byte length. A request {"id", "method", "args", "kwargs"}
+    is answered with {"id", "result"} or {"id", "error", "type"}, it runs in a worker thread since
+    commands and uploads block. A connection that calls "subscribe" gets the states of all printers
+    as result, then an {"event": "change"} message for every state change.
+    services adds methods by name, they run on the server's loop and must not block."""
+    def __init__(self, manager, path, services=None):
+        self.manager = manager
+        self.path = path
+        self.services = dict(services or {})
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(RPC_WORKERS, thread_name_prefix="rpc-worker")
+        self.server = None
+        self.subscribers = set() # StreamWriters of the subscribed connections
+        self.connections = {} # StreamWriter -> task serving the connection
+        self.thread = None
+
+    def start(self):
+        """Listen on the socket, a socket file left by a stopped daemon is replaced."""
+        self.thread = threading.Thread(target=self.loop.run_forever, name="rpc-server", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.listen(), self.loop).result()
+        self.manager.add_listener(self.on_change)
+        print(f"Printer manager listening on {self.path}.")
+
+    async def listen(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path) # Left by a stopped daemon, the lock file makes sure none is running
+        # Only the owner and the group (the web server's user) may connect, from the moment the socket exists
+        umask = os.umask(SOCKET_UMASK)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o660)
+
+    def close(self):
+        self.manager.remove_listener(self.on_change)
+
+        async def stop():
+            self.server.close()
+            tasks = list(self.connections.values())
+            for writer in list(self.connections):
+                writer.transport.abort() # The handlers see the connection closed
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                message = await read_message(reader)
+                if message.get("method") == "subscribe":
+                    # Registered and answered in one step, every later change follows the result
+                    self.subscribers.add(writer)
+                    writer.write(pack({"id": message.get("id"), "result": self.states()}))
+                else:
+                    await self.respond(writer, message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, msgpack.UnpackException):
+            pass # Closed by the client or garbage
+        finally:
+            self.connections.pop(writer, None)
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def respond(self, writer, message):
+        method, args, kwargs = message.get("method"), message.get("args") or [], message.get("kwargs") or {}
+        try:
+            if method in self.services:
+                result = self.services[method](*args, **kwargs)
+            else:
+                result = await self.loop.run_in_executor(self.executor, self.dispatch, method, args, kwargs)
+            response = {"id": message.get("id"), "result": result}
+        except Exception as e:
+            response = {"id": message.get("id"), "error": str(e), "type": type(e).__name__}
+        writer.write(pack(response))
+        await writer.drain()
+
+    def dispatch(self, method, args, kwargs):
+        """Run a request, called in a worker thread."""
+        if method == "printers":
+            return {printer_name: {"port": printer.port, "baudrate": printer.baudrate, "connected": printer.connected}
+                    for printer_name, printer in list(self.manager.printers.items())}
+        if method == "analysis":
+            state = self.manager.get_state(args[0])
+            analysis = state.analysis if state else None
+            if analysis is None:
+                return None
+            return [analysis.duration, analysis.layer_count, analysis.filament_length, analysis.total_bytes]
+        if method not in RPC_METHODS:
+            raise ValueError(f"Unknown method '{method}'.")
+        return getattr(self.manager, method)(*args, **kwargs)
+
+    def states(self):
+        """Printer name -> [version, snapshot] of every printer."""
+        return {printer_name: [state.version, list(state.snapshot())]
+                for printer_name, state in list(self.manager.states.items())}
+
+    def on_change(self, printer_name, version, changes, snapshot):
+        """Listener of the manager, called from any thread."""
+        data = pack({"event": "change", "printer": printer_name, "version": version,
+                     "changes": changes, "snapshot": list(snapshot) if snapshot else None})
+        self.loop.call_soon_threadsafe(self.broadcast, data)
+
+    def broadcast(self, data):
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BUFFER:
+                print("Dropping a subscriber that doesn't keep up.")
+                self.subscribers.discard(writer)
+                writer.close() # It subscribes again and gets the current states
+                continue
+            writer.write(data)
+
+
+class RemoteState:
+    """Read only PrinterState of a printer in the daemon, as mirrored by ManagerClient."""
+    def __init__(self, client, printer_name, version, snapshot):
+        self.client = client
+        self.printer_name = printer_name
+        self.version = version
+        self._snapshot = snapshot
+
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def analysis(self):
+        return self.client.analysis(self.printer_name)
+
+
+class ManagerClient:
+    """The PrinterManager of the daemon (manage.py printer_daemon), called over its Unix socket.
+    Has the methods and attributes of PrinterManager the web tier uses. Each thread calls over its own
+    connection. The states of the printers are mirrored by a subscription opened by the first read
+    or listener, its changes go to the listeners like the changes of a local manager.
+    job_queue is used locally, the database queue is shared with the daemon."""
+    def __init__(self, path, job_queue=None):
+        self.path = path
+        self.job_queue = job_queue
+        self.local = threading.local()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.mirror = None # Printer name -> RemoteState, None until subscribed
+        self.subscribed = threading.Event()
+        self.subscriber = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the daemon's manager and return its result."""
+        kwargs = {key: getattr(value, "pk", value) for key, value in kwargs.items()} # Model instances (owner) go as their key
+        try:
+            if getattr(self.local, "sock", None) is None:
+                self.local.sock = self.connect()
+            self.local.sock.sendall(pack({"id": next(self.ids), "method": method, "args": list(args), "kwargs": kwargs}))
+            response = receive(self.local.sock)
+            if response is None:
+                raise ConnectionResetError("Connection closed.")
+        except OSError as e:
+            if getattr(self.local, "sock", None) is not None:
+                self.local.sock.close()
+                self.local.sock = None
+            raise ConnectionError(f"Printer daemon at '{self.path}' is not reachable: {e}")
+        if "error" in response:
+            raise ERRORS.get(response["type"], RuntimeError)(response["error"])
+        return response["result"]
+
+    def __getattr__(self, name):
+        if name in RPC_METHODS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    @property
+    def printers(self):
+        return {printer_name: RemotePrinter(**info) for printer_name, info in self.call("printers").items()}
+
+    @property
+    def states(self):
+        return dict(self.subscribe())
+
+    def get_state(self, printer_name):
+        return self.subscribe().get(printer_name)
+
+    def snapshot(self, printer_name):
+        state = self.get_state(printer_name)
+        return state.snapshot() if state else None
+
+    def analysis(self, printer_name):
+        values = self.call("analysis", printer_name)
+        return GcodeAnalysis(*values) if values else None
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+        self.subscribe()
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, printer_name, version, changes, snapshot):
+        for listener in list(self.listeners):
+            try:
+                listener(printer_name, version, changes, snapshot)
+            except Exception as e:
+                print(f"Error in state listener for '{printer_name}': {e}")
+
+    def subscribe(self):
+        """Start the subscription once and return the mirrored states.
+        While the daemon is away the last states are kept."""
+        with self.lock:
+            if self.subscriber is None:
+                self.subscriber = threading.Thread(target=self.run_subscription, name="printer-daemon-events", daemon=True)
+                self.subscriber.start()
+        if self.mirror is None and not self.subscribed.wait(SUBSCRIBE_TIMEOUT):
+            raise ConnectionError(f"Printer daemon at '{self.path}' is not reachable.")
+        return self.mirror
+
+    def run_subscription(self):
+        while True:
+            sock = None
+            try:
+                sock = self.connect()
+                sock.sendall(pack({"id": next(self.ids), "method": "subscribe"}))
+                response = receive(sock)
+                if response is not None:
+                    self.replace_mirror(response["result"])
+                    self.subscribed.set()
+                    while True:
+                        message = receive(sock)
+                        if message is None:
+                            break
+                        self.apply_event(message)
+            except (OSError, ValueError, msgpack.UnpackException) as e:
+                if self.subscribed.is_set() or self.mirror is None:
+                    print(f"Printer daemon at '{self.path}' is not reachable: {e}")
+            finally:
+                if sock:
+                    sock.close()
+            self.subscribed.clear()
+            time.sleep(RECONNECT_DELAY)
+
+    def replace_mirror(self, states):
+        """Take the states of a new subscription, the listeners get every printer as changed."""
+        mirror = {printer_name: RemoteState(self, printer_name, version, PrinterSnapshot(*snapshot))
+                  for printer_name, (version, snapshot) in states.items()}
+        removed = set(self.mirror or ()) - set(mirror)
+        self.mirror = mirror
+        for printer_name, state in mirror.items():
+            snapshot = state.snapshot()
+            self.notify(printer_name, state.version, snapshot._asdict(), snapshot)
+        for printer_name in removed:
+            self.notify(printer_name, None, None, None)
+
+    def apply_event(self, message):
+        printer_name, version = message["printer"], message["version"]
+        if message["snapshot"] is None:
+            self.mirror.pop(printer_name, None)
+            self.notify(printer_name, None, None, None)
+            return
+        snapshot = PrinterSnapshot(*message["snapshot"])
+        state = self.mirror.get(printer_name)
+        if state is None or version > state.version:
+            self.mirror[printer_name] = RemoteState(self, printer_name, version, snapshot)
+        self.notify(printer_name, version, message["changes"], snapshot)
@@ -0,0 +1,355 @@
+import asyncio
+import itertools
+import os
+import re
+import threading
+from collections import deque
+
+import serial
+
+READ_CHUNK = 4096 # Max bytes read from a port per readiness event
+MAX_RESENDS = 50 # Resend requests tolerated during one stream before giving up
+
+# Lines the firmware sends on its own (auto reports, keepalives), they are never part of a command's response
+ASYNC_LINES = ("T:", "echo:busy", "busy:", "SD printing byte", "Not SD printing", "Done printing file", "NORMAL MODE:")
+
+REGEX_RESEND = re.compile(r"(?:Resend|rs)[:\s]+N?(\d+)")
+
+# Priorities of the requests of a CommandChannel, lower values run first
+PRIORITY_CONTROL = 0 # Cancelling, stopping the printer
+PRIORITY_JOB = 1 # Uploads, starting prints, SD card and console commands
+PRIORITY_POLL = 2 # Status polling
+
+class SerialConnection:
+    """Non-blocking serial connection of a single printer.
+    The port is registered with the selector of the engine loop, incoming data is split into lines
+    and every line is passed to on_line(). Commands sent with send() wait for their "ok", the lines
+    before it are their response, except ASYNC_LINES which only go to on_line()."""
+    def __init__(self, loop, port, baudrate, on_line):
+        self.loop = loop
+        self.port = port
+        self.baudrate = baudrate
+        self.on_line = on_line
+        self.serial = None
+        self.fd = None
+        self.closed = True
+
+        self.read_buffer = bytearray()
+        self.write_buffer = bytearray()
+        self.writer_registered = False
+        self.pending = deque() # (future, response lines) for every command waiting for "ok", oldest first
+
+        self.line_hook = None # Receives every line first while a binary transfer owns the connection, returns True to consume it
+
+    def open(self):
+        """Open the port in non-blocking mode and register it with the engine loop."""
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=0, write_timeout=0)
+        self.fd = self.serial.fileno()
+        self.closed = False
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def close(self, error=None):
+        """Unregister and close the port. Commands still waiting for "ok" fail with error."""
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        if self.writer_registered:
+            self.loop.remove_writer(self.fd)
+            self.writer_registered = False
+        try:
+            self.serial.close()
+        except (serial.SerialException, OSError):
+            pass
+
+        error = error or serial.SerialException(f"Port '{self.port}' closed.")
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    def write(self, data):
+        """Queue data for writing, the rest is flushed when the port becomes writable."""
+        if self.closed:
+            raise serial.SerialException(f"Port '{self.port}' is not open.")
+        self.write_buffer += data
+        self._flush()
+
+    async def send(self, gcode, timeout=None, print_response=False):
+        """Send a G-code command and wait for its "ok".
+        Returns the lines received before the "ok", or None on timeout. A command that timed out
+        stops waiting for its "ok", so a lost line doesn't shift the answers of the following commands."""
+        future = self.loop.create_future()
+        entry = (future, [])
+        self.pending.append(entry)
+        self.write((gcode + "\n").encode())
+        if print_response:
+            print(f"Sent: {gcode}")
+
+        try:
+            response_lines = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # The command was most likely lost, the next "ok" belongs to the next command
+            for index, pending in enumerate(self.pending):
+                if pending is entry:
+                    del self.pending[index]
+                    break
+            return None
+
+        if print_response:
+            for line in response_lines:
+                print(f"Printer response: {line}")
+        return response_lines
+
+    async def stream(self, lines, rx_buffer_size, first_line=1, on_progress=None, timeout=None, print_response=False):
+        """Stream numbered lines keeping several of them in flight.
+        As many lines are sent as fit into the firmware's RX buffer, every "ok" frees the space of the oldest one.
+        On "Resend: N" the stream rewinds to line N, lines sent before the rewind are expected to be rejected.
+        on_progress(lines_done, bytes_done) is called after every accepted line."""
+        window = deque() # [index, size, future, stale] of every line in flight, oldest first
+        in_flight = 0
+        next_index = 0
+        bytes_done = 0
+        resends = 0
+
+        while next_index < len(lines) or window:
+            # Fill the RX buffer, at least one line is always in flight
+            while next_index < len(lines):
+                size = len(lines[next_index]) + 1
+                if window and in_flight + size > rx_buffer_size:
+                    break
+                future = self.loop.create_future()
+                self.pending.append((future, []))
+                self.write(lines[next_index] + b"\n")
+                if print_response:
+                    print(f"Sent: {lines[next_index].decode()}")
+                window.append([next_index, size, future, False])
+                in_flight += size
+                next_index += 1
+
+            index, size, future, stale = window.popleft()
+            try:
+                response_lines = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise serial.SerialException(f"No response to line {index + first_line} from '{self.port}'.")
+            in_flight -= size
+
+            resend = None
+            for line in response_lines:
+                if print_response:
+                    print(f"Printer response: {line}")
+                match = REGEX_RESEND.match(line)
+                if match:
+                    resend = int(match.group(1))
+
+            if stale:
+                continue
+
+            if resend is None:
+                if any(line.startswith("Error") for line in response_lines):
+                    raise serial.SerialException(f"Printer rejected line {index + first_line}: {response_lines}")
+                bytes_done += size
+                if on_progress:
+                    on_progress(index + 1, bytes_done)
+                continue
+
+            resends += 1
+            if resends > MAX_RESENDS:
+                raise serial.SerialException(f"Too many resend requests from '{self.port}'.")
+            if not first_line <= resend <= index + first_line:
+                raise serial.SerialException(f"Printer requested unknown line {resend}.")
+
+            # Everything still in flight was sent after the rejected line and will be rejected as well
+            for entry in window:
+                entry[3] = True
+            bytes_done -= sum(len(lines[i]) + 1 for i in range(resend - first_line, index))
+            next_index = resend - first_line
+
+    async def wait_idle(self):
+        """Wait until every command sent so far has been answered."""
+        while True:
+            waiting = [future for future, _ in self.pending if not future.done()]
+            if not waiting:
+                return
+            await asyncio.wait(waiting)
+
+    def _flush(self):
+        try:
+            written = os.write(self.fd, self.write_buffer)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self.close(serial.SerialException(f"Write to '{self.port}' failed: {e}"))
+            return
+        del self.write_buffer[:written]
+
+        if self.write_buffer and not self.writer_registered:
+            self.loop.add_writer(self.fd, self._flush)
+            self.writer_registered = True
+        elif not self.write_buffer and self.writer_registered:
+            self.loop.remove_writer(self.fd)
+            self.writer_registered = False
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, READ_CHUNK)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.close(serial.SerialException(f"Read from '{self.port}' failed: {e}"))
+            return
+        if not data:
+            self.close(serial.SerialException(f"Device '{self.port}' disconnected."))
+            return
+
+        self.read_buffer += data
+        while True:
+            index = self.read_buffer.find(b"\n")
+            if index < 0:
+                break
+            line = self.read_buffer[:index].decode("ascii", errors="ignore").strip()
+            del self.read_buffer[:index + 1]
+            if line:
+                self._handle_line(line)
+
+    def _handle_line(self, line):
+        if self.line_hook and self.line_hook(line):
+            return
+
+        if line.startswith("ok"):
+            # "ok" answers the oldest outstanding command, "ok T:..." carries temperatures as well
+            if self.pending:
+                future, response_lines = self.pending.popleft()
+                if not future.done():
+                    future.set_result(response_lines)
+            if line == "ok":
+                return
+        elif self.pending and not line.startswith(ASYNC_LINES):
+            self.pending[0][1].append(line)
+
+        try:
+            self.on_line(line)
+        except Exception as e:
+            print(f"Error processing line '{line}' from '{self.port}': {e}")
+
+
+class RequestInterrupted(Exception):
+    """The request was cancelled for a request of higher priority."""
+
+
+class CommandChannel:
+    """Prioritized queue of the requests to one printer, the only user of the printer's connection.
+    A request is a coroutine function that gets the connection and owns it until it returns, so the
+    commands of a request are never mixed with others, an upload streams its lines undisturbed.
+    Waiting requests run by priority, requests of the same priority in the order they were made.
+    Must be created and used on the engine loop."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.current = None # (priority, task) of the running request
+        self.worker = asyncio.ensure_future(self._work())
+
+    @property
+    def closed(self):
+        return self.connection.closed
+
+    async def run(self, operation, priority=PRIORITY_JOB, preempt=False):
+        """Run operation(connection) when it is its turn and return its result.
+        With preempt a running request of lower priority is cancelled first, used to abort uploads,
+        its requester gets RequestInterrupted."""
+        if self.closed:
+            raise serial.SerialException(f"Port '{self.connection.port}' is not open.")
+        future = self.connection.loop.create_future()
+        self.queue.put_nowait((priority, next(self.order), operation, future))
+        if preempt and self.current and self.current[0] > priority:
+            self.current[1].cancel()
+        return await future
+
+    async def send(self, gcode, priority=PRIORITY_JOB, timeout=None, print_response=False):
+        """Send a single command, see SerialConnection.send()."""
+        return await self.run(lambda connection: connection.send(gcode, timeout, print_response), priority)
+
+    async def _work(self):
+        while True:
+            priority, _, operation, future = await self.queue.get()
+            if future.done():
+                continue # The requester stopped waiting
+            task = asyncio.ensure_future(operation(self.connection))
+            self.current = (priority, task)
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done():
+                    # The channel is closed, the running request ends with it
+                    task.cancel()
+                    task.add_done_callback(lambda task: task.cancelled() or task.exception()) # Nobody waits for it
+                    if not future.done():
+                        future.set_exception(serial.SerialException(f"Port '{self.connection.port}' closed."))
+                    raise
+                if not future.done():
+                    future.set_exception(RequestInterrupted(f"Request to '{self.connection.port}' was interrupted."))
+                continue
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            finally:
+                self.current = None
+            if not future.done():
+                future.set_result(result)
+
+    def close(self, error=None):
+        """Close the connection, waiting requests fail with error."""
+        self.worker.cancel()
+        error = error or serial.SerialException(f"Port '{self.connection.port}' closed.")
+        while not self.queue.empty():
+            _, _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+        self.connection.close(error)
+
+
+class SerialEngine:
+    """Single asyncio event loop that multiplexes the serial connections of all printers.
+    The loop runs in one background thread, line handling, polling and uploads run on it as coroutines."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="serial-engine", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro, timeout=None):
+        """Run a coroutine on the engine loop and block the calling thread until it finishes."""
+        return self.submit(coro).result(timeout)
+
+    def invoke(self, function, *args):
+        """Call a function on the engine loop and return its result, directly when called from the loop."""
+        if threading.current_thread() is self.thread:
+            return function(*args)
+
+        async def run():
+            return function(*args)
+        return self.call(run())
+
+    def spawn(self, coro):
+        """Start a coroutine as a task on the engine loop and return the asyncio.Task."""
+        if threading.current_thread() is self.thread:
+            return self.loop.create_task(coro)
+
+        async def create_task():
+            return asyncio.ensure_future(coro)
+        return self.call(create_task())
+
+    def open_connection(self, port, baudrate, on_line):
+        """Open a serial connection on the engine loop. Must be called from the loop."""
+        connection = SerialConnection(self.loop, port, baudrate, on_line)
+        connection.open()
+        return connection
@@ -0,0 +1,485 @@
+"""Simulated Marlin/Prusa printers on pseudo-terminals, for tests and benchmarks without hardware.
+
+All printers of a Simulator are served by one thread, so dozens of them fit into one process.
+Every printer answers on its own port like a USB printer (/dev/pts/N), the manager connects to
+the port as usual. Run standalone to try printer_shell.py or the website against fake printers:
+
+    python -m printer_manager.simulator [--printers N] [--latency S] [--print-speed X]
+"""
+import os
+import re
+import pty
+import tty
+import time
+import heapq
+import shutil
+import argparse
+import selectors
+import tempfile
+import threading
+from bisect import bisect_right
+from collections import Counter
+
+from .gcode_analyzer import analyze
+
+RX_BUFFER_SIZE = 128 # Marlin's default serial RX buffer
+READ_CHUNK = 4096
+
+MARLIN_FIRMWARE = "FIRMWARE_NAME:Marlin 2.1.2 (Simulated) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:Simulated EXTRUDER_COUNT:1"
+PRUSA_FIRMWARE = "FIRMWARE_NAME:Prusa-Firmware 3.14.0 based on Marlin FIRMWARE_URL:https://github.com/prusa3d/Prusa-Firmware PROTOCOL_VERSION:1.0 MACHINE_TYPE:Simulated EXTRUDER_COUNT:1"
+CAPABILITIES = {"EEPROM": 1, "AUTOREPORT_TEMP": 1, "AUTOREPORT_SD_STATUS": 1, "PROGRESS": 0, "BINARY_FILE_TRANSFER": 0}
+
+REGEX_NUMBERED = re.compile(r"N(\d+)\s*(.*?)\*(\d+)$")
+REGEX_PARAM = re.compile(r"([A-Z])([-+]?\d*\.?\d+)")
+
+def checksum(line):
+    result = 0
+    for byte in line.encode():
+        result ^= byte
+    return result & 0xff
+
+
+class VirtualPrinter:
+    """One simulated printer. The firmware state is only touched by the simulator thread.
+
+    latency: seconds until a command is answered, commands are processed one after the other
+    rx_buffer_size: bytes received but not yet processed that fit, more are dropped like on an RX overflow
+    resend_every: every n-th numbered line is answered with a checksum error and a resend request
+    print_speed: factor of the simulated print time, 60 prints a one hour file in a minute
+    firmware: "marlin" or "prusa", changes the firmware name and the M31/M27 reports
+    drop_lines: the first n received lines are lost and never answered, like line noise while the board resets"""
+    def __init__(self, simulator, name, latency=0.0, rx_buffer_size=RX_BUFFER_SIZE, resend_every=0,
+                 print_speed=1.0, firmware="marlin", capabilities=None, drop_lines=0):
+        self.simulator = simulator
+        self.name = name
+        self.latency = latency
+        self.rx_buffer_size = rx_buffer_size
+        self.resend_every = resend_every
+        self.print_speed = print_speed
+        self.firmware = firmware
+        self.capabilities = dict(CAPABILITIES, **(capabilities or {}))
+        self.drop_lines = drop_lines
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.sd_directory = tempfile.mkdtemp(prefix=f"sd-{name}-")
+
+        self.rx = bytearray() # Received, not yet processed
+        self.tx = bytearray() # Not yet written to the port
+        self.busy = False
+        self.last_line = 0
+        self.numbered_lines = 0
+        self.writing = None # File object while M28 writes to the SD card
+
+        self.hotend_temp, self.hotend_target = 21.0, 0.0
+        self.bed_temp, self.bed_target = 20.0, 0.0
+        self.selected = None # SD file selected with M23
+        self.printing = None # [file name, size, start time, analysis] of the running SD print
+        self.last_print_time = 0.0
+        self.autoreports = {} # "M155"/"M27" -> (interval, token) of the running auto report
+
+        # Counters for tests
+        self.commands = 0
+        self.received = Counter() # Commands by code
+        self.resends = 0
+        self.overflows = 0
+        self.dropped = 0
+
+    # Port side, called by the simulator thread
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master, READ_CHUNK)
+        except BlockingIOError:
+            return
+        except OSError:
+            return
+        free = self.rx_buffer_size - len(self.rx)
+        if len(data) > free:
+            self.overflows += len(data) - free
+            data = data[:max(free, 0)] # The rest is lost like on a real RX overflow
+        self.rx += data
+        self.process()
+
+    def on_writable(self):
+        self.flush()
+
+    def write(self, text):
+        self.tx += text.encode()
+        self.flush()
+
+    def flush(self):
+        if self.tx:
+            try:
+                written = os.write(self.master, self.tx)
+            except BlockingIOError:
+                written = 0
+            except OSError:
+                self.tx.clear()
+                return
+            del self.tx[:written]
+        self.simulator.want_write(self, bool(self.tx))
+
+    def process(self):
+        """Take the next complete line from the RX buffer, it is answered after the latency."""
+        while not self.busy:
+            index = self.rx.find(b"\n")
+            if index < 0:
+                return
+            line = self.rx[:index].decode("ascii", errors="replace").strip()
+            del self.rx[:index + 1]
+            if not line:
+                continue
+            if self.dropped < self.drop_lines:
+                self.dropped += 1
+                continue
+            if self.latency:
+                self.busy = True
+                self.simulator.schedule(self.latency, self.answer, line)
+                return
+            self.handle(line)
+
+    def answer(self, line):
+        self.busy = False
+        self.handle(line)
+        self.process()
+
+    # Firmware
+
+    def handle(self, line):
+        """Handle one received line and write the response."""
+        self.commands += 1
+        if line.startswith("N"):
+            match = REGEX_NUMBERED.match(line)
+            if not match:
+                self.write(f"Error:No Checksum with line number, Last Line: {self.last_line}\nResend: {self.last_line + 1}\nok\n")
+                return
+            number, command = int(match.group(1)), match.group(2).strip()
+            self.numbered_lines += 1
+            if self.resend_every and self.numbered_lines % self.resend_every == 0:
+                self.request_resend("checksum mismatch")
+                return
+            if checksum(line[:line.rindex("*")]) != int(match.group(3)):
+                self.request_resend("checksum mismatch")
+                return
+            if command.startswith("M110"):
+                self.last_line = number
+                self.write("ok\n")
+                return
+            if number != self.last_line + 1:
+                self.request_resend("Line Number is not Last Line Number+1")
+                return
+            self.last_line = number
+        else:
+            command = line
+
+        if self.writing and not command.startswith("M29"):
+            self.writing.write(command + "\n")
+            self.write("ok\n")
+            return
+        self.received[command.split(" ", 1)[0].upper()] += 1
+        if command.upper().startswith("M105"):
+            self.heat() # Marlin sends the temperatures with the "ok"
+            self.write(f"ok T:{self.hotend_temp:.2f} /{self.hotend_target:.2f} B:{self.bed_temp:.2f} /{self.bed_target:.2f} @:0 B@:0\n")
+            return
+        self.write(self.run(command) + "ok\n")
+
+    def request_resend(self, reason):
+        self.resends += 1
+        self.write(f"Error:{reason}, Last Line: {self.last_line}\nResend: {self.last_line + 1}\nok\n")
+
+    def run(self, command):
+        """Run a command, returns the lines written before "ok"."""
+        code = command.split(" ", 1)[0].upper()
+        argument = command[len(code):].strip()
+        params = {letter: float(value) for letter, value in REGEX_PARAM.findall(argument.upper())}
+
+        if code == "M110":
+            self.last_line = int(params.get("N", 0))
+        elif code == "M115":
+            firmware = PRUSA_FIRMWARE if self.firmware == "prusa" else MARLIN_FIRMWARE
+            return firmware + "\n" + "".join(f"Cap:{name}:{int(value)}\n" for name, value in self.capabilities.items())
+        elif code in ("M104", "M109"):
+            self.hotend_target = params.get("S", 0.0)
+        elif code in ("M140", "M190"):
+            self.bed_target = params.get("S", 0.0)
+        elif code == "M155":
+            self.autoreport(code, params.get("S", 0))
+        elif code == "M27":
+            if "S" in params:
+                self.autoreport(code, params["S"])
+                return ""
+            return self.sd_status()
+        elif code == "M31":
+            seconds = int(self.print_time())
+            if self.firmware == "prusa":
+                return f"echo:{seconds // 60} min, {seconds % 60} sec\n"
+            return f"echo:Print time: {seconds // 3600}h {seconds // 60 % 60}m {seconds % 60}s\n"
+        elif code == "M20":
+            files = "".join(f"{name} {os.path.getsize(os.path.join(self.sd_directory, name))}\n"
+                            for name in sorted(os.listdir(self.sd_directory)))
+            return f"Begin file list\n{files}End file list\n"
+        elif code == "M28":
+            self.writing = open(os.path.join(self.sd_directory, sd_name(argument)), "w")
+            return f"Writing to file: {sd_name(argument)}\n"
+        elif code == "M29":
+            if self.writing:
+                self.writing.close()
+                self.writing = None
+            return "Done saving file.\n"
+        elif code == "M30":
+            path = os.path.join(self.sd_directory, sd_name(argument))
+            if not os.path.exists(path):
+                return f"Deletion failed, File: {sd_name(argument)}.\n"
+            os.remove(path)
+            return f"File deleted:{sd_name(argument)}\n"
+        elif code in ("M23", "M32"):
+            response = self.select(sd_name(argument))
+            if code == "M32" and self.selected:
+                self.start_print()
+            return response
+        elif code == "M24":
+            if self.selected:
+                self.start_print()
+        elif code == "M524":
+            if self.printing:
+                self.last_print_time = self.print_time()
+                self.printing = None
+                return "echo:Print aborted\n"
+        return ""
+
+    def autoreport(self, code, interval):
+        """Report the temperatures (M155) or the SD status (M27) every interval seconds, 0 stops it."""
+        token = object()
+        self.autoreports[code] = (interval, token)
+        if interval:
+            self.simulator.schedule(interval, self.report, code, token)
+
+    def report(self, code, token):
+        interval, current = self.autoreports.get(code, (0, None))
+        if current is not token:
+            return # Stopped or changed
+        if code == "M155":
+            self.heat()
+            self.write(f"T:{self.hotend_temp:.2f} /{self.hotend_target:.2f} B:{self.bed_temp:.2f} /{self.bed_target:.2f} @:0 B@:0\n")
+        else:
+            self.write(self.sd_status())
+        self.simulator.schedule(interval, self.report, code, token)
+
+    def heat(self):
+        """Move the temperatures halfway to their targets."""
+        self.hotend_temp += (max(self.hotend_target, 21.0) - self.hotend_temp) / 2
+        self.bed_temp += (max(self.bed_target, 20.0) - self.bed_temp) / 2
+
+    def select(self, name):
+        path = os.path.join(self.sd_directory, name)
+        if not os.path.exists(path):
+            self.selected = None
+            return f"open failed, File: {name}.\n"
+        self.selected = name
+        return f"File opened: {name} Size: {os.path.getsize(path)}\nFile selected\n"
+
+    def start_print(self):
+        path = os.path.join(self.sd_directory, self.selected)
+        analysis = analyze(path)
+        self.printing = [self.selected, os.path.getsize(path), time.monotonic(), analysis]
+        self.simulator.schedule(analysis.duration / self.print_speed, self.finish_print, self.printing)
+
+    def finish_print(self, printing):
+        if self.printing is printing:
+            self.last_print_time = self.print_time()
+            self.printing = None
+            self.write("Done printing file\n")
+
+    def print_time(self):
+        """Simulated seconds of the running print, the last print when none is running."""
+        if not self.printing:
+            return self.last_print_time
+        _, _, start, analysis = self.printing
+        return min((time.monotonic() - start) * self.print_speed, analysis.duration)
+
+    def sd_status(self):
+        if not self.printing:
+            return "Not SD printing\n"
+        _, size, _, analysis = self.printing
+        elapsed = self.print_time()
+        # Invert the time table of the analysis: the byte the printer is at after elapsed seconds
+        times = [entry_time for _, entry_time in analysis.time_table]
+        index = bisect_right(times, elapsed)
+        if index >= len(times):
+            position = size
+        else:
+            start_offset, start_time = analysis.time_table[index - 1] if index else (0, 0.0)
+            end_offset, end_time = analysis.time_table[index]
+            position = start_offset + (end_offset - start_offset) * (elapsed - start_time) / max(end_time - start_time, 1e-9)
+        response = f"SD printing byte {min(int(position), size)}/{size}\n"
+        if self.firmware == "prusa" and analysis.duration:
+            remaining = (analysis.duration - elapsed) / 60
+            response += f"NORMAL MODE: Percent done: {int(elapsed / analysis.duration * 100)}; print time remaining in mins: {int(remaining)}\n"
+        return response
+
+    # Thread-safe helpers for tests
+
+    def sd_files(self):
+        """Names of the files on the simulated SD card."""
+        return sorted(os.listdir(self.sd_directory))
+
+    def read_file(self, name):
+        with open(os.path.join(self.sd_directory, name), "r") as file:
+            return file.read()
+
+    def close(self):
+        if self.writing:
+            self.writing.close()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        shutil.rmtree(self.sd_directory, ignore_errors=True)
+
+
+def sd_name(argument):
+    """File name argument of a SD command, Marlin uses 8.3 names in upper case."""
+    return argument.split(" ")[0].upper()
+
+
+class Simulator:
+    """Runs any number of VirtualPrinters on one thread with a selector and a timer heap."""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.printers = []
+        self.timers = [] # (time, counter, function, args)
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.calls = [] # Functions queued by other threads
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="printer-simulator", daemon=True)
+        self.thread.start()
+
+    def add_printer(self, name=None, **options):
+        """Create a VirtualPrinter, the options are passed to it. Returns the printer, its port is printer.port."""
+        printer = VirtualPrinter(self, name or f"sim{len(self.printers)}", **options)
+        self.call(self.register, printer)
+        return printer
+
+    def register(self, printer):
+        self.printers.append(printer)
+        self.selector.register(printer.master, selectors.EVENT_READ, printer)
+
+    def remove_printer(self, printer):
+        """Unplug a printer, its port stops answering."""
+        def remove():
+            if printer in self.printers:
+                self.printers.remove(printer)
+                self.selector.unregister(printer.master)
+                printer.close()
+        self.call(remove)
+
+    def call(self, function, *args):
+        """Run a function on the simulator thread and wait for it."""
+        if threading.current_thread() is self.thread:
+            return function(*args)
+        done = threading.Event()
+        result = []
+        def run():
+            try:
+                result.append(function(*args))
+            finally:
+                done.set()
+        with self.lock:
+            self.calls.append(run)
+        os.write(self.wake_write, b"\0")
+        done.wait()
+        return result[0] if result else None
+
+    def schedule(self, delay, function, *args):
+        """Run a function on the simulator thread after delay seconds. Called from the simulator thread."""
+        self.counter += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.counter, function, args))
+
+    def want_write(self, printer, wanted):
+        """Watch the port for writability while output is pending."""
+        if printer not in self.printers:
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if wanted else 0)
+        if self.selector.get_key(printer.master).events != events:
+            self.selector.modify(printer.master, events, printer)
+
+    def run(self):
+        while self.running:
+            timeout = max(self.timers[0][0] - time.monotonic(), 0) if self.timers else None
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        os.read(self.wake_read, READ_CHUNK)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if events & selectors.EVENT_READ:
+                    key.data.on_readable()
+                if events & selectors.EVENT_WRITE:
+                    key.data.on_writable()
+
+            with self.lock:
+                calls, self.calls = self.calls, []
+            for function in calls:
+                function()
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, function, args = heapq.heappop(self.timers)
+                function(*args)
+
+    def close(self):
+        """Stop the simulator and close all ports."""
+        def stop():
+            self.running = False
+            for printer in list(self.printers):
+                self.selector.unregister(printer.master)
+                printer.close()
+            self.printers.clear()
+        self.call(stop)
+        self.thread.join()
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Marlin printers on pseudo-terminals.")
+    parser.add_argument("--printers", type=int, default=1, help="number of printers")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds until a command is answered")
+    parser.add_argument("--rx-buffer", type=int, default=RX_BUFFER_SIZE, help="RX buffer size in bytes")
+    parser.add_argument("--resend-every", type=int, default=0, help="request a resend of every n-th numbered line")
+    parser.add_argument("--print-speed", type=float, default=1.0, help="factor of the simulated print time")
+    parser.add_argument("--firmware", choices=("marlin", "prusa"), default="marlin")
+    parser.add_argument("--drop-lines", type=int, default=0, help="lose the first n received lines")
+    args = parser.parse_args()
+
+    with Simulator() as simulator:
+        for _ in range(args.printers):
+            printer = simulator.add_printer(latency=args.latency, rx_buffer_size=args.rx_buffer,
+                                            resend_every=args.resend_every, print_speed=args.print_speed,
+                                            firmware=args.firmware, drop_lines=args.drop_lines)
+            print(f"{printer.name}: {printer.port}")
+        print("Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
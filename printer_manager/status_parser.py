@@ -0,0 +1,43 @@
+import re
+
+# Kinds of status lines
+TEMPERATURE = "temperature"
+PRINT_TIME = "print_time"
+TIME_REMAINING = "time_remaining"
+SD_PROGRESS = "sd_progress"
+NOT_SD_PRINTING = "not_sd_printing"
+
+REGEX_TEMP = re.compile(r"(?:ok\s+)?T:([\d\.]+)\s*(?:/([\d\.]+))?.*?B:([\d\.]+)\s*(?:/([\d\.]+))?") # Hotend and bed temp and target, Marlin and Prusa
+REGEX_TIME = re.compile(r"echo:Print time:\s*(?:(\d+)h\s*)?(?:(\d+)m\s*)?(?:(\d+)s)?") # Print time
+REGEX_TIME_2 = re.compile(r"echo:\s*(?:(\d+)\s*hour[s]?,?\s*)?(?:(\d+)\s*min[s]?,?\s*)?(?:(\d+)\s*sec[s]?)") # Print time second option
+REGEX_TIME_REMAINING = re.compile(r"NORMAL MODE: Percent done: (\d+); print time remaining in mins: (-?\d+)")
+REGEX_SD_PROGRESS = re.compile(r"SD printing byte (\d+)/(\d+)")
+
+def parse_status_line(line):
+    """Parse a status line from the printer in a single pass.
+    The line prefix selects the one pattern that can match. Returns (kind, values) or None for unrelated lines."""
+    if line.startswith("T:") or (line.startswith("ok") and "T:" in line[:8]):
+        match = REGEX_TEMP.match(line)
+        if match:
+            return TEMPERATURE, (match.group(1), match.group(3), match.group(2), match.group(4)) # Targets may be None
+
+    elif line.startswith("echo:"):
+        match = (REGEX_TIME if line.startswith("echo:Print time:") else REGEX_TIME_2).match(line)
+        if match:
+            hours, minutes, seconds = (int(group) if group else 0 for group in match.groups())
+            return PRINT_TIME, (hours, minutes, seconds)
+
+    elif line.startswith("SD printing byte"):
+        match = REGEX_SD_PROGRESS.match(line)
+        if match:
+            return SD_PROGRESS, (int(match.group(1)), int(match.group(2)))
+
+    elif line.startswith("Not SD printing"):
+        return NOT_SD_PRINTING, ()
+
+    elif line.startswith("NORMAL MODE"):
+        match = REGEX_TIME_REMAINING.match(line)
+        if match:
+            return TIME_REMAINING, (int(match.group(1)), int(match.group(2)))
+
+    return None
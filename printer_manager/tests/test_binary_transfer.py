@@ -0,0 +1,86 @@
+import asyncio
+import struct
+import unittest
+
+from printer_manager import binary_transfer
+
+
+class FakeBinaryFirmware:
+    """Connection that answers the packets of a BinaryTransfer like Marlin, checking their framing."""
+    def __init__(self, compression="none", resends=0, block_size=64):
+        self.compression = compression
+        self.resends = resends # WRITE packets answered with "rs" first
+        self.block_size = block_size
+        self.line_hook = None
+        self.filename = None
+        self.compressed = None
+        self.received = bytearray()
+        self.writes = 0
+
+    def answer(self, *lines):
+        for line in lines:
+            self.line_hook(line)
+
+    def write(self, data):
+        if data == b"M28 B1\n":
+            return self.answer("ok")
+        token, sync, kind, length, header_checksum = struct.unpack("<HBBHH", data[:8])
+        assert token == binary_transfer.PACKET_TOKEN
+        assert header_checksum == binary_transfer.checksum(data[2:6])
+        payload = data[8:8 + length]
+        if length:
+            assert len(data) == 8 + length + 2
+            assert struct.unpack("<H", data[-2:])[0] == binary_transfer.checksum(data[2:-2])
+        protocol, packet_type = kind >> 4, kind & 0xF
+
+        if protocol == binary_transfer.PROTOCOL_CONNECTION:
+            if packet_type == binary_transfer.PACKET_SYNC:
+                self.answer(f"ss{sync},{self.block_size},0.1.0")
+        elif packet_type == binary_transfer.PACKET_QUERY:
+            self.answer(f"ok{sync}", f"PFT:version:0.1.0:{self.compression}")
+        elif packet_type == binary_transfer.PACKET_OPEN:
+            self.compressed = payload[1] == 1
+            self.filename = payload[2:-1].decode()
+            self.answer(f"ok{sync}", "PFT:success")
+        elif packet_type == binary_transfer.PACKET_WRITE:
+            self.writes += 1
+            if self.resends:
+                self.resends -= 1
+                return self.answer(f"rs{sync}")
+            self.received += payload
+            self.answer(f"ok{sync}")
+        elif packet_type == binary_transfer.PACKET_CLOSE_FILE:
+            self.answer(f"ok{sync}", "PFT:success")
+
+
+class BinaryTransferTests(unittest.TestCase):
+    def test_checksum(self):
+        self.assertEqual(binary_transfer.checksum(b"abcde"), 0xC8F0) # Fletcher-16
+        self.assertEqual(binary_transfer.checksum(b"abcdefgh"), 0x0627)
+        packet = binary_transfer.build_packet(3, binary_transfer.PROTOCOL_FILE_TRANSFER, binary_transfer.PACKET_WRITE, b"G28")
+        self.assertEqual(packet[:8], b"\xad\xb5\x03\x13\x03\x00" + struct.pack("<H", binary_transfer.checksum(packet[2:6])))
+        self.assertEqual(packet[8:11], b"G28")
+        self.assertEqual(len(binary_transfer.build_packet(0, 0, 1)), 8) # No payload, no payload checksum
+
+    def test_upload(self):
+        firmware = FakeBinaryFirmware(resends=1)
+        data = bytes(range(256)) * 2
+        progress = []
+        transfer = binary_transfer.BinaryTransfer(firmware)
+        asyncio.run(transfer.upload("CUBE.GCO", data, on_progress=lambda *done: progress.append(done)))
+        self.assertEqual(firmware.filename, "CUBE.GCO")
+        self.assertFalse(firmware.compressed)
+        self.assertEqual(bytes(firmware.received), data)
+        self.assertEqual(firmware.writes, 9) # 8 blocks, the first one twice
+        self.assertEqual(progress[-1], (512, 512))
+        self.assertIsNone(firmware.line_hook) # Back to the ASCII protocol
+
+    @unittest.skipUnless(binary_transfer.heatshrink2, "heatshrink2 is not installed")
+    def test_compressed(self):
+        firmware = FakeBinaryFirmware(compression="heatshrink,8,4")
+        data = b"G1 X10 Y10 E0.5 F3000\n" * 100
+        asyncio.run(binary_transfer.BinaryTransfer(firmware).upload("CUBE.GCO", data, compress=True))
+        self.assertTrue(firmware.compressed)
+        self.assertLess(len(firmware.received), len(data))
+        self.assertEqual(binary_transfer.heatshrink2.decompress(bytes(firmware.received), window_sz2=8, lookahead_sz2=4), data)
+
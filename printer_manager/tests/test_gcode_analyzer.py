@@ -0,0 +1,77 @@
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from printer_manager import gcode_analyzer
+from printer_manager.gcode_analyzer import GcodeAnalysis
+
+
+class GcodeAnalyzerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write(self, text, name="part.gcode"):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_simulation(self):
+        # 100 mm at 100 mm/s with 1000 mm/s^2: 0.1 s accelerating, 0.9 s cruising, 0.1 s braking.
+        # The 0.4 mm move never reaches full speed, the dwells stop the moves before them
+        path = self.write("; header\nG90\nM82\nG1 F6000 ; fast\nG1 X100 E5\nG4 S2\nG1 Z0.4\nG4 P0\nG1 X0 E10\n")
+        analysis = gcode_analyzer.analyze_lines(path)
+        self.assertAlmostEqual(analysis.duration, 1.1 + 2 + 2*math.sqrt(0.4 / 1000) + 1.1, places=6)
+        self.assertEqual(analysis.layer_count, 2)
+        self.assertAlmostEqual(analysis.filament_length, 10)
+        self.assertEqual(analysis.total_bytes, len("G90\nM82\nG1 F6000\nG1 X100 E5\nG4 S2\nG1 Z0.4\nG4 P0\nG1 X0 E10\n"))
+        self.assertEqual(analysis.bounds, [0.0, 0.0, 0.0, 100.0, 0.0, 0.4])
+        self.assertEqual(analysis.elapsed_at(analysis.total_bytes), analysis.duration)
+        self.assertEqual(analysis.remaining_at(0), analysis.duration)
+
+    def test_time_table(self):
+        analysis = GcodeAnalysis(10.0, total_bytes=200, time_table=[(100, 2.0), (200, 10.0)])
+        self.assertEqual(analysis.elapsed_at(50), 1.0)
+        self.assertEqual(analysis.elapsed_at(150), 6.0)
+        self.assertEqual(analysis.elapsed_at(75, total_byte=100), 6.0) # The file on the card is half the size
+        self.assertEqual(analysis.remaining_at(250), 0.0)
+        self.assertEqual(GcodeAnalysis().elapsed_at(10), 0.0)
+
+    @unittest.skipUnless(gcode_analyzer.numpy, "numpy is not installed")
+    def test_arrays_match_lines(self):
+        layers = "".join(f"; Layer {layer}\nG1 Z{0.3 + layer * 0.2:.1f}\n" +
+                         "".join(f"G1 X{10 + move % 2 * 20} Y{10 + move * 0.5:.1f} E0.5 F3000 ; move {move}\n"
+                                 for move in range(30))
+                         for layer in range(4))
+        path = self.write("G28 ; home\nG90\nM83\nG1 Z0.3 F600\n" + layers, "mixed.gcode")
+        with open(path, "a", newline="") as file:
+            file.write("G28\r\nG0 F1800\r\nM117 Homed\nG1 X5 Y5 Z0.3 F600\nM204 S500\nG1 X50 Y.5 E1.2\nG1 E0.2 F2400 ; retract\n"
+                       "G92 E0\nM82\nG1X60Y20E1\nG91\nG1 X-10 Y5 E0.4\nG1 Z0.2\nG90\nG2 X70 Y30 I5 J5 E2\n"
+                       "G4 P500\nN5 G1 X0*12\nT0\nG1 X0 Y0 E2.5")
+        with mock.patch.object(gcode_analyzer, "CHUNK_SIZE", 256): # Blocks of moves cross the chunks
+            arrays = gcode_analyzer.analyze_arrays(path)
+        lines = gcode_analyzer.analyze_lines(path)
+        self.assertEqual((arrays.layer_count, arrays.total_bytes), (lines.layer_count, lines.total_bytes))
+        self.assertTrue(math.isclose(arrays.duration, lines.duration, rel_tol=1e-9))
+        self.assertTrue(math.isclose(arrays.filament_length, lines.filament_length, rel_tol=1e-9))
+        for array_value, line_value in zip(arrays.bounds, lines.bounds):
+            self.assertAlmostEqual(array_value, line_value, places=9)
+        self.assertEqual([offset for offset, _ in arrays.time_table], [offset for offset, _ in lines.time_table])
+        for (_, array_time), (_, line_time) in zip(arrays.time_table, lines.time_table):
+            self.assertAlmostEqual(array_time, line_time, places=6)
+
+    def test_content_hash(self):
+        path = self.write("G1 X10 E1\n" * 1000, "hashed.gcode")
+        with mock.patch.object(gcode_analyzer, "hashlib", SimpleNamespace(sha256=hashlib.sha256)), \
+                mock.patch.object(gcode_analyzer, "HASH_BLOCK_SIZE", 4096): # Python < 3.11
+            self.assertEqual(gcode_analyzer.content_hash(path), hashlib.sha256(b"G1 X10 E1\n" * 1000).hexdigest())
+
+    def test_cached(self):
+        first = gcode_analyzer.analyze_cached(self.write("G1 X10 E1\n", "a.gcode"))
+        self.assertIs(gcode_analyzer.analyze_cached(self.write("G1 X10 E1\n", "b.gcode")), first) # Same content
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+
+from printer_manager import gcode_analyzer
+from printer_manager import gcode_compiler
+
+
+class GcodeCompilerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.filename = os.path.join(self.directory, "cube.gcode")
+        with open(self.filename, "w") as file:
+            file.write("; start\nG28 ; home\n\nG1 X10 Y10\n  M104 S200  \n")
+
+    def test_numbered(self):
+        self.assertEqual(gcode_compiler.add_checksum("G28 ; home", 1), "N1 G28*18")
+        self.assertEqual(gcode_compiler.add_checksum("; comment", 2), "")
+        with gcode_compiler.CompiledGcode.open(self.filename) as compiled:
+            self.assertEqual(list(compiled), [b"N1 G28*18", b"N2 G1 X10 Y10*43", b"N3 M104 S200*100"])
+            self.assertEqual(compiled[-1], b"N3 M104 S200*100")
+            self.assertEqual(compiled.saved_bytes, 0)
+
+    def test_index(self):
+        path = gcode_compiler.compile_gcode(self.filename, gcode_compiler.PLAIN)
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"G28\nG1 X10 Y10\nM104 S200\n")
+        ends = array("Q")
+        with open(path + ".idx", "rb") as file:
+            ends.frombytes(file.read())
+        self.assertEqual(list(ends), [4, 15, 25]) # End of every line with its newline
+
+    def test_compiled_once(self):
+        path = gcode_compiler.compile_gcode(self.filename)
+        self.assertEqual(os.path.basename(path), gcode_analyzer.content_hash(self.filename) + ".numbered")
+        os.utime(path, (0, 0))
+        with mock.patch.object(gcode_compiler, "write_file") as write_file:
+            self.assertEqual(gcode_compiler.compile_gcode(self.filename), path)
+        write_file.assert_not_called()
+        self.assertGreater(os.path.getmtime(path), 0) # Marked as recently used
+
+        with mock.patch.object(gcode_compiler, "COMPILED_KEEP", 1):
+            other = gcode_compiler.compile_gcode(self.filename, gcode_compiler.PLAIN)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         sorted(os.path.basename(other) + extension for extension in ("", ".idx", ".json")))
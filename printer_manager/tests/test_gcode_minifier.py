@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from printer_manager import gcode_compiler
+from printer_manager.gcode_minifier import Minifier
+
+
+class MinifierTests(unittest.TestCase):
+    def minify(self, lines):
+        minifier = Minifier()
+        return [minifier.line(line) for line in lines], minifier
+
+    def test_modal_values(self):
+        lines, minifier = self.minify([
+            "G1  X10.0000 Y20 F1800.00",
+            "G1 X10 Y25 F1800", # Same X and feedrate
+            "G1 X10 Y25", # Moves nowhere, dropped
+            "G1 X10.0000004 E1.123456",
+            "G28", # May move the axes, the position is unknown afterwards
+            "G1 X10 Y25 F1800",
+            "M104 S200", # Doesn't move
+            "G1 X10 Y25 Z0.2",
+        ])
+        self.assertEqual(lines, ["G1 X10 Y20 F1800", "G1 Y25", "", "G1 E1.12346", "G28", "G1 X10 Y25 F1800",
+                                 "M104 S200", "G1 Z0.2"])
+        self.assertEqual(minifier.saved_bytes, sum(len(line) + 1 for line in (
+            "G1  X10.0000 Y20 F1800.00", "G1 X10 Y25 F1800", "G1 X10 Y25", "G1 X10.0000004 E1.123456", "G28",
+            "G1 X10 Y25 F1800", "M104 S200", "G1 X10 Y25 Z0.2")) - sum(len(line) + 1 for line in lines if line))
+
+    def test_modes(self):
+        lines, _ = self.minify(["G91", "G1 X0 Y5 E0", "G1 X5", "G90", "G92 E0", "G1 E0", "G1 E2", "M83", "G1 E2", "G1 E2"])
+        self.assertEqual(lines, ["G91", "G1 Y5", "G1 X5", "G90", "G92 E0", "", "G1 E2", "M83", "G1 E2", "G1 E2"])
+
+    def test_unchanged(self):
+        lines, _ = self.minify(["M117 Printing  cube", "G1 X10", "G1 X10 Y10*", "G1 X10", "T1", "G1 X10"])
+        self.assertEqual(lines, ["M117 Printing  cube", "G1 X10", "G1 X10 Y10*", "G1 X10", "T1", "G1 X10"])
+
+    def test_compiled(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        filename = os.path.join(directory, "cube.gcode")
+        with open(filename, "w") as file:
+            file.write("G1 X1.00000 F600\nG1 X1.00000 F600\nG1 X2\n")
+        with gcode_compiler.CompiledGcode.open(filename, gcode_compiler.PLAIN, minify=True) as compiled:
+            self.assertEqual(list(compiled), [b"G1 X1 F600", b"G1 X2"])
+            self.assertEqual(compiled.saved_bytes, 40 - 17)
@@ -0,0 +1,46 @@
+import unittest
+
+from printer_manager.printer_state import PrinterState
+
+
+class PrinterStateTests(unittest.TestCase):
+    def test_snapshot(self):
+        state = PrinterState(status="Not SD printing")
+        state.update(hotend_temp=20.0, bed_temp=60.0)
+        snapshot = state.snapshot()
+        self.assertEqual((snapshot.status, snapshot.hotend_temp, snapshot.bed_temp), ("Not SD printing", 20.0, 60.0))
+        self.assertIsNone(snapshot.progress)
+        state.update(bed_temp=61.0)
+        self.assertEqual(snapshot.bed_temp, 60.0) # Snapshots don't change afterwards
+        with self.assertRaises(AttributeError):
+            state.unknown_field = 1 # Slotted
+
+    def test_publish_changes(self):
+        published = []
+        state = PrinterState(on_change=lambda *change: published.append(change), status="Not SD printing")
+        self.assertEqual(state.version, 0)
+        state.update(hotend_temp=20.0, status="Not SD printing", last_connected=1.0)
+        version, changes, snapshot = published[-1]
+        self.assertEqual((version, changes), (1, {"hotend_temp": 20.0})) # Unchanged and internal fields are not announced
+        self.assertEqual(snapshot.hotend_temp, 20.0)
+        state.update(hotend_temp=20.0, last_connected=2.0)
+        self.assertEqual(len(published), 1)
+        with state.lock:
+            state.bed_temp = 60.0
+            state.bed_temp = 61.0
+        state.publish()
+        self.assertEqual(published[-1][:2], (2, {"bed_temp": 61.0}))
+        self.assertEqual(snapshot.bed_temp, None) # Snapshots don't change afterwards
+
+    def test_document(self):
+        snapshot = PrinterState(status="SD printing", hotend_temp=215.04, print_time=3723, progress=42.7,
+                                time_remaining=30, sd_upload_speed=12345).snapshot()
+        document = snapshot.to_dict()
+        self.assertEqual(document["print_time"], "1h 2m 3s")
+        self.assertEqual(document["print_progress"], "42%")
+        self.assertEqual(document["estimated_time_remaining"], "30s")
+        self.assertEqual(document["hotend_temp"], "215.0")
+        self.assertEqual(document["bed_temp"], "N/A")
+        self.assertEqual(document["sd_upload_speed"], "12.3 kB/s")
+        self.assertEqual(snapshot._replace(time_remaining=None).to_dict()["estimated_time_remaining"], "Calculating...")
+        self.assertEqual(snapshot._replace(completed=True).to_dict()["estimated_time_remaining"], "Printing Completed")
@@ -0,0 +1,99 @@
+import os
+import time
+import unittest
+
+import serial
+
+from printer_manager.serial_engine import SerialEngine
+
+
+class SerialEngineTests(unittest.TestCase):
+    """SerialConnection against a pty the test answers itself."""
+    def setUp(self):
+        self.engine = SerialEngine()
+        self.addCleanup(self.engine.loop.call_soon_threadsafe, self.engine.loop.stop)
+        self.master, slave = os.openpty()
+        self.addCleanup(os.close, self.master)
+        self.addCleanup(os.close, slave)
+        self.lines = []
+        self.connection = self.on_loop(self.engine.open_connection, os.ttyname(slave), 115200, self.lines.append)
+        self.addCleanup(self.on_loop, self.connection.close)
+
+    def on_loop(self, function, *args):
+        """Run function on the engine loop and return its result."""
+        async def run():
+            return function(*args)
+        return self.engine.call(run(), 2)
+
+    def reply(self, text):
+        """Wait for the next command and answer it with text."""
+        received = b""
+        while not received.endswith(b"\n"):
+            received += os.read(self.master, 1024)
+        os.write(self.master, text.encode())
+        return received.decode().strip()
+
+    def read_lines(self, count):
+        """The next count lines written to the printer."""
+        received = b""
+        while received.count(b"\n") < count:
+            received += os.read(self.master, 1024)
+        return received.decode().split()
+
+    def test_response(self):
+        future = self.engine.submit(self.connection.send("M20"))
+        self.assertEqual(self.reply("Begin file list\nT:21.0 /0.0\nEnd file list\nok\n"), "M20")
+        self.assertEqual(future.result(2), ["Begin file list", "End file list"]) # Auto reports are not part of it
+        self.assertEqual(self.lines, ["Begin file list", "T:21.0 /0.0", "End file list"])
+
+        future = self.engine.submit(self.connection.send("M105"))
+        self.reply("ok T:22.0 /0.0\n")
+        self.assertEqual(future.result(2), [])
+        self.assertEqual(self.lines[-1], "ok T:22.0 /0.0") # The temperatures still reach the parser
+
+    def test_split_reads(self):
+        future = self.engine.submit(self.connection.send("M115"))
+        self.reply("FIRMWARE_NAME:Mar")
+        time.sleep(0.1)
+        os.write(self.master, b"lin\r\nok\n")
+        self.assertEqual(future.result(2), ["FIRMWARE_NAME:Marlin"])
+
+    def test_stream_window(self):
+        progress = []
+        future = self.engine.submit(self.connection.stream([b"A1", b"A2", b"A3"], rx_buffer_size=6,
+                                                           on_progress=lambda *done: progress.append(done), timeout=2))
+        self.assertEqual(self.read_lines(2), ["A1", "A2"]) # As many as fit into the RX buffer
+        os.write(self.master, b"ok\n")
+        self.assertEqual(self.read_lines(1), ["A3"]) # Sent when the first one was taken
+        os.write(self.master, b"ok\nok\n")
+        future.result(2)
+        self.assertEqual(progress, [(1, 3), (2, 6), (3, 9)])
+
+    def test_stream_resend(self):
+        progress = []
+        lines = [b"A1", b"A2", b"A3", b"A4"]
+        future = self.engine.submit(self.connection.stream(lines, rx_buffer_size=64,
+                                                           on_progress=lambda *done: progress.append(done), timeout=2))
+        self.assertEqual(self.read_lines(4), ["A1", "A2", "A3", "A4"])
+        # Line 2 is damaged, the lines after it are rejected too
+        os.write(self.master, b"ok\nError:checksum mismatch\nResend: 2\nok\nok\nok\n")
+        self.assertEqual(self.read_lines(3), ["A2", "A3", "A4"])
+        os.write(self.master, b"ok\nok\nok\n")
+        future.result(2)
+        self.assertEqual(progress, [(1, 3), (2, 6), (3, 9), (4, 12)])
+
+    def test_stream_rejected(self):
+        future = self.engine.submit(self.connection.stream([b"A1"], rx_buffer_size=64, timeout=2))
+        self.read_lines(1)
+        os.write(self.master, b"Error:unknown command\nok\n")
+        with self.assertRaisesRegex(serial.SerialException, "rejected line 1"):
+            future.result(2)
+
+    def test_closed(self):
+        future = self.engine.submit(self.connection.send("G28"))
+        self.reply("echo:busy: processing\n")
+        self.on_loop(self.connection.close)
+        with self.assertRaises(serial.SerialException):
+            future.result(2)
+        with self.assertRaises(serial.SerialException):
+            self.engine.call(self.connection.send("M105"), 2)
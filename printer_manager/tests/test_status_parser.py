@@ -0,0 +1,27 @@
+import unittest
+
+from printer_manager.status_parser import (parse_status_line, TEMPERATURE, PRINT_TIME, TIME_REMAINING,
+                                           SD_PROGRESS, NOT_SD_PRINTING)
+
+
+class StatusParserTests(unittest.TestCase):
+    def test_lines(self):
+        lines = {
+            "T:210.5 /215.0 B:60.2 /60.0 @:127 B@:0": (TEMPERATURE, ("210.5", "60.2", "215.0", "60.0")),
+            "ok T:20.0 /0.0 B:21.0 /0.0 T0:20.0 /0.0 @:0 B@:0 P:0.0 A:25.4": (TEMPERATURE, ("20.0", "21.0", "0.0", "0.0")),
+            "T:20.0 B:21.0": (TEMPERATURE, ("20.0", "21.0", None, None)),
+            "echo:Print time: 1h 2m 3s": (PRINT_TIME, (1, 2, 3)),
+            "echo:Print time: 45s": (PRINT_TIME, (0, 0, 45)),
+            "echo: 2 hours, 5 mins, 7 sec": (PRINT_TIME, (2, 5, 7)),
+            "SD printing byte 1234/56789": (SD_PROGRESS, (1234, 56789)),
+            "Not SD printing": (NOT_SD_PRINTING, ()),
+            "NORMAL MODE: Percent done: 12; print time remaining in mins: 34": (TIME_REMAINING, (12, 34)),
+            "NORMAL MODE: Percent done: -1; print time remaining in mins: -1": None,
+            "echo:busy: processing": None,
+            "ok": None,
+            "Begin file list": None,
+            "T:garbage": None,
+        }
+        for line, expected in lines.items():
+            with self.subTest(line=line):
+                self.assertEqual(parse_status_line(line), expected)
@@ -0,0 +1,48 @@
+import threading
+import time
+import unittest
+
+from printer_manager.upload_pool import UploadPool
+
+def wait_for(condition, timeout=10):
+    """Wait until condition() is true, returns its last value."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class UploadPoolTests(unittest.TestCase):
+    def start(self, pool, printer_name, started, waited):
+        """Take a slot in a thread, started gets the printer name when it has the slot."""
+        thread = threading.Thread(target=lambda: (pool.acquire(printer_name, lambda: waited.append(printer_name)),
+                                                  started.append(printer_name)), daemon=True)
+        thread.start()
+        return thread
+
+    def test_bounded(self):
+        pool = UploadPool(2)
+        started, waited = [], []
+        for printer_name in ("a", "b"):
+            self.start(pool, printer_name, started, waited).join(2)
+        self.assertEqual((started, waited), (["a", "b"], []))
+        self.start(pool, "c", started, waited)
+        self.assertTrue(wait_for(lambda: waited == ["c"]))
+        self.assertEqual(pool.stats(), (2, 1))
+        self.start(pool, "d", started, waited)
+        self.assertTrue(wait_for(lambda: pool.stats() == (2, 2)))
+
+        pool.release("b")
+        self.assertTrue(wait_for(lambda: started == ["a", "b", "c"])) # First come first served
+        pool.release("a")
+        self.assertTrue(wait_for(lambda: started == ["a", "b", "c", "d"]))
+
+    def test_one_slot_per_printer(self):
+        pool = UploadPool(4)
+        started, waited = [], []
+        with pool.slot("a"):
+            self.start(pool, "a", started, waited)
+            self.start(pool, "b", started, waited).join(2)
+            self.assertTrue(wait_for(lambda: waited == ["a"]))
+            self.assertEqual(started, ["b"]) # Not blocked by the waiting upload to "a"
+        self.assertTrue(wait_for(lambda: started == ["b", "a"]))
@@ -0,0 +1,63 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+MAX_UPLOADS = 4 # Uploads running at the same time, each one keeps a serial port busy for minutes
+
+class UploadPool:
+    """Bounded pool of upload slots shared by all printers.
+    A printer holds at most one slot, a second upload to the same printer waits for the first one.
+    Waiting uploads get a slot first come first served, so a printer can't starve the others.
+    The caller's thread blocks while the pool is saturated, every printer has at most one print thread
+    so the number of waiting uploads is bounded by the number of printers."""
+    def __init__(self, size=MAX_UPLOADS):
+        self.size = max(int(size), 1)
+        self.condition = threading.Condition()
+        self.active = set() # Printers uploading
+        self.waiting = deque() # Printers waiting for a slot, oldest first
+
+    def acquire(self, printer_name, on_wait=None):
+        """Take a slot for a printer, blocks until one is free. on_wait() is called once if the upload has to wait."""
+        with self.condition:
+            self.waiting.append(printer_name)
+            try:
+                if not self.can_start(printer_name) and on_wait:
+                    self.condition.release()
+                    try:
+                        on_wait()
+                    finally:
+                        self.condition.acquire()
+                while not self.can_start(printer_name):
+                    self.condition.wait()
+            finally:
+                self.waiting.remove(printer_name)
+                self.condition.notify_all() # The next waiting printer may start now
+            self.active.add(printer_name)
+
+    def release(self, printer_name):
+        with self.condition:
+            self.active.discard(printer_name)
+            self.condition.notify_all()
+
+    def can_start(self, printer_name):
+        """True if a slot is free and the printer is the oldest waiting printer that isn't uploading."""
+        if len(self.active) >= self.size or printer_name in self.active:
+            return False
+        for name in self.waiting:
+            if name not in self.active:
+                return name == printer_name
+        return False
+
+    @contextmanager
+    def slot(self, printer_name, on_wait=None):
+        """Hold an upload slot for a printer while the block runs."""
+        self.acquire(printer_name, on_wait)
+        try:
+            yield
+        finally:
+            self.release(printer_name)
+
+    def stats(self):
+        """(uploading, waiting) number of printers."""
+        with self.condition:
+            return len(self.active), len(self.waiting)
@@ -19,7 +19,8 @@ class PrinterShell(Cmd):
 
     def do_list_serial(self, arg):
         "List all serial ports."
-        self.manager.list_serial_ports()
+        for port, label in self.manager.list_serial_ports():
+            print(f"{port}: {label}" if port else label)
 
     def do_connect(self, arg):
         "Connect to a printer: connect <printer_name> <port> [baudrate]"
@@ -93,14 +94,14 @@ class PrinterShell(Cmd):
     
     def do_exit(self, arg):
         "Exit the program."
-        self.manager.save_printer_config()
+        self.manager.save_printer_config(flush=True)
         print("Exiting.")
         return True
     
     def do_EOF(self, arg):
         "Exit the program."
         print("")
-        self.manager.save_printer_config()
+        self.manager.save_printer_config(flush=True)
         print("Exiting.")
         return True
 
@@ -140,6 +141,6 @@ if __name__ == "__main__":
         PrinterShell(manager).cmdloop()
     except (KeyboardInterrupt, EOFError):
         print("")
-        manager.save_printer_config()
+        manager.save_printer_config(flush=True)
         print("Exiting.")
         sys.exit(0)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PrintersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'printers'
+
+    def ready(self):
+        from . import scheduler # Connects the signal that keeps Printer.queue_length
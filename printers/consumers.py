@@ -3,18 +3,28 @@ import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from printer_manager.instance import printer_manager
 from asgiref.sync import sync_to_async
-from .models import Printer, PrintJob
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.conf import settings
+from .models import Printer
+from .publisher import status_publisher, group_name, FLEET_GROUP
+from . import protocol
+
+def current_document(printer_name):
+    """Status document for a new version 1 client, None if the publisher sends it with the next change.
+    Blocks while the publisher of the printer daemon is asked, raises ConnectionError if it is away."""
+    document = status_publisher.document(printer_name)
+    if document:
+        return document
+    if printer_name in printer_manager.states:
+        status_publisher.refresh(printer_name)
+        return None
+    print(f"[WS] Printer '{printer_name}' not in memory. Will report as 'Disconnected'.")
+    return json.dumps({"status": "Disconnected"})
 
-active_loops = {}  # Keeps track of one loop per printer
 
 class PrinterStatusConsumer(AsyncWebsocketConsumer):
-    def __init__(self):
-        super().__init__()
-        self.email_send = False
-
+    """Forward the status of one printer to the browser.
+    The StatusPublisher sends every change to the group of the printer, the consumer does no polling.
+    Clients offering a protocol version 2 subprotocol get a snapshot and numbered deltas,
+    other clients get the full status document on every change."""
     async def connect(self):
         pk = self.scope['url_route']['kwargs']['pk'] 
 
@@ -25,175 +35,107 @@ class PrinterStatusConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        self.room_group_name = f"printer_{self.printer_name}"
-
-        if self.printer_name not in printer_manager.printers:
-            print(f"[WS] Printer '{self.printer_name}' not in memory. Will report as 'Disconnected'.")
+        self.room_group_name = group_name(self.printer_name)
+        self.protocol = protocol.select_protocol(self.scope.get("subprotocols", []))
+        self.seq = 0
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol=self.protocol)
+
+        status_publisher.start(asyncio.get_running_loop())
 
-        # Only one loop per printer, start it in the background
-        if self.printer_name not in active_loops:
-            active_loops[self.printer_name] = True
-            asyncio.create_task(self.start_broadcast_loop())
+        # Send the current status right away, further changes arrive through the group
+        if self.protocol:
+            await self.send_snapshot()
+            return
+
+        try:
+            document = await sync_to_async(current_document, thread_sensitive=False)(self.printer_name)
+        except ConnectionError as e:
+            print(f"[WS] Status of '{self.printer_name}' not available: {e}")
+            document = json.dumps({"status": "Disconnected"})
+        if document:
+            await self.send(text_data=document)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        active_loops.pop(self.printer_name, None)  # Force-stop loop on disconnect
-
-    async def start_broadcast_loop(self):
-        last_status = None
-
-        while self.printer_name in active_loops:
-            try:
-                printer_exists = await sync_to_async(Printer.objects.filter(name=self.printer_name).exists)()
-                if not printer_exists:
-                    print(f"[WS] Printer '{self.printer_name}' no longer exists. Closing socket.")
-                    active_loops.pop(self.printer_name, None)  # Stop the loop
-                    await self.close()
-                    return
-            except Exception as e:
-                print(f"[WS] DB check failed: {e}")
-
-            printer_data = await sync_to_async(printer_manager.list_printer)(self.printer_name)
-
-            if printer_data:
-                time_remaining = printer_manager.monitorprinter_time_remaining.get(self.printer_name)
-                printer_status = printer_manager.monitorprinter_status.get(self.printer_name)
-                job_status_error = printer_manager.job_status_error.get(self.printer_name)
-
-                # Handle completed jobs
-                if time_remaining == "Printing Completed":
-                    active_job = await self.get_active_job(self.printer_name)
-                    if active_job:
-                        completed_data = await self.mark_job_completed(active_job["job_id"])
-                        if completed_data:
-                            printer_data.update(completed_data)
-                            await self.send_email(completed_data["job_id"])
-                            self.email_send = True
-
-                # Handle ongoing jobs
-                elif printer_status in ["SD printing", "Uploading to SD card"]:
-                    job_data = await self.get_active_job(self.printer_name)
-                    if job_data:
-                        printer_data.update(job_data)
-                        self.email_send = False
-                
-                # Handle failed jobs
-                elif job_status_error:
-                    active_job = await self.get_active_job(self.printer_name)
-                    if active_job:
-                        failed_job = await self.mark_job_failed(active_job["job_id"])
-                        if failed_job:
-                            printer_data.update(failed_job)
-                            await self.send_email(failed_job["job_id"])
-                            self.email_send = True
-
-                current_status = json.dumps(printer_data)
-                if current_status != last_status:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "printer.status",
-                            "message": current_status
-                        }
-                    )
-                    last_status = current_status
-
-            else:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "printer.status",
-                        "message": json.dumps({"status": "Disconnected"})
-                    }
-                )
-
-            await asyncio.sleep(1)
+        if hasattr(self, "room_group_name"):
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        message = protocol.decode(text_data, bytes_data)
+        if self.protocol and message and message.get("type") == "resync":
+            await self.send_snapshot()
+
+    async def send_snapshot(self):
+        try:
+            document, self.seq = await sync_to_async(status_publisher.snapshot, thread_sensitive=False)(self.printer_name)
+        except ConnectionError as e:
+            print(f"[WS] Status of '{self.printer_name}' not available: {e}")
+            document, self.seq = {"status": "Disconnected"}, 0
+        await self.send(**protocol.frame(self.protocol, {"type": "snapshot", "seq": self.seq, "data": document}))
 
     async def printer_status(self, event):
-        await self.send(text_data=event["message"])
+        if not self.protocol:
+            await self.send(text_data=event["message"])
+            return
+        if event["seq"] <= self.seq:
+            return # Already part of the snapshot
+        self.seq = event["seq"]
+        await self.send(**protocol.pick(self.protocol, event["frames"]))
+
+    async def printer_removed(self, event):
+        print(f"[WS] Printer '{self.printer_name}' no longer exists. Closing socket.")
+        await self.close()
 
     async def job_status(self, event):
         await self.send(text_data=event["message"])
 
-    @sync_to_async
-    def get_active_job(self, printer_name):
-        job = PrintJob.objects.select_related("user").filter(
-            printer__name=printer_name, status__in=["Printing", "Completed"]).first()
-        if job:
-            return {
-                "job_status": "Printing",
-                "job_id": job.id,
-                "job_owner_id": job.user.id,
-            }
-        return None
 
-    @sync_to_async
-    def mark_job_completed(self, job_id):
-        job = PrintJob.objects.select_related("user").filter(id=job_id).first()
-        if job:
-            job.status = "Completed"
-            job.save()
-            return {
-                "job_status": "Completed",
-                "job_id": job.id,
-                "job_owner_id": job.user.id}
-        return None
-    
-    @sync_to_async
-    def mark_job_failed(self, job_id):
-        job = PrintJob.objects.select_related("user").filter(id=job_id).first()
-        if job:
-            job.status = "Failed"
-            job.save()
-        if job:
-            return {
-                "job_status": "Failed",
-                "job_id": job.id,
-                "job_owner_id": job.user.id,
-            }
-        return None
-    
-    @sync_to_async
-    def send_email(self, job_id):
-        if self.email_send:
+class FleetStatusConsumer(AsyncWebsocketConsumer):
+    """Stream the status of all printers over one socket.
+    The first message holds the full status of every printer, the next ones only the changed fields,
+    batched into frames by the StatusPublisher. A printer mapped to null was removed.
+    With protocol version 2 the messages are typed and numbered like in PrinterStatusConsumer."""
+    async def connect(self):
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            await self.close()
             return
 
-        job = PrintJob.objects.select_related("user").filter(id=job_id).first()
-        if not job or not job.user or not job.user.email:
+        self.protocol = protocol.select_protocol(self.scope.get("subprotocols", []))
+        self.seq = 0
+
+        await self.channel_layer.group_add(FLEET_GROUP, self.channel_name)
+        await self.accept(subprotocol=self.protocol)
+
+        status_publisher.start(asyncio.get_running_loop())
+        await self.send_snapshot()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(FLEET_GROUP, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        message = protocol.decode(text_data, bytes_data)
+        if self.protocol and message and message.get("type") == "resync":
+            await self.send_snapshot()
+
+    async def send_snapshot(self):
+        printer_names = await sync_to_async(list)(Printer.objects.values_list("name", flat=True))
+        try:
+            self.seq, documents = await sync_to_async(status_publisher.fleet_snapshot, thread_sensitive=False)(printer_names)
+        except ConnectionError as e:
+            print(f"[WS] Fleet status not available: {e}")
+            self.seq, documents = 0, {printer_name: {"status": "Disconnected"} for printer_name in printer_names}
+        if self.protocol:
+            await self.send(**protocol.frame(self.protocol, {"type": "snapshot", "seq": self.seq, "printers": documents}))
+        else:
+            await self.send(text_data=json.dumps({"printers": documents}))
+
+    async def fleet_update(self, event):
+        if not self.protocol:
+            await self.send(text_data=event["message"])
+            return
+        if event["seq"] <= self.seq:
             return
-        
-        filename = job.file.name.split("/")[-1]
-        email_message_completed = render_to_string('emails/print_job_completed.html', {
-            'username': job.user.username,
-            'filename': job.file.name,
-            'printer': job.printer.name,
-        })
-
-        email_message_failed = render_to_string('emails/print_job_failed.html', {
-            'username': job.user.username,
-            'filename': job.file.name,
-            'printer': job.printer.name,
-        })
-        # Send email only if the user has an email address
-        if job.user.email:
-            try:
-                if job.status == "Completed":
-                    send_mail(
-                        subject=f"Your print {filename} is ready for pickup",
-                        message= email_message_completed,
-                        from_email=settings.DEFAULT_FROM_EMAIL,
-                        recipient_list=[job.user.email],
-                    )
-                if job.status == "Failed":
-                    send_mail(
-                        subject=f"Your print {filename} has failed",
-                        message= email_message_failed,
-                        from_email=settings.DEFAULT_FROM_EMAIL,
-                        recipient_list=[job.user.email],
-                    )
-
-            except Exception as e:
-                print(f"Email failed: {e}")
+        self.seq = event["seq"]
+        await self.send(**protocol.pick(self.protocol, event["frames"]))
@@ -0,0 +1,88 @@
+import os
+import re
+from printer_manager.instance import printer_manager
+from .models import Printer, PrintJob
+
+DEFAULT_JOB_DURATION = 60*60 # Seconds assumed for a job whose G-code has no time estimate
+MODEL_REMOVAL_DELAY = 30*60 # Seconds assumed until a finished model is taken off the printer
+MAX_QUEUE_LENGTH = 10 # Queued jobs allowed per printer
+ESTIMATE_SCAN_BYTES = 64*1024 # Slicers write the estimate to the start or the end of the file
+
+REGEX_CURA_TIME = re.compile(rb";TIME:(\d+)")
+REGEX_PRUSA_TIME = re.compile(rb"; estimated printing time \(normal mode\) = (?:(\d+)d\s*)?(?:(\d+)h\s*)?(?:(\d+)m\s*)?(?:(\d+)s)?")
+
+estimate_cache = {} # (path, modification time) -> estimated seconds
+
+def estimate_duration(path):
+    """Estimated print time of a G-code file in seconds, read from the slicer comments.
+    Returns DEFAULT_JOB_DURATION when the file has no estimate."""
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        return DEFAULT_JOB_DURATION
+    if key in estimate_cache:
+        return estimate_cache[key]
+
+    with open(path, "rb") as file:
+        data = file.read(ESTIMATE_SCAN_BYTES)
+        size = os.path.getsize(path)
+        if size > ESTIMATE_SCAN_BYTES:
+            file.seek(max(size - ESTIMATE_SCAN_BYTES, ESTIMATE_SCAN_BYTES))
+            data += file.read()
+
+    duration = DEFAULT_JOB_DURATION
+    match = REGEX_CURA_TIME.search(data)
+    if match:
+        duration = int(match.group(1))
+    else:
+        match = REGEX_PRUSA_TIME.search(data)
+        if match and any(match.groups()):
+            days, hours, minutes, seconds = (int(group) if group else 0 for group in match.groups())
+            duration = ((days*24 + hours)*60 + minutes)*60 + seconds
+
+    estimate_cache[key] = duration
+    return duration
+
+def job_duration(job):
+    """Duration of a job from its analysis, from the slicer comments for jobs queued before analysis."""
+    if job.estimated_duration is not None:
+        return job.estimated_duration
+    return estimate_duration(job.file.path)
+
+def expected_start_time(printer):
+    """Seconds until a new job on the printer could start, None if the printer can not take jobs.
+    Counts the rest of the current job, the queued jobs and the time until the model is removed."""
+    if printer.queue_length >= MAX_QUEUE_LENGTH:
+        return None
+    commands = printer_manager.printers.get(printer.name)
+    state = printer_manager.snapshot(printer.name)
+    if not commands or not commands.connected or not state or state.status in ("Disconnected", "Unknown"):
+        return None
+
+    if state.status == "SD printing":
+        current = state.time_remaining if state.time_remaining else DEFAULT_JOB_DURATION / 2
+        current += MODEL_REMOVAL_DELAY
+    elif state.status in ("Waiting for upload slot", "Uploading to SD card"):
+        live_state = printer_manager.get_state(printer.name)
+        analysis = live_state.analysis if live_state else None
+        duration = analysis.duration if analysis else estimate_duration(state.printing_file or "")
+        current = (state.sd_upload_time_remaining or 0) + duration
+        current += MODEL_REMOVAL_DELAY
+    elif not state.model_removed:
+        current = MODEL_REMOVAL_DELAY # Finished, waiting for the model to be removed
+    else:
+        current = 0
+
+    queued = (PrintJob.objects.filter(printer=printer, status="Queued").only("file", "estimated_duration")
+              if printer.queue_length else ())
+    return current + sum(job_duration(job) + MODEL_REMOVAL_DELAY for job in queued)
+
+def choose_printer():
+    """The connected printer where a new job would be finished first, None if no printer can take it.
+    The duration of the new job is the same on every printer, so the printer that gets free first wins."""
+    best, best_time = None, None
+    for printer in Printer.objects.order_by("queue_length", "pk"):
+        start_time = expected_start_time(printer)
+        if start_time is not None and (best_time is None or start_time < best_time):
+            best, best_time = printer, start_time
+    return best
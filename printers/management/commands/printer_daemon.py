@@ -0,0 +1,41 @@
+import signal
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from printer_manager.instance import printer_manager
+from printer_manager.rpc import RpcServer
+from printers.publisher import StatusPublisher, publisher_services
+
+class Command(BaseCommand):
+    help = ("Connect the printers and serve them on the Unix socket PRINTER_DAEMON_SOCKET, "
+            "so the ASGI server can run several workers. The status is published from here.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.PRINTER_DAEMON_SOCKET,
+                            help="path of the Unix socket, PRINTER_DAEMON_SOCKET by default")
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("Set PRINTER_DAEMON_SOCKET or pass --socket.")
+        try:
+            manager = printer_manager.start(local=True)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        if "InMemory" in settings.CHANNEL_LAYERS["default"]["BACKEND"]:
+            self.stderr.write("The in-memory channel layer doesn't reach the web workers, use Redis (DEBUG=False).")
+
+        # The only publisher, the workers forward its group messages
+        publisher = StatusPublisher(manager)
+        server = RpcServer(manager, options["socket"], services=publisher_services(publisher))
+        publisher.start(server.loop)
+        server.start()
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+        manager.save_printer_config(flush=True)
+        self.stdout.write("Printer daemon stopped.")
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+def count_queued_jobs(apps, schema_editor):
+    Printer = apps.get_model('printers', 'Printer')
+    for printer in Printer.objects.all():
+        printer.queue_length = printer.printjob_set.filter(status='Queued').count()
+        printer.save(update_fields=['queue_length'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0003_alter_printjob_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printer',
+            name='queue_length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='printjob',
+            index=models.Index(fields=['printer', 'status', 'created_at'], name='printjob_queue_idx'),
+        ),
+        migrations.RunPython(count_queued_jobs, migrations.RunPython.noop),
+    ]
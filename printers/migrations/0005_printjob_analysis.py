@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-16 23:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0004_printer_queue_length_printjob_queue_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printjob',
+            name='estimated_duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='printjob',
+            name='filament_length',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='printjob',
+            name='layer_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='printjob',
+            name='time_table',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -5,6 +5,7 @@ class Printer(models.Model):
     name = models.CharField(max_length=255, unique=True)
     port = models.CharField(max_length=255, unique=True)
     baudrate = models.IntegerField(default=115200)
+    queue_length = models.PositiveIntegerField(default=0) # Number of queued jobs, kept by printers.scheduler
 
     def __str__(self):
         return self.name
@@ -18,5 +19,16 @@ class PrintJob(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Analysis of the G-code file, see printer_manager.gcode_analyzer
+    estimated_duration = models.FloatField(null=True, blank=True) # seconds
+    layer_count = models.PositiveIntegerField(null=True, blank=True)
+    filament_length = models.FloatField(null=True, blank=True) # mm
+    time_table = models.JSONField(null=True, blank=True) # [[byte offset, elapsed seconds], ...]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["printer", "status", "created_at"], name="printjob_queue_idx"), # Queue order of a printer
+        ]
+
     def __str__(self):
         return f"{self.file.name} - {self.printer.name} ({self.user.username})"
\ No newline at end of file
@@ -0,0 +1,44 @@
+import json
+import msgpack
+
+# Status protocol version 2, negotiated as a WebSocket subprotocol.
+# The server sends {"type": "snapshot", "seq": n, ...} on connect and {"type": "delta", "seq": n, ...}
+# with only the changed fields afterwards. A client that sees a gap in seq sends {"type": "resync"}
+# and gets a new snapshot. Clients that offer no subprotocol get the full JSON document (version 1).
+PROTOCOL_JSON = "printer-status.v2.json"
+PROTOCOL_MSGPACK = "printer-status.v2.msgpack" # Binary frames
+PROTOCOLS = (PROTOCOL_MSGPACK, PROTOCOL_JSON)
+
+def select_protocol(offered):
+    """Pick the protocol from the subprotocols offered by the client, None for version 1."""
+    for protocol in PROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return None
+
+def encode(message):
+    """Encode a message once for every protocol, consumers pick their encoding with pick()."""
+    return {
+        PROTOCOL_JSON: json.dumps(message, separators=(",", ":")),
+        PROTOCOL_MSGPACK: msgpack.packb(message),
+    }
+
+def pick(protocol, frames):
+    """Return the send() arguments of a message encoded with encode()."""
+    if protocol == PROTOCOL_MSGPACK:
+        return {"bytes_data": frames[protocol]}
+    return {"text_data": frames[protocol]}
+
+def frame(protocol, message):
+    """Return the send() arguments of a message in the given protocol."""
+    if protocol == PROTOCOL_MSGPACK:
+        return {"bytes_data": msgpack.packb(message)}
+    return {"text_data": json.dumps(message, separators=(",", ":"))}
+
+def decode(text_data=None, bytes_data=None):
+    """Decode a message from the client, None if it is not valid."""
+    try:
+        message = msgpack.unpackb(bytes_data) if bytes_data is not None else json.loads(text_data)
+    except (ValueError, msgpack.UnpackException):
+        return None
+    return message if isinstance(message, dict) else None
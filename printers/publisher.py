@@ -0,0 +1,294 @@
+import json
+import asyncio
+import threading
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.core.mail import send_mail
+from django.template.loader import render_to_string
+from django.conf import settings
+from printer_manager.instance import printer_manager
+from .models import PrintJob
+from . import protocol
+
+ACTIVE_STATUSES = ["SD printing", "Waiting for upload slot", "Uploading to SD card"]
+FLEET_GROUP = "printers" # Group of the consumers that show all printers
+
+def group_name(printer_name):
+    return f"printer_{printer_name}"
+
+class StatusPublisher:
+    """Push printer state changes from the PrinterManager to the channel layer.
+    The manager calls on_change() from the serial engine whenever a field changes, the changes are
+    coalesced per printer and handled on the ASGI event loop. Job bookkeeping (completed/failed jobs,
+    emails) runs only on state transitions, so idle printers cost no database queries."""
+    def __init__(self, manager):
+        self.manager = manager
+        self.loop = None
+        self.lock = threading.Lock()
+        self.pending = {} # printer name -> [version, changes, snapshot] waiting to be processed
+        self.tasks = {} # printer name -> task processing the pending changes
+        self.documents = {} # printer name -> last status document sent to the group
+        self.sequences = {} # printer name -> sequence number of the last document, never reset
+        self.jobs = {} # printer name -> job fields added to the status document
+        self.fleet_batch = {} # printer name -> fields changed since the last fleet frame, None when removed
+        self.fleet_frame = None # Timer of the next fleet frame
+        self.fleet_sequence = 0 # Sequence number of the last fleet frame
+
+    def start(self, loop):
+        """Start listening to the manager. The events are handled on loop, the loop of the consumers."""
+        if self.loop:
+            return
+        self.loop = loop
+        self.manager.add_listener(self.on_change)
+        for printer_name in list(self.manager.states):
+            self.refresh(printer_name)
+
+    def refresh(self, printer_name):
+        """Process the whole state of a printer as if every field changed."""
+        state = self.manager.get_state(printer_name)
+        if state:
+            snapshot = state.snapshot()
+            self.on_change(printer_name, state.version, dict(zip(snapshot._fields, snapshot)), snapshot)
+        else:
+            self.on_change(printer_name, None, None, None)
+
+    def on_change(self, printer_name, version, changes, snapshot):
+        """Listener of the PrinterManager, called from any thread."""
+        with self.lock:
+            entry = self.pending.get(printer_name)
+            if entry is None:
+                self.pending[printer_name] = [version, dict(changes or {}), snapshot]
+                self.loop.call_soon_threadsafe(self.schedule, printer_name)
+                return
+            # Merge with the changes not processed yet, the newest snapshot wins
+            entry[1].update(changes or {})
+            if snapshot is None or entry[0] is None or version >= entry[0]:
+                entry[0], entry[2] = version, snapshot
+
+    def schedule(self, printer_name):
+        task = self.tasks.get(printer_name)
+        if task is None or task.done():
+            self.tasks[printer_name] = asyncio.ensure_future(self.process(printer_name))
+
+    async def process(self, printer_name):
+        """Send the pending changes of a printer, until none are left."""
+        channel_layer = get_channel_layer()
+        while True:
+            with self.lock:
+                entry = self.pending.pop(printer_name, None)
+            if entry is None:
+                return
+            version, changes, snapshot = entry
+
+            if snapshot is None:
+                # The printer was removed
+                self.documents.pop(printer_name, None)
+                self.jobs.pop(printer_name, None)
+                self.queue_fleet(printer_name, None)
+                await channel_layer.group_send(group_name(printer_name), {"type": "printer.removed"})
+                continue
+
+            try:
+                await self.update_job(printer_name, changes, snapshot)
+            except Exception as e:
+                print(f"[WS] Job update for '{printer_name}' failed: {e}")
+
+            document = snapshot.to_dict()
+            document.update(self.jobs.get(printer_name) or {})
+            previous = self.documents.get(printer_name) or {}
+            if document == previous:
+                continue # Only fields that are not shown changed
+            self.documents[printer_name] = document
+            sequence = self.sequences[printer_name] = self.sequences.get(printer_name, 0) + 1
+            changes = {key: value for key, value in document.items() if previous.get(key) != value}
+            changes.update({key: None for key in previous if key not in document}) # Removed job fields
+            self.queue_fleet(printer_name, changes)
+
+            await channel_layer.group_send(
+                group_name(printer_name),
+                {
+                    "type": "printer.status",
+                    "message": json.dumps(dict(document, version=version)),
+                    "seq": sequence,
+                    "frames": protocol.encode({"type": "delta", "seq": sequence, "data": changes}),
+                }
+            )
+
+    async def update_job(self, printer_name, changes, snapshot):
+        """Mark the active job completed or failed when the printer state says so."""
+        job = self.jobs.get(printer_name)
+
+        # Handle completed jobs
+        if snapshot.completed:
+            if "completed" in changes:
+                job = await mark_job(printer_name, "Completed")
+
+        # Handle ongoing jobs
+        elif snapshot.status in ACTIVE_STATUSES:
+            if "status" in changes or job is None or job["job_status"] != "Printing":
+                job = await get_active_job(printer_name)
+
+        # Handle failed jobs
+        elif snapshot.job_status_error:
+            if "job_status_error" in changes:
+                job = await mark_job(printer_name, "Failed")
+
+        else:
+            job = None
+
+        self.jobs[printer_name] = job
+
+    def queue_fleet(self, printer_name, changes):
+        """Add changed fields of a printer to the next fleet frame, frames are sent at most
+        PRINTER_FLEET_FRAME_RATE times per second and only when something changed."""
+        if changes is None or self.fleet_batch.get(printer_name, {}) is None:
+            self.fleet_batch[printer_name] = changes
+        else:
+            self.fleet_batch.setdefault(printer_name, {}).update(changes)
+
+        if self.fleet_frame is None:
+            self.fleet_frame = self.loop.call_later(1 / settings.PRINTER_FLEET_FRAME_RATE, self.send_fleet_frame)
+
+    def send_fleet_frame(self):
+        self.fleet_frame = None
+        batch, self.fleet_batch = self.fleet_batch, {}
+        if batch:
+            self.fleet_sequence += 1
+            asyncio.ensure_future(get_channel_layer().group_send(
+                FLEET_GROUP,
+                {
+                    "type": "fleet.update",
+                    "message": json.dumps({"printers": batch}),
+                    "seq": self.fleet_sequence,
+                    "frames": protocol.encode({"type": "delta", "seq": self.fleet_sequence, "printers": batch}),
+                }
+            ))
+
+    def fleet_documents(self, printer_names):
+        """Current status documents of the given printers for a new fleet consumer, valid at fleet_sequence.
+        Printers known to the manager that were not sent yet are refreshed and arrive with the next frame."""
+        documents = {}
+        for printer_name in printer_names:
+            document = self.documents.get(printer_name)
+            if document is None:
+                if printer_name in self.manager.states:
+                    self.refresh(printer_name)
+                document = {"status": "Disconnected"}
+            documents[printer_name] = document
+        return documents
+
+    def fleet_snapshot(self, printer_names):
+        """fleet_sequence and the fleet_documents() valid at it."""
+        return self.fleet_sequence, self.fleet_documents(printer_names)
+
+    def document(self, printer_name):
+        """Last status document sent for a printer, None if nothing was sent yet."""
+        document = self.documents.get(printer_name)
+        return json.dumps(document) if document else None
+
+    def snapshot(self, printer_name):
+        """Last status document of a printer and its sequence number, for protocol version 2.
+        A printer without a document is reported as disconnected and refreshed if the manager knows it.
+        The sequence number is read first, consumers call this from a worker thread while process() runs."""
+        sequence = self.sequences.get(printer_name, 0)
+        document = self.documents.get(printer_name)
+        if document is None:
+            if printer_name in self.manager.states:
+                self.refresh(printer_name)
+            document = {"status": "Disconnected"}
+        return document, sequence
+
+
+class RemotePublisher:
+    """The StatusPublisher of the printer daemon, for web workers with PRINTER_DAEMON_SOCKET set.
+    The daemon publishes the status and does the job bookkeeping once for all workers, the consumers
+    only forward the group messages. Snapshots for new clients are asked from the daemon's publisher."""
+    def __init__(self, manager):
+        self.manager = manager
+
+    def start(self, loop):
+        pass
+
+    def refresh(self, printer_name):
+        self.manager.call("status_refresh", printer_name)
+
+    def fleet_snapshot(self, printer_names):
+        sequence, documents = self.manager.call("fleet_snapshot", list(printer_names))
+        return sequence, documents
+
+    def document(self, printer_name):
+        return self.manager.call("status_document", printer_name)
+
+    def snapshot(self, printer_name):
+        document, sequence = self.manager.call("status_snapshot", printer_name)
+        return document, sequence
+
+
+@sync_to_async
+def get_active_job(printer_name):
+    job = PrintJob.objects.select_related("user").filter(
+        printer__name=printer_name, status__in=["Printing", "Completed"]).first()
+    if job:
+        return {
+            "job_status": "Printing",
+            "job_id": job.id,
+            "job_owner_id": job.user.id,
+        }
+    return None
+
+@sync_to_async
+def mark_job(printer_name, status):
+    """Set the status of the active job, the owner gets an email the first time."""
+    job = PrintJob.objects.select_related("user", "printer").filter(
+        printer__name=printer_name, status__in=["Printing", "Completed"]).first()
+    if not job:
+        return None
+    if job.status != status:
+        job.status = status
+        job.save()
+        send_email(job)
+    return {
+        "job_status": status,
+        "job_id": job.id,
+        "job_owner_id": job.user.id,
+    }
+
+def send_email(job):
+    if not job.user or not job.user.email:
+        return
+
+    filename = job.file.name.split("/")[-1]
+    context = {
+        'username': job.user.username,
+        'filename': job.file.name,
+        'printer': job.printer.name,
+    }
+    try:
+        if job.status == "Completed":
+            send_mail(
+                subject=f"Your print {filename} is ready for pickup",
+                message=render_to_string('emails/print_job_completed.html', context),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                recipient_list=[job.user.email],
+            )
+        if job.status == "Failed":
+            send_mail(
+                subject=f"Your print {filename} has failed",
+                message=render_to_string('emails/print_job_failed.html', context),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                recipient_list=[job.user.email],
+            )
+    except Exception as e:
+        print(f"Email failed: {e}")
+
+def publisher_services(publisher):
+    """RPC methods of the daemon's publisher, called by RemotePublisher."""
+    return {
+        "status_refresh": publisher.refresh,
+        "fleet_snapshot": publisher.fleet_snapshot,
+        "status_document": publisher.document,
+        "status_snapshot": publisher.snapshot,
+    }
+
+# The daemon runs its own StatusPublisher (manage.py printer_daemon)
+status_publisher = RemotePublisher(printer_manager) if settings.PRINTER_DAEMON_SOCKET else StatusPublisher(printer_manager)
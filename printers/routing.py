@@ -1,6 +1,7 @@
 from django.urls import re_path
-from .consumers import PrinterStatusConsumer
+from .consumers import PrinterStatusConsumer, FleetStatusConsumer
 
 websocket_urlpatterns = [
     re_path(r'ws/printers/(?P<pk>\d+)/$', PrinterStatusConsumer.as_asgi(), name='printer_status'),
+    re_path(r'ws/printers/$', FleetStatusConsumer.as_asgi(), name='fleet_status'),
 ]
\ No newline at end of file
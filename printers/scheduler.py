@@ -0,0 +1,97 @@
+import os
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from printer_manager.gcode_analyzer import analyze_cached
+from .models import Printer, PrintJob
+
+class DatabaseJobQueue:
+    """Print queue kept in the database, the PrintJob rows with status "Queued" are the queue.
+    Jobs are taken in created_at order through the (printer, status, created_at) index and
+    Printer.queue_length counts the queued jobs, so the length is read without counting rows.
+    Deleted queued jobs leave the count through the post_delete signal, wherever they are deleted (admin,
+    deleted users), and recount() at startup corrects jobs changed while the server was down.
+    Has the same methods as printer_manager.job_queue.MemoryJobQueue."""
+
+    def enqueue(self, printer_name, filename, owner=None):
+        """Create a queued PrintJob for a file in MEDIA_ROOT, with the analysis of the file.
+        owner is a user or its primary key (from the printer daemon's clients)."""
+        try:
+            analysis = analyze_cached(filename)
+        except (OSError, ValueError) as e:
+            print(f"Error analyzing '{filename}': {e}")
+            analysis = None
+
+        with transaction.atomic():
+            printer = self.get_printer(printer_name)
+            job = PrintJob.objects.create(
+                printer=printer,
+                user_id=getattr(owner, "pk", owner),
+                file=os.path.relpath(filename, settings.MEDIA_ROOT),
+                status="Queued",
+                estimated_duration=analysis.duration if analysis else None,
+                layer_count=analysis.layer_count if analysis else None,
+                filament_length=analysis.filament_length if analysis else None,
+                time_table=analysis.time_table if analysis else None,
+            )
+            Printer.objects.filter(pk=printer.pk).update(queue_length=F("queue_length") + 1)
+        return job
+
+    def dequeue(self, printer_name):
+        """Mark the oldest queued job as printing and return the path of its file, None when the queue is empty.
+        A job locked or taken by a concurrent dequeue is skipped."""
+        while True:
+            with transaction.atomic():
+                job = (PrintJob.objects.select_for_update(skip_locked=True)
+                       .filter(printer__name=printer_name, status="Queued")
+                       .order_by("created_at").first())
+                if job is None:
+                    return None
+                # The status check makes the claim atomic on databases without row locks (SQLite)
+                if PrintJob.objects.filter(pk=job.pk, status="Queued").update(status="Printing"):
+                    Printer.objects.filter(pk=job.printer_id).update(queue_length=F("queue_length") - 1)
+                    return job.file.path
+
+    def remove(self, printer_name, filename):
+        """Delete the newest queued job of a file. Returns False if it is not queued."""
+        with transaction.atomic():
+            for job in (PrintJob.objects.select_for_update()
+                        .filter(printer__name=printer_name, status="Queued").order_by("-created_at")):
+                if job.file.path == filename:
+                    self.delete(job)
+                    return True
+        return False
+
+    def delete(self, job):
+        """Delete a job, a queued job is removed from the queue length by job_deleted()."""
+        PrintJob.objects.filter(pk=job.pk).delete()
+
+    def length(self, printer_name):
+        return Printer.objects.filter(name=printer_name).values_list("queue_length", flat=True).first() or 0
+
+    def items(self, printer_name):
+        """Paths of the queued files, oldest first."""
+        jobs = PrintJob.objects.filter(printer__name=printer_name, status="Queued").order_by("created_at")
+        return [job.file.path for job in jobs]
+
+    def remove_printer(self, printer_name):
+        pass # The jobs are deleted together with the Printer row
+
+    def recount(self):
+        """Recompute the queue length of every printer, at startup for jobs changed while the server was down."""
+        for printer in Printer.objects.all():
+            printer.queue_length = PrintJob.objects.filter(printer=printer, status="Queued").count()
+            printer.save(update_fields=["queue_length"])
+
+    def get_printer(self, printer_name):
+        try:
+            return Printer.objects.get(name=printer_name)
+        except Printer.DoesNotExist:
+            raise ValueError(f"Printer '{printer_name}' not found in the database.")
+
+@receiver(post_delete, sender=PrintJob)
+def job_deleted(sender, instance, **kwargs):
+    if instance.status == "Queued":
+        Printer.objects.filter(pk=instance.printer_id, queue_length__gt=0).update(queue_length=F("queue_length") - 1)
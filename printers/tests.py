@@ -1,3 +1,769 @@
-from django.test import TestCase
+import os
+import json
+import stat
+import asyncio
+import time
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import serial
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.messages import get_messages
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from printer_manager import printer_commands as commands_module
+from printer_manager import printer_manager as manager_module
+from printer_manager import port_registry as registry_module
+from printer_manager.config_store import ConfigStore
+from printer_manager.gcode_analyzer import strip_comment
+from printer_manager.instance import ManagerProxy, printer_manager
+from printer_manager.poll_policy import PollScheduler, poll_activity, IDLE, HEATING, PRINTING, UPLOADING, MAX_WAIT
+from printer_manager.printer_commands import PrinterCommands
+from printer_manager.printer_manager import PrinterManager
+from printer_manager.printer_state import PrinterState
+from printer_manager.rpc import ManagerClient, RpcServer
+from printer_manager.simulator import Simulator
+from printers.models import Printer, PrintJob
+from printers.scheduler import DatabaseJobQueue
+from printers import consumers, dispatcher, protocol, routing, views
+from printers import publisher as publisher_module
+from printers.publisher import RemotePublisher, StatusPublisher, publisher_services, group_name
+
+GCODE = """; Simulated test print
+G28 ; home
+G90
+M83
+G1 Z0.3 F600
+"""
+
+def write_gcode(path, layers=3, moves=40):
+    """Write a small G-code file, about 2 seconds of printing per layer."""
+    with open(path, "w") as file:
+        file.write(GCODE)
+        for layer in range(layers):
+            file.write(f"; Layer {layer}\nG1 Z{0.3 + layer * 0.2:.1f}\n")
+            for move in range(moves):
+                file.write(f"G1 X{10 + move % 2 * 20} Y{10 + move * 0.5:.1f} E0.5 F3000 ; move {move}\n")
+
+def wait_for(condition, timeout=10):
+    """Wait until condition() is true, returns its last value."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+def ask(port, commands):
+    """Send commands to a port and return the response lines up to the last "ok"."""
+    with serial.Serial(port, 115200, timeout=2) as connection:
+        response = []
+        for command in commands:
+            connection.write((command + "\n").encode())
+            while True:
+                line = connection.readline().decode().strip()
+                if not line:
+                    raise AssertionError(f"No response to '{command}'.")
+                response.append(line)
+                if line.startswith("ok"):
+                    break
+        return response
+
+
+class SimulatorTests(SimpleTestCase):
+    def setUp(self):
+        self.simulator = Simulator()
+        self.addCleanup(self.simulator.close)
+
+    def test_firmware_report(self):
+        printer = self.simulator.add_printer()
+        commands = PrinterCommands(printer.port)
+        self.addCleanup(commands.disconnect)
+        self.assertTrue(commands.connected)
+        self.assertIn("Marlin", commands.firmware)
+        self.assertTrue(commands.capabilities["AUTOREPORT_TEMP"])
+
+    def test_status_lines_not_in_response(self):
+        printer = self.simulator.add_printer(latency=0.2)
+        lines = []
+        commands = PrinterCommands(printer.port, on_line=lines.append)
+        self.addCleanup(commands.disconnect)
+        response = commands.engine.submit(commands.connection.send("M20"))
+        self.simulator.call(printer.write, "T:25.00 /0.00 B:20.00 /0.00\n") # Auto report while M20 waits for its answer
+        self.assertEqual(response.result(5), ["Begin file list", "End file list"])
+        self.assertIn("T:25.00 /0.00 B:20.00 /0.00", lines)
+
+    def test_lost_line(self):
+        printer = self.simulator.add_printer(drop_lines=1)
+        with mock.patch.object(commands_module, "REPORT_TIMEOUT", 0.3):
+            commands = PrinterCommands(printer.port) # The first M115 is lost, the second one is answered
+        self.addCleanup(commands.disconnect)
+        self.assertTrue(commands.connected)
+        self.assertIn("Marlin", commands.firmware)
+
+        printer.drop_lines = 2 # Lose the next command
+        self.assertIsNone(commands.engine.call(commands.connection.send("M20", timeout=0.3)))
+        self.assertEqual(commands.send_gcode_command("M20"), ["Begin file list", "End file list"])
+        self.assertEqual(commands.send_gcode_command("M31"), ["echo:Print time: 0h 0m 0s"])
+
+    def test_sd_card(self):
+        printer = self.simulator.add_printer(firmware="prusa")
+        ask(printer.port, ["M28 test.gco", "G28", "G1 X10 F600", "M29", "M104 S200"])
+        self.assertEqual(printer.sd_files(), ["TEST.GCO"])
+        self.assertEqual(printer.read_file("TEST.GCO"), "G28\nG1 X10 F600\n")
+        self.assertIn("TEST.GCO 16", ask(printer.port, ["M20"]))
+        self.assertRegex(ask(printer.port, ["M105"])[-1], r"ok T:[\d.]+ /200.00 B:")
+
+        response = ask(printer.port, ["M32 TEST.GCO", "M27", "M31"])
+        self.assertTrue(any(line.startswith("SD printing byte") for line in response))
+        self.assertTrue(any(line.startswith("NORMAL MODE: Percent done:") for line in response))
+        self.assertTrue(any(line.endswith("sec") for line in response))
+        ask(printer.port, ["M524", "M30 TEST.GCO"])
+        self.assertEqual(printer.sd_files(), [])
+
+    def test_line_numbers(self):
+        printer = self.simulator.add_printer()
+        response = ask(printer.port, ["M110 N0", "N1 G28*18", "N3 G28*16"])
+        self.assertIn("Resend: 2", response)
+        self.assertIn("Resend: 2", ask(printer.port, ["N2 G28*0"])) # Wrong checksum
+
+    def test_many_printers(self):
+        printers = [self.simulator.add_printer() for _ in range(24)]
+        connections = [serial.Serial(printer.port, 115200, timeout=2) for printer in printers]
+        try:
+            for connection in connections:
+                connection.write(b"M105\n")
+            for connection in connections:
+                self.assertTrue(connection.readline().startswith(b"ok T:"))
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+class PrinterManagerTests(SimpleTestCase):
+    """Regression tests of the printer manager against simulated printers."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        for patcher in (mock.patch.object(manager_module, "DEBUG", False),
+                        mock.patch.object(manager_module, "CONFIG_FILE", os.path.join(self.directory, "printers_config.json")),
+                        mock.patch.object(registry_module, "BY_ID_DIRECTORY", os.path.join(self.directory, "by-id"))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.simulator = Simulator()
+        self.addCleanup(self.simulator.close)
+        self.manager = PrinterManager()
+        self.addCleanup(self.manager.config.flush) # Before the directory is removed
+        self.addCleanup(self.manager.ports.close)
+        self.filename = os.path.join(self.directory, "cube.gcode")
+        write_gcode(self.filename)
+
+    def connect(self, name="sim", **options):
+        printer = self.simulator.add_printer(**options)
+        self.manager.connect_printer(name, printer.port)
+        self.addCleanup(self.manager.remove_printer, name)
+        self.assertIn(name, self.manager.printers)
+        return printer
+
+    def expected_upload(self):
+        with open(self.filename) as file:
+            return "".join(strip_comment(line) + "\n" for line in file if strip_comment(line))
+
+    def test_polling(self):
+        self.connect(firmware="prusa")
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing" and state.hotend_temp))
+
+    def test_upload_with_resends(self):
+        printer = self.connect(resend_every=25, latency=0.001)
+        self.manager.upload_file("sim", self.filename)
+        state = self.manager.snapshot("sim")
+        self.assertFalse(state.job_status_error)
+        self.assertGreater(printer.resends, 0)
+        self.assertEqual(printer.read_file(state.printing_sd_filename), self.expected_upload())
+
+    def test_sd_print_progress(self):
+        printer = self.connect()
+        self.manager.upload_file("sim", self.filename)
+        sd_filename = self.manager.snapshot("sim").printing_sd_filename
+        self.manager.load_analysis("sim", self.filename)
+        printer.print_speed = self.manager.get_state("sim").analysis.duration / 3 # About 3 seconds
+        start = time.monotonic()
+        self.manager.print_file_from_sd("sim", sd_filename)
+        self.assertLess(time.monotonic() - start, 1) # No monitor restart
+
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "SD printing"))
+        self.assertTrue(wait_for(lambda: state.completed))
+        self.assertEqual(self.manager.snapshot("sim").progress, 100)
+
+    def test_upload_rx_buffer_size(self):
+        printer = self.connect(rx_buffer_size=64)
+        self.manager.printers["sim"].rx_buffer_size = 64 # More bytes in flight would overflow the printer
+        self.manager.upload_file("sim", self.filename)
+        state = self.manager.snapshot("sim")
+        self.assertFalse(state.job_status_error)
+        self.assertEqual(printer.overflows, 0)
+        self.assertEqual(printer.read_file(state.printing_sd_filename), self.expected_upload())
+
+    def test_cancel_upload(self):
+        printer = self.connect(latency=0.02)
+        upload = threading.Thread(target=self.manager.upload_file, args=("sim", self.filename))
+        upload.start()
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "Uploading to SD card" and printer.sd_files()))
+
+        changes = []
+        self.manager.add_listener(lambda printer_name, version, fields, snapshot: changes.append(fields))
+        self.manager.cancel_print("sim")
+        upload.join(5)
+        self.assertFalse(upload.is_alive())
+        self.assertTrue(state.job_status_error)
+        self.assertTrue(any(fields and fields.get("job_status_error") for fields in changes)) # Published
+        self.assertIsNone(printer.writing) # M29 closed the file
+        self.assertLess(len(printer.read_file(printer.sd_files()[0])), len(self.expected_upload()))
+
+    def test_commands(self):
+        printer = self.connect()
+        start = time.monotonic()
+        self.manager.send_gcode("sim", "M104 S210")
+        self.assertEqual(self.manager.list_sd_files("sim"), [])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(printer.hotend_target, 210)
+
+    def test_autoreport(self):
+        printer = self.connect()
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing" and state.hotend_temp))
+        time.sleep(1.5)
+        self.assertEqual(printer.received["M155"], 1) # Temperatures are reported by the firmware
+        self.assertEqual(printer.received["M105"], 1) # Once for the current temperatures
+        self.assertEqual(printer.autoreports["M155"][0], 10)
+
+    def test_adaptive_polling(self):
+        printer = self.connect(capabilities={"AUTOREPORT_TEMP": 0, "AUTOREPORT_SD_STATUS": 0})
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing" and state.hotend_temp))
+        time.sleep(1.5)
+        self.assertEqual(printer.received["M105"], 1) # Idle printers are polled every 10 seconds
+        self.assertEqual(printer.received["M31"], 0)
+
+        self.manager.send_gcode("sim", "M104 S200")
+        self.assertTrue(wait_for(lambda: printer.received["M105"] >= 3, timeout=5)) # Heating, every second
+
+    def test_remove_from_unknown_queue(self):
+        self.manager.remove_from_queue("missing", self.filename) # Reported, not raised
+        with self.assertRaisesRegex(ValueError, "No queue found"):
+            self.manager.remove_from_queue("missing", self.filename, raise_on_error=True)
+
+    def test_status_lines(self):
+        changes = []
+        state = PrinterState(on_change=lambda version, fields, snapshot: changes.append(fields))
+        self.manager.states["parsed"] = state
+        self.addCleanup(self.manager.states.pop, "parsed")
+        self.manager.read_serial("parsed", "echo:Print time: 0h 1m 40s") # Not printing yet, ignored
+        self.assertIsNone(state.print_time)
+        self.manager.read_serial("parsed", "SD printing byte 50/100")
+        self.manager.read_serial("parsed", "echo:Print time: 0h 1m 40s")
+        self.assertEqual((state.status, state.print_time, state.progress), ("SD printing", 100, 50))
+        count = len(changes)
+        self.manager.read_serial("parsed", "SD printing byte 50/100")
+        self.manager.read_serial("parsed", "echo:busy: processing")
+        self.assertEqual(len(changes), count) # Nothing changed, nothing published
+        self.manager.read_serial("parsed", "ok T:200.0 /210.0 B:60.0 /60.0")
+        self.assertEqual(changes[-1], {"hotend_temp": 200.0, "bed_temp": 60.0})
+        self.assertEqual(state.hotend_target, 210.0)
+
+    def test_config_saved(self):
+        self.connect()
+        self.manager.config.flush()
+        manager = PrinterManager()
+        self.addCleanup(manager.config.flush)
+        self.addCleanup(manager.ports.close)
+        self.addCleanup(manager.remove_printer, "sim")
+        self.assertEqual(manager.printers["sim"].port, self.manager.printers["sim"].port)
+
+    def test_parallel_startup(self):
+        printers = [self.simulator.add_printer(latency=0.05) for _ in range(3)]
+        config = {f"sim{number}": {"port": printer.port} for number, printer in enumerate(printers)}
+        config["silent"] = {"port": self.simulator.add_printer(drop_lines=1000).port} # Never answers
+        config["unplugged"] = {"port": os.path.join(self.directory, "ttyACM9")}
+        store = ConfigStore(manager_module.CONFIG_FILE)
+        store.update(config)
+        store.flush()
+
+        start = time.monotonic()
+        with mock.patch.object(commands_module, "CONNECT_DEADLINE", 1):
+            manager = PrinterManager()
+        elapsed = time.monotonic() - start
+        self.addCleanup(manager.config.flush)
+        self.addCleanup(manager.ports.close)
+        for name in config:
+            self.addCleanup(manager.remove_printer, name)
+
+        self.assertLess(elapsed, 2) # Not one printer after the other, the silent one only gets its deadline
+        self.assertEqual([name for name in config if manager.printers[name].connected], ["sim0", "sim1", "sim2"])
+        for name in ("sim0", "sim1", "sim2"):
+            self.assertLess(manager.printers[name].connect_time, 0.5) # Not held up by the silent printer
+        self.assertEqual(str(manager.printers["silent"].connect_error), "No response within 1 seconds.")
+        self.assertIn("No such file", str(manager.printers["unplugged"].connect_error))
+
+    def test_monitor_not_connected(self):
+        self.connect()
+        state = self.manager.get_state("sim")
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing"))
+        self.manager.stop_monitor_threads("sim")
+        self.manager.printers["sim"].disconnect()
+        self.manager.start_monitor_threads("sim") # Refused, there is no connection for the channel
+        self.assertEqual(state.status, "Disconnected")
+
+    def start_unplugged(self):
+        """Start a manager whose printer "sim" is configured on a by-id link that doesn't exist yet."""
+        os.mkdir(registry_module.BY_ID_DIRECTORY)
+        link = os.path.join(registry_module.BY_ID_DIRECTORY, "usb-Simulated_Printer_5678-if00")
+        store = ConfigStore(manager_module.CONFIG_FILE)
+        store.update({"sim": {"port": link, "monitorprinter_status": "Not SD printing"}})
+        store.flush()
+        manager = PrinterManager()
+        self.addCleanup(manager.config.flush)
+        self.addCleanup(manager.ports.close)
+        self.addCleanup(manager.remove_printer, "sim")
+        return manager, link
+
+    def test_unplugged_at_startup(self):
+        manager, link = self.start_unplugged()
+        state = manager.get_state("sim")
+        self.assertFalse(manager.printers["sim"].connected)
+        self.assertEqual(state.status, "Disconnected") # Not the status saved before the restart
+
+        os.symlink(self.simulator.add_printer().port, link)
+        manager.reconnect_printer("sim")
+        self.assertTrue(manager.printers["sim"].connected)
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing"))
+
+    def test_plugged_in_after_startup(self):
+        manager, link = self.start_unplugged()
+        os.symlink(self.simulator.add_printer().port, link)
+        manager.ports.scan()
+        self.assertTrue(manager.printers["sim"].connected)
+        self.assertFalse(manager.monitor_tasks["sim"].done())
+        self.assertTrue(wait_for(lambda: manager.get_state("sim").status == "Not SD printing"))
+
+    def test_replug(self):
+        os.mkdir(registry_module.BY_ID_DIRECTORY)
+        link = os.path.join(registry_module.BY_ID_DIRECTORY, "usb-Simulated_Printer_1234-if00")
+        printer = self.simulator.add_printer()
+        os.symlink(printer.port, link)
+        self.manager.ports.scan()
+        self.assertIn(link, [port for port, _ in self.manager.list_serial_ports()])
+        self.manager.connect_printer("sim", link)
+        self.addCleanup(self.manager.remove_printer, "sim")
+        state = self.manager.get_state("sim")
+
+        # Unplugged
+        self.simulator.remove_printer(printer)
+        os.remove(link)
+        self.assertTrue(wait_for(lambda: state.status == "Disconnected"))
+        self.manager.ports.scan()
+
+        # Plugged in again, it gets another device
+        printer = self.simulator.add_printer()
+        os.symlink(printer.port, link)
+        self.manager.ports.scan()
+        self.assertTrue(self.manager.printers["sim"].connected)
+        self.assertTrue(wait_for(lambda: state.status == "Not SD printing"))
+
+    def test_daemon(self):
+        server = RpcServer(self.manager, os.path.join(self.directory, "daemon.sock"))
+        server.start()
+        self.addCleanup(server.close)
+        self.assertEqual(stat.S_IMODE(os.stat(server.path).st_mode), 0o660)
+        client = ManagerClient(server.path)
+        changes = []
+        client.add_listener(lambda printer_name, version, fields, snapshot: changes.append((printer_name, fields)))
+
+        printer = self.simulator.add_printer()
+        client.connect_printer("sim", printer.port)
+        self.addCleanup(self.manager.remove_printer, "sim")
+        self.assertTrue(client.printers["sim"].connected)
+        self.assertTrue(wait_for(lambda: client.snapshot("sim") and client.snapshot("sim").hotend_temp))
+        self.assertIn("sim", client.states)
+        self.assertTrue(any(fields and "hotend_temp" in fields for _, fields in changes))
+
+        client.send_gcode("sim", "M104 S200")
+        self.assertEqual(printer.hotend_target, 200)
+        with self.assertRaisesRegex(ValueError, "Error removing printer"):
+            client.remove_printer("missing", raise_on_error=True)
+        self.assertIsNone(client.analysis("sim"))
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    def test_daemon_publisher(self):
+        publisher = StatusPublisher(self.manager)
+        server = RpcServer(self.manager, os.path.join(self.directory, "daemon.sock"), services=publisher_services(publisher))
+        publisher.start(server.loop)
+        server.start()
+        self.addCleanup(server.close)
+        client = ManagerClient(server.path)
+        remote = RemotePublisher(client)
+        remote.start(None)
+        self.assertEqual(client.listeners, []) # Workers don't publish
+
+        printer = self.simulator.add_printer()
+        self.manager.connect_printer("sim", printer.port)
+        self.addCleanup(self.manager.remove_printer, "sim")
+        self.assertTrue(wait_for(lambda: remote.snapshot("sim")[0].get("hotend_temp")))
+        document, sequence = remote.snapshot("sim")
+        self.assertEqual((document, sequence), (publisher.documents["sim"], publisher.sequences["sim"]))
+        self.assertEqual(json.loads(remote.document("sim")), document)
+        self.assertTrue(wait_for(lambda: remote.fleet_snapshot(["sim"])[0] > 0))
+        self.assertEqual(remote.fleet_snapshot(["sim", "missing"])[1]["missing"], {"status": "Disconnected"})
+
+
+class ManagerProxyTests(SimpleTestCase):
+    def test_not_started(self):
+        self.assertFalse(printer_manager.started) # Tests don't take the printers of the server
+        with self.assertRaises(RuntimeError):
+            printer_manager.printers
+
+    def test_one_owner(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "printers_config.json.lock")
+        lock_file = ManagerProxy().claim_printers(path)
+        self.addCleanup(lock_file.close)
+        with self.assertRaisesRegex(RuntimeError, str(os.getpid())):
+            ManagerProxy().claim_printers(path)
+
+
+class ConfigStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.path = os.path.join(self.directory, "printers_config.json")
+
+    def test_coalesced(self):
+        store = ConfigStore(self.path, delay=0.2)
+        for number in range(50):
+            store.update({"a": {"port": "/dev/ttyACM0", "current_byte": number}, "b": {"port": "/dev/ttyACM1"}})
+        self.assertTrue(wait_for(lambda: store.writes == 1))
+        time.sleep(0.3)
+        self.assertEqual(store.writes, 1)
+        self.assertEqual(ConfigStore(self.path).load()["a"]["current_byte"], 49)
+
+        store.update({"a": {"port": "/dev/ttyACM0", "current_byte": 49}, "b": {"port": "/dev/ttyACM1"}})
+        store.flush()
+        self.assertEqual(store.writes, 1) # Unchanged
+        self.assertEqual(os.listdir(self.directory), ["printers_config.json"]) # No temporary files left
+
+    def test_unchanged_entries_reused(self):
+        store = ConfigStore(self.path)
+        store.update({"a": {"port": "/dev/ttyACM0", "current_byte": 0}, "b": {"port": "/dev/ttyACM1"}})
+        serialized = store.entries["b"]
+        store.update({"a": {"port": "/dev/ttyACM0", "current_byte": 10}, "b": {"port": "/dev/ttyACM1"}})
+        self.assertIs(store.entries["b"], serialized)
+        store.flush()
+        self.assertEqual(ConfigStore(self.path).load(), {"a": {"port": "/dev/ttyACM0", "current_byte": 10},
+                                                         "b": {"port": "/dev/ttyACM1"}})
+
+    def test_damaged_file(self):
+        store = ConfigStore(self.path)
+        store.update({"a": {"port": "/dev/ttyACM0"}})
+        store.flush()
+        store.update({"a": {"port": "/dev/ttyACM1"}})
+        store.flush()
+        with open(self.path, "w") as file:
+            file.write('{"a": {"po') # Cut off
+        self.assertEqual(ConfigStore(self.path).load(), {"a": {"port": "/dev/ttyACM0"}})
+
+        os.remove(self.path + ".bak")
+        self.assertEqual(ConfigStore(self.path).load(), {})
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class StatusPublisherTests(SimpleTestCase):
+    def setUp(self):
+        self.manager = mock.Mock(states={})
+        self.publisher = StatusPublisher(self.manager)
+
+    async def listen(self, group):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        return lambda: asyncio.wait_for(layer.receive(channel), 2)
+
+    def test_coalesced(self):
+        async def run():
+            receive = await self.listen(group_name("p"))
+            self.publisher.start(asyncio.get_running_loop())
+            state = PrinterState(on_change=lambda *change: self.publisher.on_change("p", *change))
+            for temperature in range(20, 30):
+                state.update(hotend_temp=float(temperature), status="Not SD printing")
+            event = await receive()
+            self.assertEqual(event["type"], "printer.status")
+            self.assertEqual(json.loads(event["message"])["hotend_temp"], "29.0") # The burst arrives as one message
+            self.assertEqual(json.loads(event["message"])["version"], 10)
+
+            state.update(last_connected=5.0, model_removed=True) # Not shown
+            state.update(bed_temp=60.0)
+            event = await receive()
+            self.assertEqual(json.loads(event["message"])["bed_temp"], "60.0")
+
+            self.publisher.on_change("p", None, None, None)
+            self.assertEqual((await receive())["type"], "printer.removed")
+        asyncio.run(run())
+
+    def test_job_transitions(self):
+        job = {"job_status": "Completed", "job_id": 1, "job_owner_id": 2}
+        async def run():
+            receive = await self.listen(group_name("p"))
+            self.publisher.start(asyncio.get_running_loop())
+            state = PrinterState(on_change=lambda *change: self.publisher.on_change("p", *change))
+            state.update(status="Not SD printing", completed=True)
+            self.assertEqual(json.loads((await receive())["message"])["job_id"], 1)
+            state.update(hotend_temp=25.0)
+            await receive()
+        with mock.patch.object(publisher_module, "mark_job", mock.AsyncMock(return_value=job)) as mark_job:
+            asyncio.run(run())
+        mark_job.assert_called_once_with("p", "Completed") # Once per transition, not per change
+
+    def test_delta_frames(self):
+        async def run():
+            receive = await self.listen(group_name("p"))
+            self.publisher.start(asyncio.get_running_loop())
+            state = PrinterState(on_change=lambda *change: self.publisher.on_change("p", *change))
+            state.update(status="Not SD printing", hotend_temp=20.0)
+            first = await receive()
+            state.update(hotend_temp=21.0)
+            second = await receive()
+            return first, second
+        first, second = asyncio.run(run())
+        self.assertEqual((first["seq"], second["seq"]), (1, 2))
+        delta = msgpack.unpackb(second["frames"][protocol.PROTOCOL_MSGPACK])
+        self.assertEqual(delta, {"type": "delta", "seq": 2, "data": {"hotend_temp": "21.0"}})
+        self.assertEqual(json.loads(second["frames"][protocol.PROTOCOL_JSON]), delta)
+        self.assertEqual(json.loads(first["frames"][protocol.PROTOCOL_JSON])["data"]["status"], "Not SD printing") # Everything is new
+        document, sequence = self.publisher.snapshot("p")
+        self.assertEqual((document["hotend_temp"], sequence), ("21.0", 2))
+
+    @override_settings(PRINTER_FLEET_FRAME_RATE=20)
+    def test_fleet_frames(self):
+        async def run():
+            receive = await self.listen(publisher_module.FLEET_GROUP)
+            self.publisher.start(asyncio.get_running_loop())
+            states = {}
+            for printer_name in ("p", "q"):
+                states[printer_name] = PrinterState(on_change=lambda *change, name=printer_name: self.publisher.on_change(name, *change))
+                states[printer_name].update(status="Not SD printing", hotend_temp=20.0)
+            event = await receive()
+            self.assertEqual(event["seq"], 1)
+            self.assertEqual(json.loads(event["message"])["printers"]["q"]["hotend_temp"], "20.0") # Both in one frame
+            self.assertEqual(set(json.loads(event["message"])["printers"]), {"p", "q"})
+
+            states["p"].update(hotend_temp=21.0)
+            self.publisher.on_change("q", None, None, None)
+            event = await receive()
+            self.assertEqual(json.loads(event["message"]), {"printers": {"p": {"hotend_temp": "21.0"}, "q": None}})
+            documents = self.publisher.fleet_documents(["p", "q"])
+            self.assertEqual((self.publisher.fleet_sequence, documents["p"]["hotend_temp"], documents["q"]),
+                             (2, "21.0", {"status": "Disconnected"}))
+        asyncio.run(run())
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_select(self):
+        self.assertEqual(protocol.select_protocol([protocol.PROTOCOL_JSON, protocol.PROTOCOL_MSGPACK]), protocol.PROTOCOL_MSGPACK)
+        self.assertEqual(protocol.select_protocol(["other", protocol.PROTOCOL_JSON]), protocol.PROTOCOL_JSON)
+        self.assertIsNone(protocol.select_protocol([]))
+
+    def test_frames(self):
+        message = {"type": "delta", "seq": 7, "data": {"status": "SD printing"}}
+        frames = protocol.encode(message)
+        self.assertEqual(protocol.pick(protocol.PROTOCOL_JSON, frames),
+                         {"text_data": '{"type":"delta","seq":7,"data":{"status":"SD printing"}}'})
+        self.assertEqual(msgpack.unpackb(protocol.pick(protocol.PROTOCOL_MSGPACK, frames)["bytes_data"]), message)
+        self.assertEqual(protocol.frame(protocol.PROTOCOL_MSGPACK, message), {"bytes_data": frames[protocol.PROTOCOL_MSGPACK]})
+        self.assertEqual(protocol.frame(None, message), {"text_data": frames[protocol.PROTOCOL_JSON]})
+
+    def test_decode(self):
+        self.assertEqual(protocol.decode(text_data='{"type": "resync"}'), {"type": "resync"})
+        self.assertEqual(protocol.decode(bytes_data=msgpack.packb({"type": "resync"})), {"type": "resync"})
+        self.assertIsNone(protocol.decode(text_data="[1]"))
+        self.assertIsNone(protocol.decode(text_data="{"))
+        self.assertIsNone(protocol.decode(bytes_data=b"\xc1"))
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ConsumerTests(TestCase):
+    """The consumers of a web worker whose printer daemon is not running."""
+    def setUp(self):
+        self.printer = Printer.objects.create(name="p", port="/dev/ttyACM0")
+        client = ManagerClient(os.path.join(tempfile.gettempdir(), "missing-printer-daemon.sock"))
+        patcher = mock.patch.object(consumers, "status_publisher", RemotePublisher(client))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def receive(self, path, subprotocols=None):
+        """Connect to path and return the first message."""
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), path, subprotocols=subprotocols)
+        communicator.scope["user"] = mock.Mock(is_authenticated=True)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            return json.loads(await communicator.receive_from())
+        finally:
+            await communicator.disconnect()
+
+    async def test_daemon_not_reachable(self):
+        path = f"/ws/printers/{self.printer.pk}/"
+        self.assertEqual(await self.receive(path), {"status": "Disconnected"})
+        self.assertEqual(await self.receive(path, [protocol.PROTOCOL_JSON]),
+                         {"type": "snapshot", "seq": 0, "data": {"status": "Disconnected"}})
+        self.assertEqual(await self.receive("/ws/printers/", [protocol.PROTOCOL_JSON]),
+                         {"type": "snapshot", "seq": 0, "printers": {"p": {"status": "Disconnected"}}})
+
+
+class PollSchedulerTests(SimpleTestCase):
+    def test_intervals(self):
+        scheduler = PollScheduler()
+        self.assertEqual(scheduler.due(IDLE, now=0), ["M105", "M27"])
+        self.assertEqual(scheduler.due(IDLE, now=5), [])
+        self.assertEqual(scheduler.wait(IDLE, now=5), MAX_WAIT)
+        self.assertEqual(scheduler.due(HEATING, now=3), ["M105"])
+        self.assertEqual(scheduler.due(PRINTING, now=10), ["M105", "M27", "M31"])
+        self.assertEqual(scheduler.due(UPLOADING, now=20), [])
+
+    def test_autoreport(self):
+        scheduler = PollScheduler({"AUTOREPORT_TEMP": True})
+        self.assertEqual(scheduler.due(IDLE, now=0), ["M155 S10", "M105", "M27"])
+        self.assertEqual(scheduler.due(IDLE, now=10), ["M27"])
+        self.assertEqual(scheduler.due(UPLOADING, now=11), ["M155 S0"])
+        scheduler.refresh("M105")
+        self.assertEqual(scheduler.due(HEATING, now=12), ["M155 S1", "M105"])
+
+    def test_activity(self):
+        state = PrinterState()
+        self.assertEqual(poll_activity(state), IDLE)
+        state.hotend_temp, state.hotend_target = 25.0, 200.0
+        self.assertEqual(poll_activity(state), HEATING)
+        state.status = "SD printing"
+        self.assertEqual(poll_activity(state), PRINTING)
+        self.assertEqual(poll_activity(state, uploading=True), UPLOADING)
+
+
+class DatabaseJobQueueTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.directory)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.printer = Printer.objects.create(name="p", port="/dev/ttyACM0")
+        self.queue = DatabaseJobQueue()
+        self.files = []
+        for number in range(3):
+            path = os.path.join(self.directory, f"part{number}.gcode")
+            write_gcode(path, layers=1, moves=2)
+            self.files.append(path)
+            self.queue.enqueue("p", path)
+
+    def test_order(self):
+        self.assertEqual(self.queue.length("p"), 3)
+        self.assertEqual(self.queue.items("p"), self.files)
+        self.assertEqual(self.queue.dequeue("p"), self.files[0])
+        self.assertEqual(PrintJob.objects.get(status="Printing").file.path, self.files[0])
+        self.assertEqual(self.queue.length("p"), 2)
+        self.assertTrue(self.queue.remove("p", self.files[2]))
+        self.assertFalse(self.queue.remove("p", self.files[2]))
+        self.assertEqual(self.queue.dequeue("p"), self.files[1])
+        self.assertIsNone(self.queue.dequeue("p"))
+        self.assertEqual(self.queue.length("p"), 0)
+        self.assertIsNotNone(PrintJob.objects.first().estimated_duration)
+        with self.assertRaises(ValueError):
+            self.queue.enqueue("missing", self.files[0])
+
+    def test_deleted_elsewhere(self):
+        self.queue.dequeue("p")
+        PrintJob.objects.get(status="Printing").delete() # Not queued, the length stays
+        self.assertEqual(self.queue.length("p"), 2)
+        PrintJob.objects.filter(status="Queued").first().delete() # e.g. in the admin
+        self.assertEqual(self.queue.length("p"), 1)
+
+    def test_recount(self):
+        Printer.objects.update(queue_length=7)
+        PrintJob.objects.filter(status="Queued").update(status="Failed")
+        self.queue.recount()
+        self.assertEqual(self.queue.length("p"), 0)
+
+
+class DispatcherTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.states = {}
+        manager = mock.Mock(printers={}, snapshot=lambda printer_name: self.states[printer_name].snapshot())
+        patcher = mock.patch.object(dispatcher, "printer_manager", manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for number, name in enumerate(("a", "b", "c")):
+            Printer.objects.create(name=name, port=f"/dev/ttyACM{number}")
+            manager.printers[name] = mock.Mock(connected=name != "c")
+            self.states[name] = PrinterState(status="Not SD printing", model_removed=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_estimate_duration(self):
+        self.assertEqual(dispatcher.estimate_duration(self.write("cura.gcode", ";FLAVOR:Marlin\n;TIME:5025\nG28\n")), 5025)
+        prusa = self.write("prusa.gcode", "G28\n" * 30000 + "; estimated printing time (normal mode) = 1d 2h 3m 4s\n")
+        self.assertEqual(dispatcher.estimate_duration(prusa), ((24 + 2) * 60 + 3) * 60 + 4) # Found at the end
+        self.assertEqual(dispatcher.estimate_duration(self.write("plain.gcode", "G28\n")), dispatcher.DEFAULT_JOB_DURATION)
+        self.assertEqual(dispatcher.estimate_duration(os.path.join(self.directory, "missing.gcode")),
+                         dispatcher.DEFAULT_JOB_DURATION)
+
+    def test_choose_printer(self):
+        self.states["a"].update(status="SD printing", time_remaining=600)
+        self.assertEqual(dispatcher.expected_start_time(Printer.objects.get(name="a")), 600 + dispatcher.MODEL_REMOVAL_DELAY)
+        self.assertIsNone(dispatcher.expected_start_time(Printer.objects.get(name="c"))) # Disconnected
+        self.assertEqual(dispatcher.choose_printer().name, "b") # Free right away
+
+        self.states["b"].update(model_removed=False)
+        PrintJob.objects.create(printer=Printer.objects.get(name="b"), file="gcode_files/x.gcode", estimated_duration=60)
+        Printer.objects.filter(name="b").update(queue_length=1)
+        b = dispatcher.expected_start_time(Printer.objects.get(name="b"))
+        self.assertEqual(b, dispatcher.MODEL_REMOVAL_DELAY + 60 + dispatcher.MODEL_REMOVAL_DELAY)
+        self.assertEqual(dispatcher.choose_printer().name, "a") # Gets free first
+
+        Printer.objects.filter(name="a").update(queue_length=dispatcher.MAX_QUEUE_LENGTH)
+        self.assertEqual(dispatcher.choose_printer().name, "b")
+        Printer.objects.filter(name="b").update(queue_length=dispatcher.MAX_QUEUE_LENGTH)
+        self.assertIsNone(dispatcher.choose_printer())
+
+
+class StartPrintTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("student", password="x", print_jobs_limit=3)
+        self.client.force_login(self.user)
+        self.printer = Printer.objects.create(name="p", port="/dev/ttyACM0")
+
+    def test_missing_file(self):
+        with mock.patch.object(views, "submit_print") as submit_print, \
+                mock.patch.object(views, "choose_printer") as choose_printer:
+            response = self.client.post(reverse("start_print_any"))
+            self.assertRedirects(response, reverse("printer_list"), fetch_redirect_response=False)
+            response = self.client.post(reverse("start_print", args=[self.printer.pk]))
+            self.assertRedirects(response, reverse("printer_detail", args=[self.printer.pk]), fetch_redirect_response=False)
+        submit_print.assert_not_called()
+        choose_printer.assert_not_called()
+        self.assertEqual([str(message) for message in get_messages(response.wsgi_request)],
+                         ["Choose a G-code file to print."] * 2)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.print_jobs_limit, 3)
@@ -15,6 +15,7 @@ import time
 
 from .models import Printer, PrintJob
 from .forms import PrinterForm
+from .dispatcher import choose_printer, MAX_QUEUE_LENGTH
 from accounts.decorators import role_required
 from printer_manager.instance import printer_manager
 
@@ -93,7 +94,8 @@ class PrinterDetailView(LoginRequiredMixin, DetailView):
         context['page_obj'] = paginator.get_page(page_number)
 
         # Add model_removed flag from printer_manager
-        context['model_removed'] = printer_manager.model_removed.get(printer.name, False)
+        state = printer_manager.snapshot(printer.name)
+        context['model_removed'] = state.model_removed if state else False
 
         # Add printer_connected flag
         context['printer_connected'] = printer.name in printer_manager.printers
@@ -105,36 +107,58 @@ def start_print(request, pk):
     printer = get_object_or_404(Printer, pk=pk)
     gcode_file = request.FILES.get("file")
 
+    if gcode_file is None:
+        messages.error(request, "Choose a G-code file to print.", extra_tags='print_error')
+        return redirect('printer_detail', pk=pk)
+
     if request.user.print_jobs_limit <= 0:
         messages.error(request, "You have reached your print job limit.", extra_tags='print_error')
         return redirect('printer_detail', pk=pk)
     
-    queue_length = len(printer_manager.queues.get(printer.name, []))
-    if queue_length >= 10:
-        messages.error(request, "Queue is full. A maximum of 10 print jobs are allowed per printer.", extra_tags='print_error')
+    if printer.queue_length >= MAX_QUEUE_LENGTH:
+        messages.error(request, f"Queue is full. A maximum of {MAX_QUEUE_LENGTH} print jobs are allowed per printer.", extra_tags='print_error')
         return redirect('printer_detail', pk=pk)
 
+    submit_print(request, printer, gcode_file)
+    return redirect('printer_detail', pk=pk)
+
+@login_required
+@role_required(['admin', 'teacher', 'student'])
+@require_POST
+def start_print_any(request):
+    """Print on the printer where the job would be finished first."""
+    gcode_file = request.FILES.get("file")
+
+    if gcode_file is None:
+        messages.error(request, "Choose a G-code file to print.", extra_tags='print_error')
+        return redirect('printer_list')
+
+    if request.user.print_jobs_limit <= 0:
+        messages.error(request, "You have reached your print job limit.", extra_tags='print_error')
+        return redirect('printer_list')
+
+    printer = choose_printer()
+    if printer is None:
+        messages.error(request, "No printer is available at the moment.", extra_tags='print_error')
+        return redirect('printer_list')
+
+    submit_print(request, printer, gcode_file)
+    return redirect('printer_detail', pk=printer.pk)
+
+def submit_print(request, printer, gcode_file):
+    """Save the uploaded file and print it on the printer, or queue it if the printer is busy."""
     fs = FileSystemStorage(location=os.path.join(settings.MEDIA_ROOT, 'gcode_files'))
     filename = fs.save(gcode_file.name, gcode_file)
     file_path = fs.path(filename)
-    
-    job = PrintJob.objects.create(
-        printer=printer,
-        user=request.user,
-        file=f"gcode_files/{filename}",
-        status="Queued"
-    )
 
+    # The PrintJob is created by the database job queue of the printer manager
     try:
-        if printer_manager.model_removed.get(printer.name, False):
-            printer_manager.print_gcode(printer.name, file_path, raise_on_error=True)
-            
-            job.status = "Printing"
-            job.save()
-            printer_manager.model_removed[printer.name] = False
+        state = printer_manager.snapshot(printer.name)
+        if state and state.model_removed:
+            printer_manager.print_gcode(printer.name, file_path, raise_on_error=True, owner=request.user)
             messages.success(request, f"Printing started: {gcode_file.name}", extra_tags='print_success')
         else:
-            printer_manager.add_to_queue(printer.name, file_path, raise_on_error=True)
+            printer_manager.add_to_queue(printer.name, file_path, raise_on_error=True, owner=request.user)
             messages.success(request, f"Model added to queue: {gcode_file.name}", extra_tags='print_success')
 
         request.user.print_jobs_limit -= 1
@@ -142,8 +166,6 @@ def start_print(request, pk):
 
     except Exception as e:
         messages.error(request, f"Print failed: {e}", extra_tags='print_error')
-        
-    return redirect('printer_detail', pk=pk)
 
 @login_required
 @role_required(['admin', 'teacher', 'student'])
@@ -163,7 +185,7 @@ def delete_printjob(request, pk):
             job.user.save()
 
         # Delete the job
-        job.delete()
+        printer_manager.job_queue.delete(job)
 
         # Delete the uploaded file if it exists
         if job.file and os.path.isfile(job.file.path):
@@ -172,13 +194,10 @@ def delete_printjob(request, pk):
         # Remove from printer manager
         printer_manager.remove_model(printer_name, raise_on_error=True)
                     
-        # Start next job if one is queued
-        queued_job = PrintJob.objects.filter(printer=printer, status="Queued").order_by('created_at').first()
-        if queued_job:
-
-            queued_job.status = "Printing"
-            queued_job.save()
-            filename = os.path.basename(queued_job.file.path)
+        # remove_model() started the next queued job, if there was one
+        next_job = PrintJob.objects.filter(printer=printer, status="Printing").order_by('-created_at').first()
+        if next_job:
+            filename = os.path.basename(next_job.file.path)
             messages.success(request, f"Printing started: {filename}", extra_tags='print_success')
         else:
             messages.success(request, "Model removed. You can now upload a new one.", extra_tags='print_success')